@@ -13,13 +13,36 @@ USO:
 python backend_extractor_mejorado.py
 """
 
+from __future__ import annotations
+
 import os
 import sys
 import json
 import base64
 import re
+import time
+import colorsys
+import hashlib
+import shutil
+import threading
+import queue
+import tempfile
+import uuid
+import sqlite3
+import glob
+import importlib
+import importlib.util
+import multiprocessing
+import random
+import zipfile
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Optional, Callable, Iterator
 import io
 
 # ⭐ Cargar variables de entorno
@@ -29,18 +52,52 @@ try:
 except ImportError:
     print("⚠️ python-dotenv no instalado. Instala: pip install python-dotenv")
 
+class _LazyModule:
+    """
+    Módulo que se importa la primera vez que se usa uno de sus atributos. anthropic,
+    fitz, PIL, cv2 y numpy solo se cargan en los caminos que los necesitan (detección,
+    render, llamada a Claude), así un servidor que solo atiende /api/exercises o
+    /figures/... arranca antes y ocupa mucha menos memoria.
+    """
+    
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+    
+    def _load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+        return self._module
+    
+    def __getattr__(self, attr: str):
+        return getattr(self._load(), attr)
+    
+    def __repr__(self) -> str:
+        state = 'cargado' if self._module is not None else 'sin cargar'
+        return f"<módulo diferido {self._name} ({state})>"
+
+
 try:
-    import anthropic
-    import fitz
-    from PIL import Image
-    import cv2
-    import numpy as np
-    from flask import Flask, jsonify, request, send_from_directory
+    from flask import Flask, Response, g, jsonify, request, send_from_directory, stream_with_context
     from flask_cors import CORS
+    from werkzeug.exceptions import RequestEntityTooLarge
+    # Solo se comprueba que estén instalados; se importan al usarse
+    for _name in ('anthropic', 'fitz', 'PIL', 'cv2', 'numpy'):
+        if importlib.util.find_spec(_name) is None:
+            raise ImportError(_name)
 except ImportError:
     print("❌ Instala: pip install anthropic pymupdf pillow opencv-python numpy flask flask-cors python-dotenv")
     sys.exit(1)
 
+anthropic = _LazyModule('anthropic')
+fitz = _LazyModule('fitz')
+Image = _LazyModule('PIL.Image')
+cv2 = _LazyModule('cv2')
+np = _LazyModule('numpy')
+
 
 # ╔══════════════════════════════════════════════════════════════╗
 # ║  ⭐ CONFIGURACIÓN DE API KEY                                ║
@@ -55,6 +112,87 @@ class Config:
     # ⭐ OPCIÓN 2: Variable de entorno (RECOMENDADO)
     ANTHROPIC_API_KEY = os.environ.get('ANTHROPIC_API_KEY', ANTHROPIC_API_KEY_HARDCODED)
     
+    # ⭐ Procesos para rasterizar páginas en paralelo (1 = modo secuencial)
+    RENDER_WORKERS = int(os.environ.get('RENDER_WORKERS', '1'))
+    
+    # ⭐ Detección de figuras
+    # 'full': rasteriza cada página completa a RENDER_ZOOM
+    # 'two_pass': escaneo rápido a SCAN_ZOOM y render en alta solo de las figuras
+    # 'vector': lee los rectángulos rojos del PDF (dibujos y anotaciones); si una página
+    #           no tiene ninguno (p. ej. escaneada) usa el modo 'full'
+    DETECTION_MODE = os.environ.get('DETECTION_MODE', 'full')
+    RENDER_ZOOM = 3
+    SCAN_ZOOM = float(os.environ.get('SCAN_ZOOM', '1'))
+    
+    # ⭐ Extracción de ejercicios con Claude
+    CLAUDE_MODEL = "claude-sonnet-4-20250514"
+    CLAUDE_MAX_TOKENS = 8000
+    # Segundos máximos por llamada (cliente compartido por proceso)
+    CLAUDE_TIMEOUT = float(os.environ.get('CLAUDE_TIMEOUT', '600'))
+    # ⭐ Planificador de llamadas (todo el proceso): llamadas a la vez, tokens de entrada
+    # por minuto (0 = sin límite) y reintentos con espera exponencial ante 429/529/5xx
+    CLAUDE_MAX_IN_FLIGHT = int(os.environ.get('CLAUDE_MAX_IN_FLIGHT', '8'))
+    CLAUDE_TOKENS_PER_MINUTE = int(os.environ.get('CLAUDE_TOKENS_PER_MINUTE', '0'))
+    CLAUDE_MAX_RETRIES = int(os.environ.get('CLAUDE_MAX_RETRIES', '5'))
+    CLAUDE_BACKOFF_BASE = float(os.environ.get('CLAUDE_BACKOFF_BASE', '1'))
+    CLAUDE_BACKOFF_MAX = float(os.environ.get('CLAUDE_BACKOFF_MAX', '60'))
+    # Páginas por fragmento y fragmentos procesados a la vez
+    CHUNK_PAGES = int(os.environ.get('CHUNK_PAGES', '10'))
+    CLAUDE_CONCURRENCY = int(os.environ.get('CLAUDE_CONCURRENCY', '4'))
+    # Contenido enviado a Claude: 'pdf' (el PDF completo) o 'hybrid' (el texto de las
+    # páginas con capa de texto fiable; imagen solo de las escaneadas o con muchas fórmulas)
+    EXTRACTION_MODE = os.environ.get('EXTRACTION_MODE', 'pdf')
+    HYBRID_MIN_CHARS = int(os.environ.get('HYBRID_MIN_CHARS', '40'))  # menos texto = escaneada
+    HYBRID_MATH_RATIO = float(os.environ.get('HYBRID_MATH_RATIO', '0.05'))  # fracción de caracteres matemáticos
+    HYBRID_IMAGE_ZOOM = float(os.environ.get('HYBRID_IMAGE_ZOOM', '1.5'))
+    
+    # ⭐ Entrega de figuras: por URL (con miniatura) en lugar de base64 dentro del JSON
+    EMBED_FIGURES = os.environ.get('EMBED_FIGURES', '0') == '1'
+    THUMBNAIL_HEIGHT = int(os.environ.get('THUMBNAIL_HEIGHT', '120'))
+    
+    # ⭐ Formato de las figuras: 'png', 'webp' (con pérdida, WEBP_QUALITY) o 'webp_lossless'
+    FIGURE_FORMAT = os.environ.get('FIGURE_FORMAT', 'png')
+    PNG_COMPRESS_LEVEL = int(os.environ.get('PNG_COMPRESS_LEVEL', '6'))  # 0 (rápido) .. 9 (pequeño)
+    WEBP_QUALITY = int(os.environ.get('WEBP_QUALITY', '90'))
+    # Hilos para codificar figuras (por proceso de RENDER_WORKERS; 1 = en el mismo hilo)
+    ENCODE_WORKERS = int(os.environ.get('ENCODE_WORKERS', '4'))
+    
+    # ⭐ Figuras repetidas: una sola imagen por grupo de casi-duplicados (dHash de 256 bits)
+    DEDUP_FIGURES = os.environ.get('DEDUP_FIGURES', '1') == '1'
+    DEDUP_DISTANCE = int(os.environ.get('DEDUP_DISTANCE', '10'))  # bits distintos tolerados
+    # Índice de figuras compartido entre documentos y ejecuciones ('' = desactivado)
+    FIGURE_INDEX_DIR = os.environ.get('FIGURE_INDEX_DIR', '')
+    FIGURE_MAX_AGE = int(os.environ.get('FIGURE_MAX_AGE', '86400'))
+    
+    # ⭐ Tamaño máximo de un PDF subido (se rechaza con 413 antes de leerlo completo)
+    MAX_UPLOAD_MB = int(os.environ.get('MAX_UPLOAD_MB', '100'))
+    
+    # ⭐ Cola de trabajos (/api/jobs): trabajos simultáneos y máximo en espera
+    JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '2'))
+    JOB_QUEUE_MAX = int(os.environ.get('JOB_QUEUE_MAX', '20'))
+    JOBS_DIR = os.environ.get('JOBS_DIR', 'extracted_data/jobs')
+    # Horas que se conservan los trabajos terminados (workspace y ejercicios); 0 = para siempre
+    JOB_RETENTION_HOURS = float(os.environ.get('JOB_RETENTION_HOURS', '24'))
+    
+    # ⭐ Almacén de ejercicios editables (SQLite)
+    STORE_PATH = os.environ.get('STORE_PATH', 'extracted_data/exercises.db')
+    
+    # ⭐ Caché de resultados (mismo PDF + mismo modelo/prompt/parámetros = sin volver a procesar)
+    CACHE_ENABLED = os.environ.get('CACHE_ENABLED', '1') == '1'
+    CACHE_DIR = os.environ.get('CACHE_DIR', 'extracted_data/cache')
+    CACHE_MAX_MB = int(os.environ.get('CACHE_MAX_MB', '500'))
+    
+    # ⭐ Procesamiento por lotes (--batch): documentos a la vez y carpeta de salida
+    BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', '2'))
+    BATCH_OUTPUT_DIR = os.environ.get('BATCH_OUTPUT_DIR', 'extracted_data/batch')
+    
+    # ⭐ Servidor (--server --production): hilos que atienden peticiones y segundos
+    # que se espera a un cliente inactivo antes de cerrar su conexión
+    SERVER_HOST = os.environ.get('SERVER_HOST', '127.0.0.1')
+    SERVER_PORT = int(os.environ.get('SERVER_PORT', '5000'))
+    SERVER_THREADS = int(os.environ.get('SERVER_THREADS', '8'))
+    SERVER_TIMEOUT = int(os.environ.get('SERVER_TIMEOUT', '60'))
+    
     @classmethod
     def validate_api_key(cls):
         if not cls.ANTHROPIC_API_KEY or cls.ANTHROPIC_API_KEY == "COLOCA_TU_API_KEY_AQUI":
@@ -80,291 +218,3026 @@ class Config:
         return api_key
 
 
+EXERCISES_PROMPT = """Extrae TODOS los ejercicios matemáticos del PDF.
+
+Formato JSON (campos requeridos):
+{
+  "text": "Enunciado completo del ejercicio",
+  "question": "Pregunta específica que se hace",
+  "alternatives": "A) opción 1\\nB) opción 2\\nC) opción 3\\nD) opción 4",
+  "answer": "Letra correcta (A, B, C, D o E)",
+  "resolution": "Explicación paso a paso (sin describir figuras, solo matemática)",
+  "page": número de página
+}
+
+IMPORTANTE: 
+- El campo "page" es interno para organización, se usará pero NO se exportará al JSON final
+- "page" es la posición de la página dentro de este PDF (la primera página es 1), no el número impreso
+- NO incluyas campos adicionales como "numero" o "id"
+- Responde SOLO con array JSON: []"""
+
+
+# Modo hybrid: las páginas llegan como texto o imagen en lugar del PDF
+HYBRID_PROMPT = """Las páginas del PDF se entregan una por una, cada una precedida por el encabezado "=== Página N ===".
+Las páginas con una capa de texto fiable llegan como texto extraído del PDF; las escaneadas o con muchas fórmulas, como imagen.
+En el texto extraído los exponentes, subíndices, fracciones y raíces pueden aparecer aplanados: reconstrúyelos según el contexto.
+El campo "page" es el número N del encabezado.
+
+""" + EXERCISES_PROMPT
+
+
+# Cambia automáticamente cuando se edita el prompt (invalida la caché)
+PROMPT_VERSION = hashlib.sha256((EXERCISES_PROMPT + HYBRID_PROMPT).encode('utf-8')).hexdigest()[:12]
+
+
+# ============================================================================
+# MÉTRICAS
+# ============================================================================
+
+class Metrics:
+    """
+    Contadores, histogramas y gauges en memoria, exportados en el formato de texto
+    de Prometheus (GET /metrics). Las etiquetas se pasan como argumentos con nombre.
+    """
+    
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._types = {}
+        self._help = {}
+        self._counters = {}    # (nombre, etiquetas) -> valor
+        self._histograms = {}  # (nombre, etiquetas) -> [conteos por bucket, suma, total]
+        self._gauges = {}      # nombre -> función que devuelve {etiquetas: valor}
+    
+    def describe(self, name: str, kind: str, help_text: str):
+        self._types[name] = kind
+        self._help[name] = help_text
+    
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+    
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            entry = self._histograms.setdefault(key, [[0] * len(self.BUCKETS), 0.0, 0])
+            for idx, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    entry[0][idx] += 1
+            entry[1] += seconds
+            entry[2] += 1
+    
+    def gauge(self, name: str, help_text: str, fn: Callable[[], Dict[Tuple, float]]):
+        """Gauge calculado al exportar: fn devuelve {(('etiqueta', 'valor'), ...): valor}"""
+        self.describe(name, 'gauge', help_text)
+        self._gauges[name] = fn
+    
+    @staticmethod
+    def _escape(value) -> str:
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    
+    @staticmethod
+    def _number(value: float) -> str:
+        return str(int(value)) if float(value).is_integer() else repr(float(value))
+    
+    @classmethod
+    def _labels(cls, labels: Tuple) -> str:
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{key}="{cls._escape(value)}"' for key, value in labels) + '}'
+    
+    def render(self) -> str:
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (list(entry[0]), entry[1], entry[2]) for key, entry in self._histograms.items()}
+        samples = {}
+        
+        for (name, labels), value in counters.items():
+            samples.setdefault(name, []).append(f"{name}{self._labels(labels)} {self._number(value)}")
+        
+        for (name, labels), (buckets, total, count) in histograms.items():
+            lines = samples.setdefault(name, [])
+            for bound, bucket_count in zip(self.BUCKETS, buckets):
+                lines.append(f"{name}_bucket{self._labels(labels + (('le', bound),))} {bucket_count}")
+            lines.append(f"{name}_bucket{self._labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{self._labels(labels)} {total:.6f}")
+            lines.append(f"{name}_count{self._labels(labels)} {count}")
+        
+        for name, fn in self._gauges.items():
+            samples[name] = [f"{name}{self._labels(labels)} {self._number(value)}" for labels, value in fn().items()]
+        
+        output = []
+        for name in sorted(samples):
+            output.append(f"# HELP {name} {self._help.get(name, name)}")
+            output.append(f"# TYPE {name} {self._types.get(name, 'counter')}")
+            output.extend(samples[name])
+        return '\n'.join(output) + '\n'
+
+
+metrics = Metrics()
+metrics.describe('extractor_stage_seconds', 'histogram',
+                 'Duración por etapa: render, detect y encode por página; claude por fragmento; '
+                 'figures, exercises y persist por documento')
+metrics.describe('extractor_documents_total', 'counter', 'Documentos procesados, por origen del resultado')
+metrics.describe('extractor_pages_total', 'counter', 'Páginas procesadas')
+metrics.describe('extractor_figures_total', 'counter', 'Figuras extraídas')
+metrics.describe('extractor_exercises_total', 'counter', 'Ejercicios extraídos')
+metrics.describe('extractor_pdf_bytes_total', 'counter', 'Bytes de PDF de entrada')
+metrics.describe('extractor_render_bytes_total', 'counter', 'Bytes de píxeles rasterizados')
+metrics.describe('extractor_figure_bytes_total', 'counter', 'Bytes de imágenes de figuras escritas')
+metrics.describe('extractor_figure_duplicates_total', 'counter',
+                 'Figuras guardadas como referencia a un casi-duplicado del mismo documento')
+metrics.describe('extractor_figure_reused_total', 'counter', 'Figuras enlazadas desde el índice compartido')
+metrics.describe('extractor_claude_requests_total', 'counter', 'Llamadas a Claude')
+metrics.describe('extractor_claude_errors_total', 'counter', 'Llamadas a Claude fallidas')
+metrics.describe('extractor_claude_text_pages_total', 'counter', 'Páginas enviadas a Claude como texto (modo hybrid)')
+metrics.describe('extractor_claude_image_pages_total', 'counter', 'Páginas enviadas a Claude como imagen (modo hybrid)')
+metrics.describe('extractor_claude_retries_total', 'counter', 'Reintentos de llamadas a Claude, por código de estado')
+metrics.describe('extractor_claude_wait_seconds', 'histogram', 'Espera en la cola del planificador antes de cada llamada a Claude')
+metrics.describe('extractor_claude_input_tokens_total', 'counter', 'Tokens de entrada de Claude (usage)')
+metrics.describe('extractor_claude_output_tokens_total', 'counter', 'Tokens de salida de Claude (usage)')
+metrics.describe('http_request_duration_seconds', 'histogram',
+                 'Duración de las peticiones HTTP (hasta el primer byte en las respuestas en streaming)')
+metrics.describe('http_requests_total', 'counter', 'Peticiones HTTP por ruta y código de estado')
+metrics.describe('http_request_bytes_total', 'counter', 'Bytes recibidos en el cuerpo de las peticiones')
+metrics.describe('http_response_bytes_total', 'counter', 'Bytes enviados (respuestas de tamaño conocido)')
+
+
+# ============================================================================
+# CACHÉ DE RESULTADOS
+# ============================================================================
+
+class ResultCache:
+    """
+    Caché en disco de extracciones completas (ejercicios + manifiesto de figuras).
+    
+    Cada entrada es un directorio <clave>/ con result.json y una copia de las figuras.
+    La clave combina el hash del PDF con el modelo, la versión del prompt y los
+    parámetros de detección. Se expulsan las entradas usadas hace más tiempo cuando
+    el tamaño total supera max_bytes.
+    """
+    
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def make_key(pdf_path: str, params: Dict) -> str:
+        """Hash del contenido del PDF + parámetros que afectan al resultado"""
+        digest = hashlib.sha256()
+        with open(pdf_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        digest.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+        return digest.hexdigest()
+    
+    def get(self, key: str, figures_dir: Path) -> Optional[Tuple[List[Dict], List[Dict]]]:
+        """Devuelve (figuras, ejercicios) y restaura las imágenes en figures_dir, o None"""
+        entry = self.cache_dir / key
+        try:
+            with open(entry / 'result.json', 'r', encoding='utf-8') as f:
+                result = json.load(f)
+            
+            figures = result['figures']
+            for fig in figures:
+                for name in _figure_files(fig):
+                    (figures_dir / name).parent.mkdir(parents=True, exist_ok=True)
+                    # Sin escribir a través de un posible enlace al índice compartido
+                    (figures_dir / name).unlink(missing_ok=True)
+                    shutil.copyfile(entry / 'figures' / name, figures_dir / name)
+                fig['path'] = str(figures_dir / fig['filename'])
+            
+            # Marcar como usada recientemente (LRU)
+            os.utime(entry / 'result.json')
+        except (FileNotFoundError, KeyError, json.JSONDecodeError):
+            with self._lock:
+                self.misses += 1
+            return None
+        
+        with self._lock:
+            self.hits += 1
+        return figures, result['exercises']
+    
+    def put(self, key: str, figures: List[Dict], exercises: List[Dict]):
+        """Guarda una extracción; se escribe en un directorio temporal y se renombra al final"""
+        with self._lock:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            entry = self.cache_dir / key
+            tmp = self.cache_dir / f".{key}.{os.getpid()}.{threading.get_ident()}.tmp"
+            
+            try:
+                (tmp / 'figures' / 'thumbs').mkdir(parents=True)
+                for fig in figures:
+                    source_dir = Path(fig['path']).parent
+                    for name in _figure_files(fig):
+                        shutil.copyfile(source_dir / name, tmp / 'figures' / name)
+                
+                with open(tmp / 'result.json', 'w', encoding='utf-8') as f:
+                    json.dump({'figures': figures, 'exercises': exercises}, f, ensure_ascii=False)
+                
+                if entry.exists():
+                    shutil.rmtree(entry)
+                tmp.rename(entry)
+            finally:
+                if tmp.exists():
+                    shutil.rmtree(tmp, ignore_errors=True)
+            
+            self._evict(keep=key)
+    
+    def _evict(self, keep: str):
+        """Elimina las entradas menos usadas (salvo keep) hasta quedar por debajo de max_bytes"""
+        entries = []
+        total = 0
+        for entry in self.cache_dir.iterdir():
+            if entry.name.startswith('.') or not (entry / 'result.json').exists():
+                continue
+            size = sum(f.stat().st_size for f in entry.rglob('*') if f.is_file())
+            entries.append(((entry / 'result.json').stat().st_mtime, size, entry))
+            total += size
+        
+        for _, size, entry in sorted(entries, key=lambda item: item[0]):
+            if total <= self.max_bytes:
+                break
+            if entry.name == keep:
+                continue
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+    
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+                'dir': str(self.cache_dir),
+                'max_bytes': self.max_bytes
+            }
+
+
+def _figure_files(fig: Dict) -> List[str]:
+    """Archivos de una figura relativos a su carpeta de figuras (imagen y miniatura)"""
+    return [fig['filename']] + ([fig['thumbnail']] if fig.get('thumbnail') else [])
+
+
+result_cache = ResultCache(Config.CACHE_DIR, Config.CACHE_MAX_MB * 1024 * 1024)
+
+
+class FigureManifest:
+    """
+    figures.json escrito a medida que llegan las figuras de cada página, sin tener
+    la lista completa en memoria. Se escribe en un archivo temporal junto a path:
+    commit() lo publica (el resultado es idéntico a json.dump con indent=2) y, si no
+    se llama, al cerrar se descarta y el figures.json anterior queda intacto.
+    """
+    
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.count = 0
+        self.committed = False
+        self._temp = self.path.with_name(f".{self.path.name}.{uuid.uuid4().hex}")
+        self._file = open(self._temp, 'w', encoding='utf-8')
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.discard()
+        return False
+    
+    def write(self, figures: List[Dict]):
+        for fig in figures:
+            item = json.dumps(fig, ensure_ascii=False, indent=2).replace('\n', '\n  ')
+            self._file.write((',\n  ' if self.count else '[\n  ') + item)
+            self.count += 1
+    
+    def commit(self):
+        self._file.write('\n]' if self.count else '[]')
+        self._file.close()
+        os.replace(self._temp, self.path)
+        self.committed = True
+    
+    def read(self) -> List[Dict]:
+        """Figuras escritas hasta ahora, leídas del archivo (publicado o no)"""
+        if self.committed:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        self._file.flush()
+        with open(self._temp, 'r', encoding='utf-8') as f:
+            return json.loads(f.read() + ('\n]' if self.count else '[]'))
+    
+    def discard(self):
+        if not self._file.closed:
+            self._file.close()
+        self._temp.unlink(missing_ok=True)
+
+
+# ============================================================================
+# ALMACÉN DE EJERCICIOS
+# ============================================================================
+
+class ExerciseStore:
+    """
+    Ejercicios en SQLite, separados por documento (doc): 'default' para
+    extracted_data/ y el id del trabajo para cada workspace de /api/jobs.
+    
+    Búsquedas y ediciones por id son O(1) sobre la clave primaria (doc, id) y cada
+    escritura es una transacción atómica, así que ediciones simultáneas no se pisan.
+    Cada documento lleva un número de versión que aumenta con cada escritura.
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS exercises (
+            doc TEXT NOT NULL,
+            id TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (doc, id)
+        );
+        CREATE TABLE IF NOT EXISTS documents (
+            doc TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0,
+            source_mtime INTEGER
+        );
+    """
+    
+    def __init__(self, db_path: str):
+        self.db_path = Path(db_path)
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+    
+    def _conn(self) -> sqlite3.Connection:
+        """Una conexión por hilo; las transacciones se abren explícitamente"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            with self._init_lock:
+                if not self._initialized:
+                    conn.executescript(self.SCHEMA)
+                    self._initialized = True
+            self._local.conn = conn
+        return conn
+    
+    @contextmanager
+    def _write(self):
+        """Transacción de escritura (BEGIN IMMEDIATE: un escritor a la vez)"""
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+    
+    @staticmethod
+    def _bump_version(conn: sqlite3.Connection, doc: str, source_mtime: Optional[int] = None):
+        conn.execute(
+            'INSERT INTO documents (doc, version, source_mtime) VALUES (?, 1, ?) '
+            'ON CONFLICT(doc) DO UPDATE SET version = version + 1, '
+            'source_mtime = COALESCE(excluded.source_mtime, source_mtime)',
+            (doc, source_mtime)
+        )
+    
+    def replace(self, doc: str, exercises: List[Dict], source_mtime: Optional[int] = None):
+        """Reemplaza todos los ejercicios de un documento"""
+        with self._write() as conn:
+            conn.execute('DELETE FROM exercises WHERE doc = ?', (doc,))
+            conn.executemany(
+                'INSERT OR REPLACE INTO exercises (doc, id, position, data) VALUES (?, ?, ?, ?)',
+                [(doc, ex.get('id', f'EX_{i}'), i, json.dumps(ex, ensure_ascii=False))
+                 for i, ex in enumerate(exercises, 1)]
+            )
+            self._bump_version(conn, doc, source_mtime)
+    
+    def list(self, doc: str) -> Optional[List[Dict]]:
+        """Ejercicios del documento en orden (None si el documento no existe)"""
+        conn = self._conn()
+        if not conn.execute('SELECT 1 FROM documents WHERE doc = ?', (doc,)).fetchone():
+            return None
+        rows = conn.execute('SELECT data FROM exercises WHERE doc = ? ORDER BY position', (doc,))
+        return [json.loads(data) for (data,) in rows]
+    
+    def get(self, doc: str, exercise_id: str) -> Optional[Dict]:
+        row = self._conn().execute(
+            'SELECT data FROM exercises WHERE doc = ? AND id = ?', (doc, exercise_id)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def update(self, doc: str, exercise_id: str, fields: Dict) -> Optional[Dict]:
+        """Actualiza campos de un ejercicio; devuelve el ejercicio completo o None si no existe"""
+        with self._write() as conn:
+            row = conn.execute(
+                'SELECT data FROM exercises WHERE doc = ? AND id = ?', (doc, exercise_id)
+            ).fetchone()
+            if not row:
+                return None
+            
+            exercise = json.loads(row[0])
+            exercise.update(fields)
+            conn.execute(
+                'UPDATE exercises SET data = ? WHERE doc = ? AND id = ?',
+                (json.dumps(exercise, ensure_ascii=False), doc, exercise_id)
+            )
+            self._bump_version(conn, doc)
+            return exercise
+    
+    def update_many(self, doc: str, updates: List[Tuple[str, Dict]]) -> List[Dict]:
+        """Varias actualizaciones (id, campos) en una sola transacción; devuelve las que existían, en orden"""
+        updated = []
+        with self._write() as conn:
+            for exercise_id, fields in updates:
+                row = conn.execute(
+                    'SELECT data FROM exercises WHERE doc = ? AND id = ?', (doc, exercise_id)
+                ).fetchone()
+                if not row:
+                    continue
+                
+                exercise = json.loads(row[0])
+                exercise.update(fields)
+                conn.execute(
+                    'UPDATE exercises SET data = ? WHERE doc = ? AND id = ?',
+                    (json.dumps(exercise, ensure_ascii=False), doc, exercise_id)
+                )
+                updated.append(exercise)
+            if updated:
+                self._bump_version(conn, doc)
+        return updated
+    
+    def delete(self, doc: str, exercise_id: str) -> Optional[int]:
+        """Elimina un ejercicio; devuelve cuántos quedan o None si no existía"""
+        with self._write() as conn:
+            deleted = conn.execute(
+                'DELETE FROM exercises WHERE doc = ? AND id = ?', (doc, exercise_id)
+            ).rowcount
+            if not deleted:
+                return None
+            
+            self._bump_version(conn, doc)
+            return conn.execute('SELECT COUNT(*) FROM exercises WHERE doc = ?', (doc,)).fetchone()[0]
+    
+    def drop(self, doc: str):
+        """Elimina el documento y todos sus ejercicios"""
+        with self._write() as conn:
+            conn.execute('DELETE FROM exercises WHERE doc = ?', (doc,))
+            conn.execute('DELETE FROM documents WHERE doc = ?', (doc,))
+    
+    def version(self, doc: str) -> int:
+        row = self._conn().execute('SELECT version FROM documents WHERE doc = ?', (doc,)).fetchone()
+        return row[0] if row else 0
+    
+    def sync_from_json(self, doc: str, json_path: Path):
+        """
+        Importa exercises.json si cambió desde la última importación
+        (p. ej. tras procesar un PDF desde la línea de comandos).
+        """
+        if not json_path.exists():
+            return
+        
+        mtime = json_path.stat().st_mtime_ns
+        row = self._conn().execute('SELECT source_mtime FROM documents WHERE doc = ?', (doc,)).fetchone()
+        if row and row[0] == mtime:
+            return
+        
+        with open(json_path, 'r', encoding='utf-8') as f:
+            exercises = json.load(f)
+        self.replace(doc, exercises, source_mtime=mtime)
+    
+    def export_json(self, doc: str, fileobj):
+        """Escribe los ejercicios del documento en el formato de exercises.json"""
+        json.dump(self.list(doc) or [], fileobj, ensure_ascii=False, indent=2)
+
+
+exercise_store = ExerciseStore(Config.STORE_PATH)
+
+
+_anthropic_clients = {}
+_anthropic_lock = threading.Lock()
+
+
+def _anthropic_client(api_key: str):
+    """
+    Cliente de Anthropic del proceso actual (uno por API Key). Es seguro entre hilos y
+    mantiene abiertas sus conexiones HTTP (keep-alive): las peticiones siguientes no
+    vuelven a crear el cliente ni a negociar TLS.
+    """
+    key = (os.getpid(), api_key)
+    with _anthropic_lock:
+        if key not in _anthropic_clients:
+            # Los reintentos los hace claude_scheduler (para respetar el presupuesto global)
+            _anthropic_clients[key] = anthropic.Anthropic(
+                api_key=api_key, timeout=Config.CLAUDE_TIMEOUT, max_retries=0
+            )
+        return _anthropic_clients[key]
+
+
+class ClaudeRequestError(RuntimeError):
+    """Llamada a Claude fallida sin posibilidad de reintento (o agotados los reintentos)"""
+
+
+def _estimate_input_tokens(content: List[Dict], pages: int) -> int:
+    """Tokens de entrada aproximados de un mensaje, para el presupuesto por minuto"""
+    tokens = 0
+    for block in content:
+        if block['type'] == 'document':
+            tokens += pages * 2500  # texto e imagen de cada página
+        elif block['type'] == 'image':
+            tokens += 1600
+        else:
+            tokens += len(block['text']) // 3
+    return tokens
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """Segundos indicados por el servidor en retry-after-ms / retry-after (None si no hay)"""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        value = headers.get('retry-after')
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+    except (TypeError, ValueError):
+        return None
+
+
+class ClaudeScheduler:
+    """
+    Reparte las llamadas a Claude de todo el proceso (todos los documentos, trabajos y
+    lotes): como máximo max_in_flight a la vez y, con tokens_per_minute, un presupuesto
+    de tokens de entrada que se rellena de forma continua. Cada llamada reserva su
+    estimación y al terminar se corrige con el usage real.
+    
+    Los errores transitorios (429, 529, 5xx, red, timeout) se reintentan con espera
+    exponencial con jitter o lo que indique retry-after; un 429 o 529 pausa también
+    las demás llamadas durante esa espera, en lugar de dejar que insistan.
+    """
+    
+    RETRY_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+    
+    def __init__(self, max_in_flight: int, tokens_per_minute: int, max_retries: int,
+                 backoff_base: float = 1.0, backoff_max: float = 60.0):
+        self.max_in_flight = max(1, max_in_flight)
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._queued = 0
+        self._tokens = float(tokens_per_minute)
+        self._refilled = time.monotonic()
+        self._paused_until = 0.0
+        self._totals = {'requests': 0, 'retries': 0, 'throttled': 0, 'failed': 0, 'wait_seconds': 0.0}
+    
+    def _refill(self, now: float):
+        if self.tokens_per_minute:
+            elapsed = now - self._refilled
+            self._tokens = min(self.tokens_per_minute, self._tokens + elapsed * self.tokens_per_minute / 60)
+        self._refilled = now
+    
+    def _acquire(self, cost: int) -> float:
+        """Espera turno (pausa, llamadas en curso y presupuesto); devuelve los segundos esperados"""
+        start = time.monotonic()
+        with self._cond:
+            self._queued += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    timeouts = []
+                    if self._paused_until > now:
+                        timeouts.append(self._paused_until - now)
+                    if self.tokens_per_minute:
+                        # Una llamada mayor que el presupuesto entero espera a tenerlo completo
+                        missing = min(cost, self.tokens_per_minute) - self._tokens
+                        if missing > 0:
+                            timeouts.append(missing * 60 / self.tokens_per_minute)
+                    if self._in_flight >= self.max_in_flight:
+                        self._cond.wait(min(timeouts) if timeouts else None)
+                    elif timeouts:
+                        self._cond.wait(min(timeouts))
+                    else:
+                        break
+                
+                self._in_flight += 1
+                if self.tokens_per_minute:
+                    self._tokens -= cost
+                waited = time.monotonic() - start
+                self._totals['requests'] += 1
+                self._totals['wait_seconds'] += waited
+            finally:
+                self._queued -= 1
+        
+        metrics.observe('extractor_claude_wait_seconds', waited)
+        return waited
+    
+    def _release(self, cost: int, input_tokens: Optional[int]):
+        with self._cond:
+            self._in_flight -= 1
+            if self.tokens_per_minute and input_tokens is not None:
+                self._tokens -= input_tokens - cost
+            self._cond.notify_all()
+    
+    @contextmanager
+    def slot(self, cost: int):
+        """
+        Turno para una llamada de cost tokens estimados. Devuelve un dict con 'waited'
+        (segundos en cola); si se guarda en él 'input_tokens', se corrige el presupuesto.
+        """
+        ticket = {'waited': self._acquire(cost), 'input_tokens': None}
+        try:
+            yield ticket
+        finally:
+            self._release(cost, ticket['input_tokens'])
+    
+    def retry_delay(self, error: Exception, attempt: int) -> Optional[float]:
+        """Segundos a esperar antes del reintento número attempt + 1 (None = no reintentar)"""
+        status = getattr(error, 'status_code', None)
+        transient = status in self.RETRY_STATUS or isinstance(error, anthropic.APIConnectionError)
+        if not transient or attempt >= self.max_retries:
+            with self._cond:
+                self._totals['failed'] += 1
+            return None
+        
+        delay = _retry_after(error)
+        if delay is None:
+            # Exponencial con jitter: entre la mitad y el total de base·2^intento
+            ceiling = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+            delay = random.uniform(ceiling / 2, ceiling)
+        delay = max(0.0, delay)
+        
+        with self._cond:
+            self._totals['retries'] += 1
+            if status in (429, 529):
+                self._totals['throttled'] += 1
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        metrics.inc('extractor_claude_retries_total', reason=str(status or 'connection'))
+        return delay
+    
+    def stats(self) -> Dict:
+        """Estado actual (cola, en curso, presupuesto) y totales desde el inicio"""
+        with self._cond:
+            now = time.monotonic()
+            self._refill(now)
+            return {
+                'queued': self._queued,
+                'in_flight': self._in_flight,
+                'max_in_flight': self.max_in_flight,
+                'tokens_per_minute': self.tokens_per_minute,
+                'tokens_available': round(self._tokens) if self.tokens_per_minute else None,
+                'paused_seconds': round(max(0.0, self._paused_until - now), 3),
+                **self._totals,
+                'wait_seconds': round(self._totals['wait_seconds'], 3)
+            }
+
+
+claude_scheduler = ClaudeScheduler(Config.CLAUDE_MAX_IN_FLIGHT, Config.CLAUDE_TOKENS_PER_MINUTE,
+                                   Config.CLAUDE_MAX_RETRIES, Config.CLAUDE_BACKOFF_BASE, Config.CLAUDE_BACKOFF_MAX)
+
+
 class VisualExtractor:
     """
     Extractor mejorado con soporte para múltiples figuras y organización por página
+    
+    Cada documento usa su propio extractor (stats y manifest son de ese documento);
+    crearlo es barato porque el cliente de Anthropic y los pools son del proceso.
     """
     
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, output_dir: str = "extracted_data"):
         self.api_key = api_key
-        self.client = anthropic.Anthropic(api_key=api_key)
-        self.output_dir = Path("extracted_data")
+        self.client = _anthropic_client(api_key)
+        self.output_dir = Path(output_dir)
         self.figures_dir = self.output_dir / "figures"
+        self.manifest = None  # huellas de página del último PDF (ver plan_incremental)
+        self.failed_pages = set()  # páginas cuyo fragmento no dio un resultado completo
+        
+        # Resumen de lo procesado por este extractor (tiempos por etapa, conteos, tokens)
+        self.stats = {'seconds': {}}
+        self._stats_lock = threading.Lock()
         
         # Crear directorios
-        self.output_dir.mkdir(exist_ok=True)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
         self.figures_dir.mkdir(exist_ok=True)
+        (self.figures_dir / "thumbs").mkdir(exist_ok=True)
         
         print("✅ Extractor inicializado")
         print(f"📁 Directorio de salida: {self.output_dir}\n")
     
-    def detect_red_boxes(self, img: np.ndarray) -> List[Tuple[int, int, int, int]]:
-        """Detecta recuadros rojos"""
-        hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
-        
-        lower_red1 = np.array([0, 70, 50])
-        upper_red1 = np.array([10, 255, 255])
-        lower_red2 = np.array([170, 70, 50])
-        upper_red2 = np.array([180, 255, 255])
-        
-        mask1 = cv2.inRange(hsv, lower_red1, upper_red1)
-        mask2 = cv2.inRange(hsv, lower_red2, upper_red2)
-        red_mask = cv2.bitwise_or(mask1, mask2)
+    def account(self, stage: Optional[str] = None, seconds: float = 0.0, **counts):
+        """
+        Suma a self.stats y a las métricas globales: segundos de una etapa
+        y/o contadores (pages, figures, claude_input_tokens, ...)
+        """
+        with self._stats_lock:
+            if stage:
+                self.stats['seconds'][stage] = round(self.stats['seconds'].get(stage, 0) + seconds, 4)
+            for name, value in counts.items():
+                self.stats[name] = self.stats.get(name, 0) + value
         
-        kernel = np.ones((3, 3), np.uint8)
-        dilated = cv2.dilate(red_mask, kernel, iterations=2)
+        if stage:
+            metrics.observe('extractor_stage_seconds', seconds, stage=stage)
+        for name, value in counts.items():
+            metrics.inc(f'extractor_{name}_total', value)
+    
+    def account_document(self, pdf_path: str, source: str):
+        """Registra un documento de entrada; source: 'full', 'incremental' o 'cache'"""
+        self.stats['source'] = source
+        metrics.inc('extractor_documents_total', source=source)
+        self.account(pdf_bytes=os.path.getsize(pdf_path))
+    
+    def _account_page(self, timings: Dict, figures: List[Dict]):
+        for stage in ('render', 'detect', 'encode'):
+            self.account(stage, timings.get(stage, 0.0))
+        self.account(pages=1, figures=len(figures), render_bytes=timings.get('render_bytes', 0),
+                     figure_bytes=timings.get('figure_bytes', 0),
+                     figure_duplicates=timings.get('figure_duplicates', 0),
+                     figure_reused=timings.get('figure_reused', 0))
+    
+    @staticmethod
+    def detect_red_boxes(img: np.ndarray, scale: float = 1.0, padding: int = 15) -> List[Tuple[int, int, int, int]]:
+        """
+        Detecta recuadros rojos
         
-        contours, _ = cv2.findContours(dilated, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        scale: resolución de img relativa a RENDER_ZOOM (p. ej. 1/3 para un escaneo a 1x);
+        ajusta el tamaño mínimo de las figuras. padding se expresa en píxeles de img.
+        """
+        contours, _ = cv2.findContours(_red_mask(img), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
         
         height, width = img.shape[:2]
-        min_area = (width * height) * 0.005
-        max_area = (width * height) * 0.40
-        
-        red_boxes = []
-        
-        for contour in contours:
-            x, y, w, h = cv2.boundingRect(contour)
-            area = w * h
-            aspect_ratio = w / h if h > 0 else 0
-            
-            if (min_area < area < max_area and
-                0.2 < aspect_ratio < 5.0 and
-                w > 50 and h > 50):
-                
-                padding = 15
-                x = max(0, x - padding)
-                y = max(0, y - padding)
-                w = min(width - x, w + 2 * padding)
-                h = min(height - y, h + 2 * padding)
-                
-                red_boxes.append((x, y, w, h))
-        
-        red_boxes.sort(key=lambda box: box[1])
-        return red_boxes
+        rects = [cv2.boundingRect(contour) for contour in contours]
+        return _filter_red_boxes(rects, width, height, scale, padding)
     
-    def extract_figures_with_nomenclature(self, pdf_path: str) -> List[Dict]:
+    def extract_figures_with_nomenclature(self, pdf_path: str, workers: Optional[int] = None,
+                                          mode: Optional[str] = None,
+                                          on_page: Optional[Callable[[int, int, List[Dict]], None]] = None,
+                                          pages: Optional[List[int]] = None,
+                                          known: Optional[List[Dict]] = None,
+                                          manifest: Optional[FigureManifest] = None) -> List[Dict]:
         """
         Extrae figuras con nomenclatura clara: IMG_PAG1_1, IMG_PAG1_2, etc.
+        
+        Devuelve la lista completa; para procesar página a página sin acumular
+        resultados usa iter_figures (los parámetros son los mismos).
+        on_page: se llama con (página, total de páginas, figuras) al terminar cada página, en orden.
+        """
+        all_figures = []
+        for page_number, total_pages, page_figures in self.iter_figures(pdf_path, workers, mode, pages,
+                                                                        known, manifest):
+            if on_page:
+                on_page(page_number, total_pages, page_figures)
+            all_figures.extend(page_figures)
+        return all_figures
+    
+    def iter_figures(self, pdf_path: str, workers: Optional[int] = None, mode: Optional[str] = None,
+                     pages: Optional[List[int]] = None, known: Optional[List[Dict]] = None,
+                     manifest: Optional[FigureManifest] = None,
+                     cancel: Optional[threading.Event] = None) -> Iterator[Tuple[int, int, List[Dict]]]:
+        """
+        Extrae las figuras página a página: produce (página, total de páginas, figuras)
+        en orden en cuanto cada página termina, sin guardar nada de las anteriores.
+        La memoria no depende del largo del documento: en cada momento solo hay una
+        página rasterizada (o, con workers > 1, unos pocos rangos de páginas en curso).
+        
+        Con workers > 1 las páginas se reparten en rangos entre varios procesos;
+        cada proceso abre su propio documento. El resultado es idéntico al modo secuencial.
+        
+        mode: 'full', 'two_pass' o 'vector' (ver Config.DETECTION_MODE).
+        pages: procesa solo estas páginas (numeradas desde 1); por defecto, todas.
+        known: figuras ya guardadas del documento (reproceso parcial); sus casi-duplicados
+               quedan como referencias (duplicate_of) en lugar de guardarse de nuevo.
+        manifest: las figuras de cada página se escriben en él antes de entregarla.
+        cancel: si se activa, se deja de procesar en la página siguiente.
         """
+        # Más procesos que núcleos solo suma costo de arranque y de envío de resultados
+        workers = min(workers or Config.RENDER_WORKERS, os.cpu_count() or 1)
+        mode = mode or Config.DETECTION_MODE
+        if mode not in _PAGE_DETECTORS:
+            raise ValueError(f"Modo de detección desconocido: {mode}")
+        if Config.FIGURE_FORMAT not in FIGURE_FORMATS:
+            raise ValueError(f"Formato de figura desconocido: {Config.FIGURE_FORMAT}")
+        
         print("📸 Extrayendo figuras con recuadros rojos...\n")
         
         doc = fitz.open(pdf_path)
-        all_figures = []
+        total_pages = len(doc)
+        page_numbers = pages or list(range(1, total_pages + 1))
+        total_figures = 0
+        # Solo cuenta el trabajo propio, no el tiempo que el consumidor tarda en pedir la siguiente página
+        elapsed = 0.0
+        start_time = time.perf_counter()
+        dedup = _FigureDeduper(known) if Config.DEDUP_FIGURES else None
         
-        # Contador por página
-        figures_per_page = {}
+        def finish_page(page_number: int, page_figures: List[Dict]):
+            nonlocal total_figures
+            _report_page(page_number, total_pages, page_figures)
+            if manifest:
+                manifest.write(page_figures)
+            total_figures += len(page_figures)
         
-        for page_num in range(len(doc)):
-            page_number = page_num + 1
-            print(f"📄 Página {page_number}/{len(doc)}")
-            
-            page = doc[page_num]
-            
-            # Convertir a imagen
-            mat = fitz.Matrix(3, 3)
-            pix = page.get_pixmap(matrix=mat)
-            img_data = pix.tobytes("png")
-            
-            nparr = np.frombuffer(img_data, np.uint8)
-            img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-            
-            # Detectar recuadros rojos
-            red_boxes = self.detect_red_boxes(img)
-            
-            if not red_boxes:
-                print(f"  ⚠️ Sin recuadros rojos\n")
-                continue
-            
-            # Inicializar contador de esta página
-            if page_number not in figures_per_page:
-                figures_per_page[page_number] = 0
-            
-            # Extraer cada figura
-            for x, y, w, h in red_boxes:
-                figures_per_page[page_number] += 1
-                fig_num_in_page = figures_per_page[page_number]
-                
-                # NOMENCLATURA CLARA
-                filename = f"IMG_PAG{page_number}_{fig_num_in_page}.png"
-                
-                # Recortar
-                cropped = img[y:y+h, x:x+w]
-                cropped_rgb = cv2.cvtColor(cropped, cv2.COLOR_BGR2RGB)
-                pil_image = Image.fromarray(cropped_rgb)
-                
-                # Guardar
-                filepath = self.figures_dir / filename
-                pil_image.save(filepath, quality=95)
-                
-                # Base64
-                buffered = io.BytesIO()
-                pil_image.save(buffered, format="PNG", quality=95)
-                img_b64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
-                
-                all_figures.append({
-                    'id': filename.replace('.png', ''),
-                    'filename': filename,
-                    'page': page_number,
-                    'position_in_page': fig_num_in_page,
-                    'path': str(filepath),
-                    'base64': f"data:image/png;base64,{img_b64}",
-                    'width': w,
-                    'height': h
-                })
-                
-                print(f"  ✅ {filename} extraída")
+        # Con menos de dos páginas por worker repartir no compensa el envío de resultados entre procesos
+        if workers > 1 and len(page_numbers) >= 2 * workers:
+            doc.close()
+            print(f"⚡ Modo paralelo: {workers} procesos\n")
             
-            print()
+            ranges = _split_page_ranges(total_pages, workers, pages)
+            executor = _render_pool(workers)
+            # Pocos rangos en curso a la vez: los terminados no se acumulan en memoria
+            pending = deque()
+            remap = {}
+            try:
+                while ranges or pending:
+                    if cancel and cancel.is_set():
+                        return
+                    while ranges and len(pending) < 2 * workers:
+                        first, last = ranges.pop(0)
+                        pending.append(executor.submit(_extract_page_range, os.path.abspath(pdf_path),
+                                                       str(self.figures_dir.resolve()), first, last, mode, known))
+                    # Recorrer en orden de envío mantiene el orden de páginas
+                    for page_number, page_figures, timings in pending.popleft().result():
+                        if dedup:
+                            # Antes de reportar la página, para no anunciar archivos que se borran
+                            self.account(figure_duplicates=_merge_duplicates(page_figures, dedup, remap,
+                                                                             self.figures_dir))
+                        self._account_page(timings, page_figures)
+                        finish_page(page_number, page_figures)
+                        elapsed += time.perf_counter() - start_time
+                        yield page_number, total_pages, page_figures
+                        start_time = time.perf_counter()
+            except BrokenProcessPool:
+                _reset_render_pool(executor)
+                raise
+            finally:
+                # Si el consumidor deja de iterar, los rangos aún no empezados no se procesan
+                for future in pending:
+                    future.cancel()
+        else:
+            raster = _RasterBuffer()
+            try:
+                for page_number in page_numbers:
+                    if cancel and cancel.is_set():
+                        return
+                    page_figures = _extract_page_figures(doc[page_number - 1], page_number, self.figures_dir,
+                                                         raster, mode, dedup)
+                    self._account_page(raster.timings, page_figures)
+                    finish_page(page_number, page_figures)
+                    elapsed += time.perf_counter() - start_time
+                    yield page_number, total_pages, page_figures
+                    start_time = time.perf_counter()
+            finally:
+                doc.close()
         
-        doc.close()
+        elapsed += time.perf_counter() - start_time
+        self.account('figures', elapsed)
         
         print(f"{'='*70}")
-        print(f"✅ Total: {len(all_figures)} figuras extraídas")
+        print(f"✅ Total: {total_figures} figuras extraídas")
         print(f"📁 Guardadas en: {self.figures_dir}/")
+        print(f"⏱️  {len(page_numbers)} páginas en {elapsed:.1f}s ({len(page_numbers) / max(elapsed, 1e-9):.1f} páginas/s)")
         print(f"{'='*70}\n")
+    
+    def _split_pdf(self, pdf_path: str, pages: Optional[List[int]] = None) -> List[Tuple[int, int, List[Dict]]]:
+        """
+        Divide el PDF en fragmentos de CHUNK_PAGES páginas: (primera página, última página, contenido)
         
-        return all_figures
+        El contenido son los bloques del mensaje a Claude: el PDF del fragmento o, en el
+        modo hybrid, el texto o la imagen de cada página (ver _hybrid_content).
+        pages: incluye solo estas páginas; cada tramo contiguo se fragmenta por separado.
+        """
+        hybrid = Config.EXTRACTION_MODE == 'hybrid'
+        doc = fitz.open(pdf_path)
+        total_pages = len(doc)
+        
+        try:
+            # Documento pequeño: se envía tal cual
+            if not hybrid and not pages and total_pages <= Config.CHUNK_PAGES:
+                with open(pdf_path, 'rb') as f:
+                    return [(1, total_pages, self._document_content(f.read()))]
+            
+            chunks = []
+            for first, last in (_page_runs(pages) if pages else [(1, total_pages)]):
+                for start in range(first - 1, last, Config.CHUNK_PAGES):
+                    end = min(start + Config.CHUNK_PAGES, last) - 1
+                    chunks.append((start + 1, end + 1, self._chunk_content(doc, start, end)))
+        finally:
+            doc.close()
+        
+        if hybrid:
+            image_pages = sum(block['type'] == 'image' for chunk in chunks for block in chunk[2])
+            text_pages = sum(last - first + 1 for first, last, _ in chunks) - image_pages
+            self.account(claude_text_pages=text_pages, claude_image_pages=image_pages)
+            print(f"📝 Modo hybrid: {text_pages} páginas como texto, {image_pages} como imagen\n")
+        return chunks
     
-    def extract_exercises(self, pdf_path: str) -> List[Dict]:
-        """Extrae ejercicios con Claude"""
-        print("🤖 Extrayendo ejercicios con Claude...\n")
+    def _chunk_content(self, doc, start: int, end: int) -> List[Dict]:
+        """Bloques del mensaje para las páginas [start, end] (base 0) según EXTRACTION_MODE"""
+        if Config.EXTRACTION_MODE == 'hybrid':
+            return self._hybrid_content(doc, start, end)
+        sub_doc = fitz.open()
+        sub_doc.insert_pdf(doc, from_page=start, to_page=end)
+        content = self._document_content(sub_doc.tobytes())
+        sub_doc.close()
+        return content
+    
+    @staticmethod
+    def _document_content(pdf_bytes: bytes) -> List[Dict]:
+        """Bloques del mensaje con el PDF completo del fragmento"""
+        return [
+            {
+                "type": "document",
+                "source": {
+                    "type": "base64",
+                    "media_type": "application/pdf",
+                    "data": base64.b64encode(pdf_bytes).decode('utf-8')
+                }
+            },
+            {
+                "type": "text",
+                "text": EXERCISES_PROMPT
+            }
+        ]
+    
+    @staticmethod
+    def _hybrid_content(doc, start: int, end: int) -> List[Dict]:
+        """
+        Bloques del modo hybrid para las páginas [start, end] (base 0): el texto local
+        de cada página o, si page_text_layer lo descarta, la página renderizada a
+        HYBRID_IMAGE_ZOOM en gris y JPEG (Claude solo lee el texto; cuesta la mitad que
+        un PNG en color). Los encabezados numeran las páginas desde 1, como en un PDF.
+        """
+        content = []
+        matrix = fitz.Matrix(Config.HYBRID_IMAGE_ZOOM, Config.HYBRID_IMAGE_ZOOM)
         
-        with open(pdf_path, 'rb') as f:
-            pdf_base64 = base64.b64encode(f.read()).decode('utf-8')
+        for local_page, page_num in enumerate(range(start, end + 1), 1):
+            page = doc[page_num]
+            text, reason = page_text_layer(page)
+            header = f"=== Página {local_page} ==="
+            
+            if reason is None:
+                content.append({"type": "text", "text": f"{header}\n{text}"})
+                continue
+            
+            pix = page.get_pixmap(matrix=matrix, colorspace=fitz.csGRAY, alpha=False)
+            content.append({"type": "text", "text": header})
+            content.append({
+                "type": "image",
+                "source": {
+                    "type": "base64",
+                    "media_type": "image/jpeg",
+                    "data": base64.b64encode(pix.tobytes('jpg', jpg_quality=85)).decode('utf-8')
+                }
+            })
         
+        content.append({"type": "text", "text": HYBRID_PROMPT})
+        return content
+    
+    @staticmethod
+    def _claude_request(content: List[Dict]) -> Dict:
+        """Parámetros de la llamada a Claude para un fragmento del PDF"""
+        return dict(
+            model=Config.CLAUDE_MODEL,
+            max_tokens=Config.CLAUDE_MAX_TOKENS,
+            messages=[{
+                "role": "user",
+                "content": content
+            }]
+        )
+    
+    @staticmethod
+    def _to_document_page(ex: Dict, first_page: int, last_page: int) -> Dict:
+        """Traduce el campo page de un fragmento a la numeración del PDF original"""
         try:
-            message = self.client.messages.create(
-                model="claude-sonnet-4-20250514",
-                max_tokens=8000,
-                messages=[{
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "document",
-                            "source": {
-                                "type": "base64",
-                                "media_type": "application/pdf",
-                                "data": pdf_base64
-                            }
-                        },
-                        {
-                            "type": "text",
-                            "text": """Extrae TODOS los ejercicios matemáticos del PDF.
-
-Formato JSON (campos requeridos):
-{
-  "text": "Enunciado completo del ejercicio",
-  "question": "Pregunta específica que se hace",
-  "alternatives": "A) opción 1\\nB) opción 2\\nC) opción 3\\nD) opción 4",
-  "answer": "Letra correcta (A, B, C, D o E)",
-  "resolution": "Explicación paso a paso (sin describir figuras, solo matemática)",
-  "page": número de página
+            local_page = int(ex.get('page'))
+        except (TypeError, ValueError):
+            local_page = 1
+        ex['page'] = first_page + min(max(local_page, 1), last_page - first_page + 1) - 1
+        return ex
+    
+    def _account_claude(self, seconds: float, message=None):
+        """Registra una llamada a Claude: duración y tokens de usage (sin message = fallida)"""
+        self.account('claude', seconds, claude_requests=1)
+        if message is None:
+            self.account(claude_errors=1)
+            return
+        
+        usage = getattr(message, 'usage', None)
+        self.account(claude_input_tokens=getattr(usage, 'input_tokens', 0) or 0,
+                      claude_output_tokens=getattr(usage, 'output_tokens', 0) or 0)
+    
+    def _call_claude(self, content: List[Dict], first_page: int, last_page: int,
+                     on_text: Optional[Callable[[str], None]] = None):
+        """
+        Una llamada a Claude a través de claude_scheduler, con sus reintentos; devuelve
+        el mensaje final o lanza ClaudeRequestError.
+        
+        on_text: usa streaming y recibe el texto a medida que llega. Una vez recibido
+        texto, un error ya no se reintenta (el consumidor ya pudo usar parte de la respuesta).
+        """
+        request = self._claude_request(content)
+        cost = _estimate_input_tokens(content, last_page - first_page + 1)
+        attempt = 0
+        
+        while True:
+            received = False
+            start = time.perf_counter()
+            try:
+                with claude_scheduler.slot(cost) as ticket:
+                    self.account('claude_wait', ticket['waited'])
+                    start = time.perf_counter()
+                    if on_text:
+                        with self.client.messages.stream(**request) as stream:
+                            for text in stream.text_stream:
+                                received = True
+                                on_text(text)
+                            message = stream.get_final_message()
+                    else:
+                        message = self.client.messages.create(**request)
+                    ticket['input_tokens'] = getattr(getattr(message, 'usage', None), 'input_tokens', None)
+                
+                self._account_claude(time.perf_counter() - start, message)
+                if message.stop_reason == "max_tokens":
+                    print(f"⚠️ Respuesta truncada en páginas {first_page}-{last_page} (reduce CHUNK_PAGES)")
+                return message
+            
+            except Exception as e:
+                self._account_claude(time.perf_counter() - start)
+                delay = None if received else claude_scheduler.retry_delay(e, attempt)
+                if delay is None:
+                    raise ClaudeRequestError(f"Claude falló en páginas {first_page}-{last_page}: {e}") from e
+                
+                attempt += 1
+                # Solo en self.stats: retry_delay ya cuenta el reintento en
+                # extractor_claude_retries_total, con el código de estado como etiqueta
+                with self._stats_lock:
+                    self.stats['claude_retries'] = self.stats.get('claude_retries', 0) + 1
+                print(f"⏳ Páginas {first_page}-{last_page}: {type(e).__name__}, reintento {attempt} en {delay:.1f}s")
+                time.sleep(delay)
+    
+    def _extract_chunk(self, content: List[Dict], first_page: int, last_page: int,
+                       pdf_path: Optional[str] = None) -> List[Dict]:
+        """
+        Extrae los ejercicios de un fragmento y traduce su campo page a la numeración del PDF original
+        
+        Si la respuesta se corta por max_tokens, un fragmento de varias páginas se divide
+        en dos mitades que se vuelven a pedir (con pdf_path); de una sola página se
+        conservan los ejercicios completos y la página queda en failed_pages.
+        """
+        message = self._call_claude(content, first_page, last_page)
+        
+        if message.stop_reason == "max_tokens" and pdf_path and last_page > first_page:
+            middle = (first_page + last_page) // 2
+            print(f"✂️  Dividiendo páginas {first_page}-{last_page} en {first_page}-{middle} y {middle + 1}-{last_page}")
+            doc = fitz.open(pdf_path)
+            try:
+                halves = [(first_page, middle, self._chunk_content(doc, first_page - 1, middle - 1)),
+                          (middle + 1, last_page, self._chunk_content(doc, middle, last_page - 1))]
+            finally:
+                doc.close()
+            return [ex for first, last, half in halves for ex in self._extract_chunk(half, first, last, pdf_path)]
+        
+        response_text = "".join(block.text for block in message.content if block.type == "text")
+        
+        # El parser conserva los objetos completos aunque el array quede cortado
+        parser = _IncrementalJSONArrayParser()
+        exercises = parser.feed(response_text)
+        if not parser.complete:
+            print(f"❌ Respuesta incompleta en páginas {first_page}-{last_page}: "
+                  f"{len(exercises)} ejercicios conservados, se reprocesarán en la próxima subida\n")
+            self.failed_pages.update(range(first_page, last_page + 1))
+        
+        return [self._to_document_page(ex, first_page, last_page) for ex in exercises if isinstance(ex, dict)]
+    
+    def extract_exercises(self, pdf_path: str, pages: Optional[List[int]] = None,
+                          first_id: int = 1) -> List[Dict]:
+        """
+        Extrae ejercicios con Claude
+        
+        El PDF se divide en fragmentos de páginas que se procesan en paralelo
+        (CLAUDE_CONCURRENCY a la vez); los resultados se unen en orden de página.
+        pages limita la extracción a esas páginas; los ids se numeran desde first_id.
+        Si un fragmento falla tras los reintentos se lanza ClaudeRequestError, en lugar
+        de devolver el documento sin sus ejercicios.
+        """
+        print("🤖 Extrayendo ejercicios con Claude...\n")
+        start = time.perf_counter()
+        
+        chunks = self._split_pdf(pdf_path, pages)
+        if len(chunks) > 1:
+            print(f"📦 {len(chunks)} fragmentos de hasta {Config.CHUNK_PAGES} páginas\n")
+        
+        with ThreadPoolExecutor(max_workers=max(1, min(Config.CLAUDE_CONCURRENCY, len(chunks)))) as executor:
+            # map conserva el orden de los fragmentos
+            results = list(executor.map(lambda chunk: self._extract_chunk(chunk[2], chunk[0], chunk[1], pdf_path),
+                                        chunks))
+        
+        exercises = [ex for chunk_exercises in results for ex in chunk_exercises]
+        valid = [ex for ex in exercises if ex.get('question')]
+        
+        # Agregar ID único y campos para múltiples figuras
+        for idx, ex in enumerate(valid, first_id):
+            ex['id'] = f"EX_{idx}"
+            ex['text_figures'] = []  # Array de IDs de figuras para text
+            ex['resolution_figures'] = []  # Array de IDs de figuras para resolution
+        
+        self.account('exercises', time.perf_counter() - start, exercises=len(valid))
+        print(f"✅ {len(valid)} ejercicios extraídos\n")
+        return valid
+    
+    def _stream_chunk(self, content: List[Dict], first_page: int, last_page: int,
+                      emit: Callable[[Dict], None], pdf_path: Optional[str] = None,
+                      emitted: Optional[Dict[int, int]] = None):
+        """
+        Como _extract_chunk, pero entrega a emit cada ejercicio en cuanto Claude cierra su objeto JSON
+        
+        Si la respuesta se corta por max_tokens, las páginas desde la del último ejercicio
+        recibido se vuelven a pedir en dos mitades (con pdf_path). Los ejercicios ya
+        entregados no se repiten: emitted cuenta cuántos se entregaron por página.
+        """
+        parser = _IncrementalJSONArrayParser()
+        emitted = {} if emitted is None else emitted
+        received = {}
+        resume = first_page
+        
+        def on_text(text: str):
+            nonlocal resume
+            for ex in parser.feed(text):
+                ex = self._to_document_page(ex, first_page, last_page)
+                page = ex['page']
+                resume = max(resume, page)
+                received[page] = received.get(page, 0) + 1
+                # Ya entregado por una respuesta anterior que se cortó
+                if received[page] <= emitted.get(page, 0):
+                    continue
+                emitted[page] = received[page]
+                emit(ex)
+        
+        message = self._call_claude(content, first_page, last_page, on_text)
+        
+        if message.stop_reason == "max_tokens" and pdf_path and last_page > first_page:
+            if resume < last_page:
+                middle = (resume + last_page) // 2
+                ranges = [(resume, middle), (middle + 1, last_page)]
+            else:
+                ranges = [(last_page, last_page)]
+            print(f"✂️  Páginas {first_page}-{last_page} truncadas: se vuelven a pedir "
+                  + ", ".join(f"{first}-{last}" for first, last in ranges))
+            doc = fitz.open(pdf_path)
+            try:
+                halves = [(first, last, self._chunk_content(doc, first - 1, last - 1)) for first, last in ranges]
+            finally:
+                doc.close()
+            for first, last, half in halves:
+                self._stream_chunk(half, first, last, emit, pdf_path, emitted)
+            return
+        
+        if not parser.complete:
+            print(f"⚠️ Respuesta incompleta en páginas {first_page}-{last_page}: se reprocesarán en la próxima subida")
+            self.failed_pages.update(range(first_page, last_page + 1))
+    
+    def iter_exercises(self, pdf_path: str, cancel: Optional[threading.Event] = None) -> Iterator[Dict]:
+        """
+        Versión en streaming de extract_exercises: produce cada ejercicio apenas se recibe.
+        
+        Los fragmentos se procesan en paralelo, pero los ejercicios se entregan en orden
+        de página: los de un fragmento esperan a que terminen los anteriores.
+        cancel: si se activa (p. ej. el cliente se desconectó), los fragmentos que aún
+        no empezaron ya no se envían a Claude; lo mismo si se deja de iterar.
+        """
+        print("🤖 Extrayendo ejercicios con Claude (streaming)...\n")
+        start = time.perf_counter()
+        
+        chunks = self._split_pdf(pdf_path)
+        events = queue.Queue()
+        closed = threading.Event()
+        
+        def run(idx: int, chunk: Tuple[int, int, List[Dict]]):
+            try:
+                if closed.is_set() or (cancel and cancel.is_set()):
+                    self.failed_pages.update(range(chunk[0], chunk[1] + 1))
+                    return
+                self._stream_chunk(chunk[2], chunk[0], chunk[1], lambda ex: events.put((idx, ex)), pdf_path)
+            except Exception as e:
+                events.put((idx, e))
+            finally:
+                events.put((idx, None))
+        
+        executor = ThreadPoolExecutor(max_workers=max(1, min(Config.CLAUDE_CONCURRENCY, len(chunks))))
+        for idx, chunk in enumerate(chunks):
+            executor.submit(run, idx, chunk)
+        
+        pending = {idx: [] for idx in range(len(chunks))}
+        finished = set()
+        current = 0
+        count = 0
+        
+        try:
+            while current < len(chunks):
+                idx, ex = events.get()
+                if isinstance(ex, Exception):
+                    raise ex
+                if ex is None:
+                    finished.add(idx)
+                else:
+                    pending[idx].append(ex)
+                
+                # Entregar todo lo que ya está en orden
+                while current < len(chunks):
+                    for ready in pending[current]:
+                        if ready.get('question'):
+                            count += 1
+                            ready['id'] = f"EX_{count}"
+                            ready['text_figures'] = []
+                            ready['resolution_figures'] = []
+                            yield ready
+                    pending[current] = []
+                    
+                    if current not in finished:
+                        break
+                    current += 1
+        finally:
+            closed.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+        
+        self.account('exercises', time.perf_counter() - start, exercises=count)
+        print(f"✅ {count} ejercicios extraídos\n")
+    
+    def cache_params(self) -> Dict:
+        """Parámetros que forman parte de la clave de caché"""
+        return {
+            'model': Config.CLAUDE_MODEL,
+            'prompt_version': PROMPT_VERSION,
+            'detection_mode': Config.DETECTION_MODE,
+            'render_zoom': Config.RENDER_ZOOM,
+            'scan_zoom': Config.SCAN_ZOOM,
+            'chunk_pages': Config.CHUNK_PAGES,
+            'extraction_mode': Config.EXTRACTION_MODE,
+            'hybrid': [Config.HYBRID_MIN_CHARS, Config.HYBRID_MATH_RATIO, Config.HYBRID_IMAGE_ZOOM]
+                      if Config.EXTRACTION_MODE == 'hybrid' else None,
+            'thumbnail_height': Config.THUMBNAIL_HEIGHT,
+            'figure_format': Config.FIGURE_FORMAT,
+            'png_compress_level': Config.PNG_COMPRESS_LEVEL,
+            'webp_quality': Config.WEBP_QUALITY,
+            'dedup_distance': Config.DEDUP_DISTANCE if Config.DEDUP_FIGURES else None,
+            'figure_index': bool(Config.FIGURE_INDEX_DIR)
+        }
+    
+    def plan_incremental(self, pdf_path: str, doc: Optional[str] = None) -> Optional[Dict]:
+        """
+        Compara las huellas de página del PDF con las del último resultado guardado
+        en output_dir (pages.json) para el documento doc del almacén.
+        
+        Deja en self.manifest el manifiesto del PDF nuevo. Devuelve None si no hay un
+        resultado previo compatible o si cambiaron todas las páginas; si no, las figuras
+        y ejercicios previos (con las ediciones manuales) y las páginas a reprocesar.
+        """
+        fingerprints = page_fingerprints(pdf_path)
+        self.manifest = {'params': self.cache_params(), 'pages': fingerprints}
+        self.failed_pages = set()
+        
+        manifest_path = self.output_dir / 'pages.json'
+        figures_path = self.output_dir / 'figures.json'
+        if doc is None or not manifest_path.exists() or not figures_path.exists():
+            return None
+        
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            previous = json.load(f)
+        if previous.get('params') != self.manifest['params']:
+            return None
+        
+        old_pages = previous.get('pages', [])
+        changed = [
+            page_number for page_number, fingerprint in enumerate(fingerprints, 1)
+            if page_number > len(old_pages) or old_pages[page_number - 1] != fingerprint
+        ]
+        if len(changed) == len(fingerprints):
+            return None
+        
+        exercise_store.sync_from_json(doc, self.output_dir / 'exercises.json')
+        exercises = exercise_store.list(doc)
+        if exercises is None:
+            return None
+        
+        with open(figures_path, 'r', encoding='utf-8') as f:
+            figures = json.load(f)
+        
+        return {
+            'changed': changed,
+            'total_pages': len(fingerprints),
+            'figures': figures,
+            'exercises': exercises
+        }
+    
+    def extract_incremental(self, pdf_path: str, plan: Dict,
+                            on_page: Optional[Callable[[int, int, List[Dict]], None]] = None,
+                            on_stage: Optional[Callable[[str, int], None]] = None) -> Tuple[List[Dict], List[Dict]]:
+        """
+        Reprocesa solo las páginas cambiadas de plan_incremental y las combina con el
+        resultado previo. Los ejercicios de páginas sin cambios se conservan tal cual
+        (incluidas las ediciones); los nuevos reciben ids posteriores al mayor existente.
+        on_stage: ver extract.
+        """
+        changed = plan['changed']
+        total_pages = plan['total_pages']
+        print(f"♻️  Reprocesando {len(changed)} de {total_pages} páginas: {changed}\n")
+        
+        def keep(item: Dict) -> bool:
+            return item.get('page') not in changed and (item.get('page') or 0) <= total_pages
+        
+        kept_figures = [fig for fig in plan['figures'] if keep(fig)]
+        
+        # Quitar las imágenes de las páginas que cambiaron o ya no existen; si una
+        # figura conservada era referencia a una de ellas, la imagen pasa a esa figura
+        for fig in plan['figures']:
+            if keep(fig) or fig.get('duplicate_of'):
+                continue
+            
+            references = [ref for ref in kept_figures if ref.get('duplicate_of') == fig['id']]
+            if references:
+                heir = references[0]
+                filename = heir['id'] + Path(fig['filename']).suffix
+                os.replace(self.figures_dir / fig['filename'], self.figures_dir / filename)
+                os.replace(self.figures_dir / fig['thumbnail'], self.figures_dir / 'thumbs' / filename)
+                heir.update(filename=filename, thumbnail=f"thumbs/{filename}", path=str(self.figures_dir / filename))
+                heir.pop('duplicate_of')
+                for ref in references[1:]:
+                    _as_duplicate(ref, heir)
+            else:
+                for name in _figure_files(fig):
+                    (self.figures_dir / name).unlink(missing_ok=True)
+        
+        if on_stage:
+            on_stage('figures', len(changed))
+        new_figures = self.extract_figures_with_nomenclature(pdf_path, on_page=on_page, pages=changed,
+                                                             known=kept_figures) if changed else []
+        figures = sorted(kept_figures + new_figures, key=lambda fig: (fig['page'], fig['position_in_page']))
+        
+        last_id = max((int(ex['id'][3:]) for ex in plan['exercises']
+                       if re.fullmatch(r'EX_\d+', str(ex.get('id')))), default=0)
+        if on_stage:
+            on_stage('exercises', len(changed))
+        new_exercises = self.extract_exercises(pdf_path, pages=changed, first_id=last_id + 1) if changed else []
+        
+        # Las asociaciones a figuras que desaparecieron ya no apuntan a nada
+        figure_ids = {fig['id'] for fig in figures}
+        kept = []
+        for ex in plan['exercises']:
+            if keep(ex):
+                for field in ('text_figures', 'resolution_figures'):
+                    ex[field] = [fig_id for fig_id in ex.get(field, []) if fig_id in figure_ids]
+                kept.append(ex)
+        
+        # sorted es estable: dentro de una página se mantiene el orden previo
+        exercises = sorted(kept + new_exercises, key=lambda ex: ex.get('page') or 0)
+        
+        print(f"♻️  {len(new_exercises)} ejercicios nuevos, {len(kept)} conservados\n")
+        return figures, exercises
+    
+    def page_manifest(self, exercises: List[Dict], failed: bool = False) -> Optional[Dict]:
+        """
+        Manifiesto de páginas para guardar junto al resultado (pages.json), o None si
+        el resultado no debe servir de base a un reproceso incremental: la extracción
+        falló o no dio ejercicios. Las páginas de fragmentos incompletos quedan sin
+        huella, así que la próxima subida las vuelve a procesar.
+        """
+        if failed or not exercises or not self.manifest:
+            return None
+        pages = [None if page_number in self.failed_pages else fingerprint
+                 for page_number, fingerprint in enumerate(self.manifest['pages'], 1)]
+        return dict(self.manifest, pages=pages)
+    
+    def extract(self, pdf_path: str,
+                on_page: Optional[Callable[[int, int, List[Dict]], None]] = None,
+                doc: Optional[str] = None,
+                manifest: Optional[FigureManifest] = None,
+                on_stage: Optional[Callable[[str, int], None]] = None) -> Tuple[List[Dict], List[Dict]]:
+        """
+        Extrae figuras y ejercicios, reutilizando la caché si el PDF ya fue procesado
+        
+        doc: documento del almacén con el resultado previo en output_dir; si se indica,
+        solo se reprocesan las páginas que cambiaron (ver plan_incremental).
+        manifest: recibe las figuras (página a página en una extracción completa) y
+        entonces no se devuelven: figuras es None y se leen del manifiesto (count, read).
+        Publicarlo con commit() queda a cargo de quien lo creó.
+        on_stage: se llama con (etapa, páginas a procesar) al empezar cada etapa:
+        'figures', 'exercises' o 'cached' (resultado de la caché, sin procesar páginas).
+        """
+        plan = self.plan_incremental(pdf_path, doc)
+        total_pages = len(self.manifest['pages'])
+        if plan:
+            self.account_document(pdf_path, 'incremental')
+            figures, exercises = self.extract_incremental(pdf_path, plan, on_page, on_stage)
+            if manifest:
+                manifest.write(figures)
+                return None, exercises
+            return figures, exercises
+        
+        cache_key = None
+        if Config.CACHE_ENABLED:
+            cache_key = ResultCache.make_key(pdf_path, self.cache_params())
+            cached = result_cache.get(cache_key, self.figures_dir)
+            if cached:
+                figures, exercises = cached
+                self.account_document(pdf_path, 'cache')
+                print(f"⚡ Resultado en caché: {len(exercises)} ejercicios, {len(figures)} figuras\n")
+                if on_stage:
+                    on_stage('cached', total_pages)
+                if manifest:
+                    manifest.write(figures)
+                    return None, exercises
+                return figures, exercises
+        
+        self.account_document(pdf_path, 'full')
+        
+        # 1. Extraer figuras (con manifest van página a página al archivo, sin acumularse)
+        if on_stage:
+            on_stage('figures', total_pages)
+        if manifest:
+            for page_number, page_total, page_figures in self.iter_figures(pdf_path, manifest=manifest):
+                if on_page:
+                    on_page(page_number, page_total, page_figures)
+            figures = None
+        else:
+            figures = self.extract_figures_with_nomenclature(pdf_path, on_page=on_page)
+        
+        # 2. Extraer ejercicios
+        if on_stage:
+            on_stage('exercises', total_pages)
+        exercises = self.extract_exercises(pdf_path)
+        
+        # Solo se guardan extracciones exitosas y completas
+        if cache_key and exercises and not self.failed_pages:
+            result_cache.put(cache_key, manifest.read() if manifest else figures, exercises)
+        
+        return figures, exercises
+    
+    def process_pdf(self, pdf_path: str, doc: Optional[str] = 'default'):
+        """
+        Proceso completo: extrae figuras y ejercicios; devuelve (número de figuras, ejercicios)
+        
+        doc: documento del almacén para el reproceso incremental (None = procesar todo)
+        """
+        pdf_name = Path(pdf_path).stem
+        
+        print(f"\n{'='*70}")
+        print(f"🚀 PROCESANDO: {pdf_name}")
+        print(f"{'='*70}\n")
+        
+        figures_json = self.output_dir / "figures.json"
+        exercises_json = self.output_dir / "exercises.json"
+        
+        # 1-2. Extraer figuras y ejercicios (solo las páginas cambiadas si ya se procesó antes);
+        # figures.json se escribe a medida que avanzan las páginas y se publica al final
+        with FigureManifest(figures_json) as figure_manifest:
+            _, exercises = self.extract(pdf_path, doc=doc, manifest=figure_manifest)
+            
+            if not exercises:
+                print("⚠️ No se extrajeron ejercicios")
+                return
+            
+            # 3. Guardar datos
+            start = time.perf_counter()
+            figure_manifest.commit()
+        
+        with open(exercises_json, 'w', encoding='utf-8') as f:
+            json.dump(exercises, f, ensure_ascii=False, indent=2)
+        
+        with open(self.output_dir / "pages.json", 'w', encoding='utf-8') as f:
+            json.dump(self.page_manifest(exercises), f)
+        self.account('persist', time.perf_counter() - start)
+        
+        print(f"{'='*70}")
+        print(f"🎉 DATOS PREPARADOS")
+        print(f"{'='*70}")
+        print(f"📊 Ejercicios: {len(exercises)}")
+        print(f"🖼️  Figuras: {figure_manifest.count}")
+        print(f"💾 Figuras JSON: {figures_json}")
+        print(f"💾 Ejercicios JSON: {exercises_json}")
+        print(f"📁 Imágenes: {self.figures_dir}/")
+        print(f"{'='*70}\n")
+        
+        return figure_manifest.count, exercises
+
+
+# ============================================================================
+# PROCESAMIENTO POR PÁGINA (compartido por el modo secuencial y los workers)
+# ============================================================================
+
+def page_fingerprints(pdf_path: str) -> List[str]:
+    """
+    Huella de cada página: su flujo de contenido, las imágenes y XObjects que usa
+    y sus anotaciones. Los recuadros rojos (dibujados o anotados) salen de estos
+    mismos datos, así que cualquier cambio en ellos cambia la huella. No renderiza nada.
+    """
+    doc = fitz.open(pdf_path)
+    digests = {}  # xref -> sha256 del flujo (las imágenes suelen repetirse entre páginas)
+    
+    def stream_digest(xref: int) -> bytes:
+        if xref not in digests:
+            digests[xref] = hashlib.sha256(doc.xref_stream_raw(xref) or b'').digest()
+        return digests[xref]
+    
+    try:
+        fingerprints = []
+        for page in doc:
+            h = hashlib.sha256()
+            h.update(repr((tuple(page.rect), page.rotation)).encode('utf-8'))
+            h.update(page.read_contents())
+            for xref in [img[0] for img in page.get_images(full=True)] + [xobj[0] for xobj in page.get_xobjects()]:
+                h.update(stream_digest(xref))
+            for annot in page.annots():
+                h.update(repr((annot.type[0], tuple(annot.rect), annot.colors, annot.border)).encode('utf-8'))
+            fingerprints.append(h.hexdigest()[:16])
+        return fingerprints
+    finally:
+        doc.close()
+
+
+# Fuentes de fórmulas (Computer Modern, Cambria Math, Symbol, MathType...) y símbolos
+# que la capa de texto aplana o pierde (exponentes, fracciones, raíces)
+_MATH_FONTS = re.compile(r'CM(MI|SY|EX|BSY)|MSBM|MSAM|Math|Symbol|MT ?Extra|STIX|Euclid', re.IGNORECASE)
+_MATH_CHARS = set('√∛∑∏∫∂∞≤≥≠≈≡±∓×÷·∈∉⊂⊆∪∩∀∃→⇒⇔∠⊥∥°′″^_π⁰¹²³⁴⁵⁶⁷⁸⁹ⁿ₀₁₂₃₄₅₆₇₈₉')
+
+
+def page_text_layer(page) -> Tuple[str, Optional[str]]:
+    """
+    Texto de la página en orden de lectura y, si no conviene enviarlo a Claude como
+    texto, el motivo: 'scanned' (casi sin texto), 'garbled' (fuentes sin mapa Unicode)
+    o 'formulas' (más de HYBRID_MATH_RATIO de caracteres en fuentes matemáticas,
+    superíndices o símbolos). Una página en blanco se considera texto.
+    """
+    blocks = []
+    total = math = garbled = 0
+    
+    for block in page.get_text('dict', sort=True)['blocks']:
+        if block['type'] != 0:
+            continue
+        lines = []
+        for line in block['lines']:
+            lines.append(''.join(span['text'] for span in line['spans']))
+            for span in line['spans']:
+                chars = [char for char in span['text'] if not char.isspace()]
+                total += len(chars)
+                if _MATH_FONTS.search(span['font']) or span['flags'] & fitz.TEXT_FONT_SUPERSCRIPT:
+                    math += len(chars)
+                else:
+                    math += sum(char in _MATH_CHARS for char in chars)
+                garbled += sum(char == '\ufffd' or '\ue000' <= char <= '\uf8ff' for char in chars)
+        blocks.append('\n'.join(lines))
+    text = '\n\n'.join(blocks).strip()
+    
+    if total < Config.HYBRID_MIN_CHARS:
+        blank = not total and not page.get_images() and not page.get_drawings()
+        return text, None if blank else 'scanned'
+    if garbled > 0.02 * total:
+        return text, 'garbled'
+    if math > Config.HYBRID_MATH_RATIO * total:
+        return text, 'formulas'
+    return text, None
+
+
+def _page_runs(pages: List[int]) -> List[Tuple[int, int]]:
+    """Agrupa números de página en tramos contiguos [primera, última]"""
+    runs = []
+    for page in sorted(set(pages)):
+        if runs and page == runs[-1][1] + 1:
+            runs[-1] = (runs[-1][0], page)
+        else:
+            runs.append((page, page))
+    return runs
+
+
+# Páginas máximas por rango en modo paralelo: acota lo que un worker devuelve de una vez
+_MAX_RANGE_PAGES = 16
+
+# Los workers se crean sin fork: el proceso padre tiene hilos (Flask, trabajos, Claude) y
+# un fork copiaría locks tomados por ellos. forkserver donde existe; spawn en el resto.
+# Los workers no heredan el directorio actual del momento: se les pasan rutas absolutas
+_MP_CONTEXT = multiprocessing.get_context(
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+)
+
+_render_executor = None
+_render_key = None
+_render_lock = threading.Lock()
+
+
+def _render_pool(workers: int) -> ProcessPoolExecutor:
+    """
+    Pool de procesos de render del proceso actual, creado la primera vez y reutilizado:
+    arrancar los workers (cada uno importa el módulo) cuesta más que un PDF corto.
+    Se vuelve a crear si cambia el número de workers o tras _reset_render_pool.
+    """
+    global _render_executor, _render_key
+    with _render_lock:
+        key = (os.getpid(), workers)
+        if _render_executor is None or _render_key != key:
+            if _render_executor is not None and _render_key[0] == os.getpid():
+                # Las llamadas en curso con el pool anterior terminan normalmente
+                _render_executor.shutdown(wait=False)
+            _render_executor = ProcessPoolExecutor(max_workers=workers, mp_context=_MP_CONTEXT)
+            _render_key = key
+        return _render_executor
+
+
+def _reset_render_pool(executor: ProcessPoolExecutor):
+    """Descarta el pool si sigue siendo executor (p. ej. un worker murió y quedó inservible)"""
+    global _render_executor, _render_key
+    with _render_lock:
+        if _render_executor is executor:
+            _render_executor = _render_key = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _split_page_ranges(total_pages: int, workers: int, pages: Optional[List[int]] = None) -> List[Tuple[int, int]]:
+    """
+    Divide las páginas (todas, o solo pages) en rangos [inicio, fin) contiguos, en base 0,
+    para repartir entre workers
+    """
+    # Varios rangos por worker para equilibrar páginas pesadas y ligeras
+    chunk = min(_MAX_RANGE_PAGES, max(1, -(-total_pages // (workers * 4))))
+    runs = [(first - 1, last) for first, last in _page_runs(pages)] if pages else [(0, total_pages)]
+    return [(start, min(start + chunk, end)) for first, end in runs for start in range(first, end, chunk)]
+
+
+class _RasterBuffer:
+    """
+    Convierte Pixmaps de fitz a arreglos NumPy sin pasar por PNG.
+    Reutiliza el arreglo BGR entre páginas del mismo tamaño.
+    
+    timings acumula los tiempos (segundos) y bytes de la página en curso;
+    _extract_page_figures lo reinicia en cada página.
+    """
+    
+    def __init__(self):
+        self._bgr = None
+        self.timings = {}
+    
+    def add(self, name: str, value: float):
+        self.timings[name] = self.timings.get(name, 0) + value
+    
+    def render(self, page, matrix, clip=None):
+        """page.get_pixmap (RGB, sin alfa) midiendo tiempo y bytes rasterizados"""
+        start = time.perf_counter()
+        pix = page.get_pixmap(matrix=matrix, clip=clip, alpha=False)
+        self.add('render', time.perf_counter() - start)
+        self.add('render_bytes', len(pix.samples_mv))
+        return pix
+    
+    @staticmethod
+    def rgb_view(pix) -> np.ndarray:
+        """Vista RGB (sin copia) sobre las muestras del Pixmap"""
+        return np.ndarray(
+            (pix.height, pix.width, pix.n), dtype=np.uint8,
+            buffer=pix.samples_mv, strides=(pix.stride, pix.n, 1)
+        )
+    
+    def to_bgr(self, rgb: np.ndarray) -> np.ndarray:
+        """Convierte a BGR escribiendo sobre el buffer reutilizable"""
+        if self._bgr is None or self._bgr.shape != rgb.shape:
+            self._bgr = np.empty(rgb.shape, dtype=np.uint8)
+        cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR, dst=self._bgr)
+        return self._bgr
+
+
+def _red_mask(img: np.ndarray) -> np.ndarray:
+    """Máscara binaria (dilatada) de los píxeles rojos de una imagen BGR"""
+    hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+    
+    lower_red1 = np.array([0, 70, 50])
+    upper_red1 = np.array([10, 255, 255])
+    lower_red2 = np.array([170, 70, 50])
+    upper_red2 = np.array([180, 255, 255])
+    
+    mask1 = cv2.inRange(hsv, lower_red1, upper_red1)
+    mask2 = cv2.inRange(hsv, lower_red2, upper_red2)
+    red_mask = cv2.bitwise_or(mask1, mask2)
+    
+    kernel = np.ones((3, 3), np.uint8)
+    return cv2.dilate(red_mask, kernel, iterations=2)
+
+
+def _filter_red_boxes(rects, width: int, height: int, scale: float = 1.0,
+                      padding: int = 15) -> List[Tuple[int, int, int, int]]:
+    """Filtra rectángulos candidatos por área, proporción y tamaño mínimo; añade padding"""
+    min_area = (width * height) * 0.005
+    max_area = (width * height) * 0.40
+    min_side = 50 * scale
+    
+    red_boxes = []
+    
+    for x, y, w, h in rects:
+        area = w * h
+        aspect_ratio = w / h if h > 0 else 0
+        
+        if (min_area < area < max_area and
+            0.2 < aspect_ratio < 5.0 and
+            w > min_side and h > min_side):
+            
+            x = max(0, x - padding)
+            y = max(0, y - padding)
+            w = min(width - x, w + 2 * padding)
+            h = min(height - y, h + 2 * padding)
+            
+            red_boxes.append((x, y, w, h))
+    
+    red_boxes.sort(key=lambda box: box[1])
+    return red_boxes
+
+
+def _detect_page_full(page, raster: _RasterBuffer) -> List[Tuple[np.ndarray, int, int]]:
+    """Modo 'full': rasteriza la página completa a RENDER_ZOOM. Devuelve (recorte RGB, ancho, alto)"""
+    # Convertir a imagen (RGB sin canal alfa, directo desde las muestras)
+    mat = fitz.Matrix(Config.RENDER_ZOOM, Config.RENDER_ZOOM)
+    pix = raster.render(page, mat)
+    rgb = _RasterBuffer.rgb_view(pix)
+    img = raster.to_bgr(rgb)
+    
+    # Detectar recuadros rojos
+    red_boxes = VisualExtractor.detect_red_boxes(img)
+    
+    # Copiar los recortes mientras el Pixmap sigue vivo
+    # (la vista RGB ya tiene el orden de canales que espera PIL)
+    return [(rgb[y:y+h, x:x+w].copy(), w, h) for x, y, w, h in red_boxes]
+
+
+def _detect_page_two_pass(page, raster: _RasterBuffer) -> List[Tuple[np.ndarray, int, int]]:
+    """
+    Modo 'two_pass': detecta en un escaneo a SCAN_ZOOM y renderiza a RENDER_ZOOM
+    solo un recorte (clip) alrededor de cada candidato. Dentro del recorte se vuelve a
+    medir el recuadro en alta resolución, así las coordenadas coinciden con el modo 'full'.
+    """
+    zoom = Config.RENDER_ZOOM
+    scale = Config.SCAN_ZOOM / zoom
+    padding = 15
+    
+    pix = raster.render(page, fitz.Matrix(Config.SCAN_ZOOM, Config.SCAN_ZOOM))
+    candidates = VisualExtractor.detect_red_boxes(raster.to_bgr(_RasterBuffer.rgb_view(pix)), scale=scale, padding=0)
+    if not candidates:
+        return []
+    
+    # Rejilla de píxeles de la página completa a RENDER_ZOOM
+    mat = fitz.Matrix(zoom, zoom)
+    page_irect = (page.rect * mat).irect
+    width, height = page_irect.width, page_irect.height
+    # Tolerancia: padding + error de redondeo y dilatación del escaneo
+    margin = padding + int(np.ceil(3 / scale))
+    
+    crops = []
+    for cx, cy, cw, ch in candidates:
+        x0 = max(0, int(cx / scale) - margin)
+        y0 = max(0, int(cy / scale) - margin)
+        x1 = min(width, int(np.ceil((cx + cw) / scale)) + margin)
+        y1 = min(height, int(np.ceil((cy + ch) / scale)) + margin)
+        
+        clip = fitz.Rect(x0, y0, x1, y1) * (1 / zoom)
+        clip.x0 += page.rect.x0; clip.x1 += page.rect.x0
+        clip.y0 += page.rect.y0; clip.y1 += page.rect.y0
+        clip_pix = raster.render(page, mat, clip)
+        clip_rgb = _RasterBuffer.rgb_view(clip_pix)
+        ox, oy = clip_pix.x - page_irect.x0, clip_pix.y - page_irect.y0
+        
+        # Medir el recuadro en alta resolución: el contorno que más se solapa con el candidato
+        contours, _ = cv2.findContours(
+            _red_mask(cv2.cvtColor(clip_rgb, cv2.COLOR_RGB2BGR)), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
+        )
+        expected = (cx / scale - ox, cy / scale - oy, (cx + cw) / scale - ox, (cy + ch) / scale - oy)
+        best, best_overlap = None, 0
+        for contour in contours:
+            bx, by, bw, bh = cv2.boundingRect(contour)
+            overlap = (max(0, min(bx + bw, expected[2]) - max(bx, expected[0])) *
+                       max(0, min(by + bh, expected[3]) - max(by, expected[1])))
+            if overlap > best_overlap:
+                best, best_overlap = (bx + ox, by + oy, bw, bh), overlap
+        
+        if best is None:
+            continue
+        
+        for x, y, w, h in _filter_red_boxes([best], width, height, padding=padding):
+            crop = clip_rgb[max(0, y - oy):y - oy + h, max(0, x - ox):x - ox + w].copy()
+            crops.append((y, crop, w, h))
+    
+    # Mismo orden que el modo 'full': por coordenada y en alta resolución
+    crops.sort(key=lambda item: item[0])
+    return [(crop, w, h) for _, crop, w, h in crops]
+
+
+def _is_red(color) -> bool:
+    """Mismo criterio que la máscara HSV de _red_mask, aplicado a un color RGB 0..1 del PDF"""
+    if not color or len(color) != 3:
+        return False
+    h, s, v = colorsys.rgb_to_hsv(*color)
+    hue = h * 180
+    return (hue <= 10 or hue >= 170) and s * 255 >= 70 and v * 255 >= 50
+
+
+def _vector_red_rects(page) -> List:
+    """Rectángulos rojos trazados en el contenido de la página o como anotaciones cuadradas"""
+    rects = []
+    
+    for path in page.get_drawings():
+        if 's' not in (path.get('type') or '') or not _is_red(path.get('color')):
+            continue
+        
+        # El trazo se extiende medio grosor hacia afuera del rectángulo geométrico
+        half = (path.get('width') or 1) / 2
+        boxes = [item[1] for item in path['items'] if item[0] == 're']
+        boxes += [item[1].rect for item in path['items'] if item[0] == 'qu']
+        if not boxes:
+            boxes = [path['rect']]
+        
+        rects.extend(fitz.Rect(box) + (-half, -half, half, half) for box in boxes)
+    
+    # Recuadros dibujados con la herramienta de formas del lector de PDF
+    for annot in page.annots(types=[fitz.PDF_ANNOT_SQUARE]) or []:
+        if _is_red(annot.colors.get('stroke')):
+            rects.append(fitz.Rect(annot.rect))
+    
+    return rects
+
+
+def _merge_touching(rects: List[List[int]]) -> List[List[int]]:
+    """Une rectángulos que se tocan o solapan, como hace findContours con RETR_EXTERNAL"""
+    merged = [list(r) for r in rects]
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(merged)):
+            for j in range(i + 1, len(merged)):
+                a, b = merged[i], merged[j]
+                if a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]:
+                    merged[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    del merged[j]
+                    changed = True
+                    break
+            if changed:
+                break
+    return merged
+
+
+def _detect_page_vector(page, raster: _RasterBuffer) -> List[Tuple[np.ndarray, int, int]]:
+    """
+    Modo 'vector': obtiene los recuadros de los comandos de dibujo del PDF, sin rasterizar
+    la página, y renderiza solo el recorte de cada figura. Si la página no tiene
+    rectángulos rojos vectoriales recurre a la detección con OpenCV.
+    """
+    vector_rects = _vector_red_rects(page)
+    if not vector_rects:
+        return _detect_page_full(page, raster)
+    
+    zoom = Config.RENDER_ZOOM
+    mat = fitz.Matrix(zoom, zoom)
+    page_irect = (page.rect * mat).irect
+    width, height = page_irect.width, page_irect.height
+    dilation = 2  # píxeles que añade la dilatación de _red_mask
+    
+    pixel_rects = []
+    for rect in vector_rects:
+        x0 = max(0, int(np.floor((rect.x0 - page.rect.x0) * zoom)) - dilation)
+        y0 = max(0, int(np.floor((rect.y0 - page.rect.y0) * zoom)) - dilation)
+        x1 = min(width, int(np.ceil((rect.x1 - page.rect.x0) * zoom)) + dilation)
+        y1 = min(height, int(np.ceil((rect.y1 - page.rect.y0) * zoom)) + dilation)
+        if x1 > x0 and y1 > y0:
+            pixel_rects.append((x0, y0, x1, y1))
+    
+    boxes = _filter_red_boxes(
+        [(x0, y0, x1 - x0, y1 - y0) for x0, y0, x1, y1 in _merge_touching(pixel_rects)],
+        width, height
+    )
+    
+    crops = []
+    for x, y, w, h in boxes:
+        clip = fitz.Rect(x, y, x + w, y + h) * (1 / zoom)
+        clip.x0 += page.rect.x0; clip.x1 += page.rect.x0
+        clip.y0 += page.rect.y0; clip.y1 += page.rect.y0
+        clip_pix = raster.render(page, mat, clip)
+        crops.append((_RasterBuffer.rgb_view(clip_pix)[:h, :w].copy(), w, h))
+    
+    return crops
+
+
+_PAGE_DETECTORS = {
+    'full': _detect_page_full,
+    'two_pass': _detect_page_two_pass,
+    'vector': _detect_page_vector,
+}
+
+
+# Extensión y tipo MIME de cada FIGURE_FORMAT
+FIGURE_FORMATS = {
+    'png': ('.png', 'image/png'),
+    'webp': ('.webp', 'image/webp'),
+    'webp_lossless': ('.webp', 'image/webp'),
 }
+_FIGURE_MIME = dict(FIGURE_FORMATS.values())
+
+_encoder = None
+_encoder_pid = None
+
+
+def _encoder_pool() -> Optional[ThreadPoolExecutor]:
+    """Pool de codificación del proceso actual (se crea de nuevo en cada worker de RENDER_WORKERS)"""
+    global _encoder, _encoder_pid
+    if Config.ENCODE_WORKERS <= 1:
+        return None
+    if _encoder is None or _encoder_pid != os.getpid():
+        _encoder = ThreadPoolExecutor(max_workers=Config.ENCODE_WORKERS, thread_name_prefix='encode')
+        _encoder_pid = os.getpid()
+    return _encoder
+
+
+def _encode_image(pil_image: Image.Image) -> bytes:
+    """Codifica una imagen una sola vez en FIGURE_FORMAT; los bytes sirven para el archivo y para base64"""
+    buffer = io.BytesIO()
+    if Config.FIGURE_FORMAT == 'png':
+        pil_image.save(buffer, format='PNG', compress_level=Config.PNG_COMPRESS_LEVEL)
+    elif Config.FIGURE_FORMAT == 'webp':
+        pil_image.save(buffer, format='WEBP', quality=Config.WEBP_QUALITY, method=4)
+    elif Config.FIGURE_FORMAT == 'webp_lossless':
+        pil_image.save(buffer, format='WEBP', lossless=True, quality=Config.WEBP_QUALITY, method=4)
+    else:
+        raise ValueError(f"Formato de figura desconocido: {Config.FIGURE_FORMAT}")
+    return buffer.getvalue()
+
+
+def _save_figure(crop: np.ndarray, filepath: Path, thumbnail_path: Path) -> int:
+    """Guarda la figura y su miniatura; devuelve los bytes escritos"""
+    pil_image = Image.fromarray(crop)
+    data = _encode_image(pil_image)
+    # unlink antes de escribir: el archivo anterior puede ser un enlace al índice compartido
+    filepath.unlink(missing_ok=True)
+    filepath.write_bytes(data)
+    
+    # Miniatura para las vistas previas de la interfaz
+    pil_image.thumbnail((Config.THUMBNAIL_HEIGHT * 5, Config.THUMBNAIL_HEIGHT))
+    thumbnail_data = _encode_image(pil_image)
+    thumbnail_path.unlink(missing_ok=True)
+    thumbnail_path.write_bytes(thumbnail_data)
+    
+    return len(data) + len(thumbnail_data)
+
+
+def _dhash(crop: np.ndarray, size: int = 16) -> str:
+    """dHash de size² bits: compara cada píxel con su vecino en la imagen gris reducida"""
+    gray = cv2.cvtColor(crop, cv2.COLOR_RGB2GRAY)
+    small = cv2.resize(gray, (size + 1, size), interpolation=cv2.INTER_AREA)
+    return np.packbits(small[:, 1:] > small[:, :-1]).tobytes().hex()
+
+
+def _similar_figures(hash_a: str, size_a: Tuple[int, int], hash_b: str, size_b: Tuple[int, int]) -> bool:
+    """Candidatas a duplicado: mismo tamaño (±5%) y a lo sumo DEDUP_DISTANCE bits distintos"""
+    for a, b in zip(size_a, size_b):
+        if abs(a - b) > 0.05 * max(a, b):
+            return False
+    return bin(int(hash_a, 16) ^ int(hash_b, 16)).count('1') <= Config.DEDUP_DISTANCE
+
+
+# Píxeles distintos tolerados entre dos figuras iguales. Un rótulo que cambia
+# ("Figura 1" / "Figura 4", "3 cm" / "5 cm") ya difiere en más de una decena.
+_DEDUP_MAX_PIXELS = 4
+
+
+def _figure_signature(gray: np.ndarray) -> np.ndarray:
+    """Imagen gris a media resolución y suavizada, para verificar candidatas píxel a píxel"""
+    height, width = gray.shape
+    small = cv2.resize(gray, (max(1, width // 2), max(1, height // 2)), interpolation=cv2.INTER_AREA)
+    return cv2.GaussianBlur(small, (3, 3), 0)
+
+
+def _load_signature(path) -> Optional[np.ndarray]:
+    """Firma de una figura ya guardada (None si no se puede leer)"""
+    gray = cv2.imread(str(path), cv2.IMREAD_GRAYSCALE)
+    return None if gray is None else _figure_signature(gray)
+
+
+def _same_figure(signature_a: Optional[np.ndarray], signature_b: Optional[np.ndarray]) -> bool:
+    """
+    Verificación final de un casi-duplicado
+    
+    El dHash solo mira la forma general y no distingue rótulos o números distintos
+    sobre el mismo dibujo; aquí se exige que casi ningún píxel cambie de verdad
+    (el suavizado absorbe el antialiasing y los artefactos de codificación).
+    """
+    if signature_a is None or signature_b is None:
+        return False
+    if signature_a.shape != signature_b.shape:
+        signature_b = cv2.resize(signature_b, signature_a.shape[::-1], interpolation=cv2.INTER_AREA)
+    return int(np.count_nonzero(cv2.absdiff(signature_a, signature_b) > 64)) <= _DEDUP_MAX_PIXELS
+
+
+# Firmas de figuras canónicas que _FigureDeduper mantiene en memoria (decenas de KB cada una)
+_SIGNATURE_CACHE = 256
+
+
+class _FigureDeduper:
+    """Figuras canónicas (con imagen propia) de un documento, para reconocer casi-duplicados"""
+    
+    def __init__(self, figures: Optional[List[Dict]] = None):
+        self.canonical = [fig for fig in figures or [] if fig.get('phash') and not fig.get('duplicate_of')]
+        # id → firma, solo las _SIGNATURE_CACHE usadas más recientemente; las demás se leen del archivo
+        self._signatures = OrderedDict()
+    
+    def _remember(self, fig_id: str, signature: Optional[np.ndarray]):
+        self._signatures[fig_id] = signature
+        self._signatures.move_to_end(fig_id)
+        while len(self._signatures) > _SIGNATURE_CACHE:
+            self._signatures.popitem(last=False)
+    
+    def _signature(self, fig: Dict) -> Optional[np.ndarray]:
+        if fig['id'] in self._signatures:
+            self._signatures.move_to_end(fig['id'])
+            return self._signatures[fig['id']]
+        signature = _load_signature(fig['path'])
+        self._remember(fig['id'], signature)
+        return signature
+    
+    def match(self, fig: Dict, signature: Optional[np.ndarray] = None) -> Optional[Dict]:
+        """Canónica igual a fig; sin signature, la de fig se lee de su archivo si hace falta"""
+        for canonical in self.canonical:
+            if not _similar_figures(canonical['phash'], (canonical['width'], canonical['height']),
+                                    fig['phash'], (fig['width'], fig['height'])):
+                continue
+            if signature is None:
+                signature = _load_signature(fig['path'])
+            if _same_figure(self._signature(canonical), signature):
+                return canonical
+        return None
+    
+    def add(self, fig: Dict, signature: Optional[np.ndarray] = None):
+        self.canonical.append(fig)
+        if signature is not None:
+            self._remember(fig['id'], signature)
+
+
+def _as_duplicate(fig: Dict, canonical: Dict):
+    """Convierte fig en una referencia: conserva su id y posición, pero usa la imagen de canonical"""
+    fig.update(filename=canonical['filename'], thumbnail=canonical['thumbnail'],
+               path=canonical['path'], duplicate_of=canonical['id'])
+
+
+def _link_file(src: Path, dst: Path):
+    """Enlace duro (copia si el sistema de archivos no lo permite), reemplazando dst"""
+    dst.unlink(missing_ok=True)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class FigureIndex:
+    """
+    Figuras compartidas entre documentos y ejecuciones (FIGURE_INDEX_DIR).
+    
+    Cada imagen se guarda una vez como <dhash>_<ancho>x<alto>_<sha1><ext> (y su
+    miniatura en thumbs/), en una subcarpeta por formato y parámetros de render y
+    codificación. Los documentos reciben enlaces duros a esos archivos, así que no se
+    vuelven a codificar ni ocupan espacio extra en disco. Las entradas se publican con
+    os.replace, de modo que varios procesos pueden compartir el índice.
+    """
+    
+    def __init__(self, root: str):
+        params = {
+            'render_zoom': Config.RENDER_ZOOM,
+            'thumbnail_height': Config.THUMBNAIL_HEIGHT,
+            'figure_format': Config.FIGURE_FORMAT,
+            'png_compress_level': Config.PNG_COMPRESS_LEVEL,
+            'webp_quality': Config.WEBP_QUALITY
+        }
+        digest = hashlib.sha256(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+        self.dir = Path(root) / digest
+        (self.dir / 'thumbs').mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._entries = None  # [(dhash, (ancho, alto), nombre)]
+        self._signatures = {}
+    
+    def _load(self) -> List:
+        if self._entries is None:
+            self._entries = []
+            for path in self.dir.iterdir():
+                match = re.fullmatch(r'([0-9a-f]+)_(\d+)x(\d+)_[0-9a-f]+', path.stem)
+                if path.is_file() and match:
+                    self._entries.append((match[1], (int(match[2]), int(match[3])), path.name))
+        return self._entries
+    
+    def find(self, phash: str, width: int, height: int, signature: np.ndarray) -> Optional[str]:
+        with self._lock:
+            for entry_hash, size, name in self._load():
+                if not _similar_figures(entry_hash, size, phash, (width, height)):
+                    continue
+                if name not in self._signatures:
+                    self._signatures[name] = _load_signature(self.dir / name)
+                if _same_figure(self._signatures[name], signature):
+                    return name
+        return None
+    
+    def link_into(self, name: str, filepath: Path, thumbnail_path: Path):
+        _link_file(self.dir / name, filepath)
+        _link_file(self.dir / 'thumbs' / name, thumbnail_path)
+    
+    def add(self, phash: str, width: int, height: int, filepath: Path, thumbnail_path: Path):
+        digest = hashlib.sha1(filepath.read_bytes()).hexdigest()[:12]
+        name = f"{phash}_{width}x{height}_{digest}{filepath.suffix}"
+        with self._lock:
+            if any(entry[2] == name for entry in self._load()):
+                return
+            if not (self.dir / name).exists():
+                # La miniatura primero: la entrada existe desde que aparece la imagen
+                self._publish(thumbnail_path, self.dir / 'thumbs' / name)
+                self._publish(filepath, self.dir / name)
+            self._entries.append((phash, (width, height), name))
+    
+    @staticmethod
+    def _publish(src: Path, dst: Path):
+        temp = dst.with_name(f".{dst.name}.{os.getpid()}.{threading.get_ident()}")
+        _link_file(src, temp)
+        os.replace(temp, dst)
+
+
+_figure_indexes = {}
+
+
+def _figure_index() -> Optional[FigureIndex]:
+    """Índice compartido del proceso actual (None si FIGURE_INDEX_DIR está vacío)"""
+    if not Config.FIGURE_INDEX_DIR:
+        return None
+    key = (os.getpid(), Config.FIGURE_INDEX_DIR)
+    if key not in _figure_indexes:
+        _figure_indexes[key] = FigureIndex(Config.FIGURE_INDEX_DIR)
+    return _figure_indexes[key]
+
+
+def _extract_page_figures(page, page_number: int, figures_dir: Path,
+                          raster: Optional[_RasterBuffer] = None, mode: str = 'full',
+                          dedup: Optional[_FigureDeduper] = None) -> List[Dict]:
+    """
+    Detecta los recuadros rojos de una página y guarda cada figura
+    
+    Las figuras de la página se codifican en paralelo (ENCODE_WORKERS); al volver,
+    todos los archivos ya están escritos. Deja en raster.timings los segundos de
+    render, detect y encode de la página y los bytes rasterizados y escritos.
+    
+    Con DEDUP_FIGURES, un casi-duplicado de una figura de dedup no se codifica: queda
+    como referencia (duplicate_of) a la imagen canónica. Con FIGURE_INDEX_DIR, las
+    figuras ya vistas en otros documentos se enlazan desde el índice compartido.
+    """
+    raster = raster or _RasterBuffer()
+    raster.timings = {}
+    
+    start = time.perf_counter()
+    crops = _PAGE_DETECTORS[mode](page, raster)
+    raster.add('detect', time.perf_counter() - start - raster.timings.get('render', 0))
+    start = time.perf_counter()
+    
+    extension = FIGURE_FORMATS[Config.FIGURE_FORMAT][0]
+    pool = _encoder_pool() if len(crops) > 1 else None
+    index = _figure_index()
+    figures = []
+    pending = []
+    
+    # Extraer cada figura
+    for fig_num_in_page, (crop, w, h) in enumerate(crops, 1):
+        # NOMENCLATURA CLARA
+        figure_id = f"IMG_PAG{page_number}_{fig_num_in_page}"
+        filename = figure_id + extension
+        filepath = figures_dir / filename
+        thumbnail = f"thumbs/{filename}"
+        
+        fig = {
+            'id': figure_id,
+            'filename': filename,
+            'thumbnail': thumbnail,
+            'page': page_number,
+            'position_in_page': fig_num_in_page,
+            'path': str(filepath),
+            'width': w,
+            'height': h
+        }
+        figures.append(fig)
+        
+        if Config.DEDUP_FIGURES or index:
+            fig['phash'] = _dhash(crop)
+            signature = _figure_signature(cv2.cvtColor(crop, cv2.COLOR_RGB2GRAY))
+            
+            canonical = dedup.match(fig, signature) if dedup else None
+            if canonical:
+                _as_duplicate(fig, canonical)
+                raster.add('figure_duplicates', 1)
+                continue
+            if dedup:
+                dedup.add(fig, signature)
+            
+            shared = index.find(fig['phash'], w, h, signature) if index else None
+            if shared:
+                index.link_into(shared, filepath, figures_dir / thumbnail)
+                raster.add('figure_reused', 1)
+                continue
+        
+        if pool:
+            pending.append((fig, pool.submit(_save_figure, crop, filepath, figures_dir / thumbnail)))
+        else:
+            pending.append((fig, None))
+            raster.add('figure_bytes', _save_figure(crop, filepath, figures_dir / thumbnail))
+    
+    for fig, future in pending:
+        if future:
+            raster.add('figure_bytes', future.result())
+        if index:
+            index.add(fig['phash'], fig['width'], fig['height'], Path(fig['path']), figures_dir / fig['thumbnail'])
+    
+    raster.add('encode', time.perf_counter() - start)
+    
+    # MuPDF guarda las imágenes decodificadas de cada página (hasta ~256 MB por proceso);
+    # en un libro escaneado no se vuelven a usar, así que se liberan página a página
+    fitz.TOOLS.store_shrink(100)
+    return figures
+
+
+def _extract_page_range(pdf_path: str, figures_dir: str, start: int, end: int, mode: str = 'full',
+                        known: Optional[List[Dict]] = None) -> List[Tuple[int, List[Dict], Dict]]:
+    """
+    Worker: abre su propia copia del PDF y procesa las páginas [start, end) → (página, figuras, tiempos)
+    
+    Los duplicados se buscan dentro del rango y entre known; el proceso principal
+    une después los de rangos distintos (_merge_duplicates).
+    """
+    doc = fitz.open(pdf_path)
+    raster = _RasterBuffer()
+    dedup = _FigureDeduper(known) if Config.DEDUP_FIGURES else None
+    try:
+        results = []
+        for page_num in range(start, end):
+            page_figures = _extract_page_figures(doc[page_num], page_num + 1, Path(figures_dir), raster, mode, dedup)
+            results.append((page_num + 1, page_figures, raster.timings))
+        return results
+    finally:
+        doc.close()
+
+
+def _merge_duplicates(figures: List[Dict], dedup: _FigureDeduper, remap: Dict[str, Dict],
+                      figures_dir: Path) -> int:
+    """
+    Une duplicados entre rangos de páginas procesados por workers distintos.
+    
+    Se llama en orden de página: una figura canónica de su rango que repite otra
+    anterior pasa a ser referencia y se borran sus archivos; remap redirige las
+    referencias que apuntaban a ella. Devuelve cuántas figuras se unieron.
+    """
+    merged = 0
+    for fig in figures:
+        if not fig.get('phash'):
+            continue
+        if fig.get('duplicate_of'):
+            if fig['duplicate_of'] in remap:
+                _as_duplicate(fig, remap[fig['duplicate_of']])
+            continue
+        
+        canonical = dedup.match(fig)
+        if canonical:
+            for name in _figure_files(fig):
+                (figures_dir / name).unlink(missing_ok=True)
+            remap[fig['id']] = canonical
+            _as_duplicate(fig, canonical)
+            merged += 1
+        else:
+            dedup.add(fig)
+    return merged
+
+
+def _report_page(page_number: int, total_pages: int, figures: List[Dict]):
+    """Imprime el resultado de una página en el mismo formato del modo secuencial"""
+    print(f"📄 Página {page_number}/{total_pages}")
+    
+    if not figures:
+        print(f"  ⚠️ Sin recuadros rojos\n")
+        return
+    
+    for fig in figures:
+        print(f"  ✅ {fig['filename']} extraída")
+    print()
+
+
+class _IncrementalJSONArrayParser:
+    """
+    Recibe el texto de un array JSON por partes y devuelve cada objeto de primer
+    nivel en cuanto se cierra. Ignora el texto previo al '[' (p. ej. ```json).
+    """
+    
+    def __init__(self):
+        self._started = False
+        self._done = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._buffer = []
+        self._invalid = 0
+    
+    @property
+    def complete(self) -> bool:
+        """Se recibió el array completo (hasta su ']') sin objetos inválidos"""
+        return self._done and not self._invalid
+    
+    def feed(self, text: str) -> List[Dict]:
+        objects = []
+        
+        for ch in text:
+            if self._done:
+                break
+            
+            if not self._started:
+                self._started = ch == '['
+                continue
+            
+            if self._depth == 0:
+                if ch == '{':
+                    self._depth = 1
+                    self._buffer = [ch]
+                elif ch == ']':
+                    self._done = True
+                continue
+            
+            self._buffer.append(ch)
+            
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in '{[':
+                self._depth += 1
+            elif ch in '}]':
+                self._depth -= 1
+                if self._depth == 0:
+                    try:
+                        objects.append(json.loads(''.join(self._buffer)))
+                    except json.JSONDecodeError:
+                        self._invalid += 1
+                        print("⚠️ Objeto JSON inválido descartado")
+        
+        return objects
+
+
+# ============================================================================
+# COLA DE TRABAJOS
+# ============================================================================
+
+_process_token = None
+_process_token_pid = None
+
+
+def _job_owner() -> Dict:
+    """
+    Identifica al proceso actual en job.json: pid más un token propio del proceso, que
+    distingue a este proceso de uno anterior que tuvo el mismo pid (p. ej. tras reiniciar)
+    """
+    global _process_token, _process_token_pid
+    if _process_token_pid != os.getpid():
+        _process_token = uuid.uuid4().hex
+        _process_token_pid = os.getpid()
+    return {'pid': _process_token_pid, 'token': _process_token}
+
+
+def _pid_alive(pid: int) -> bool:
+    """Indica si existe un proceso con ese pid"""
+    if sys.platform == 'win32':
+        # En Windows os.kill(pid, 0) terminaría el proceso
+        import ctypes
+        handle = ctypes.windll.kernel32.OpenProcess(0x1000, False, pid)  # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return False
+        ctypes.windll.kernel32.CloseHandle(handle)
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _owner_alive(owner: Optional[Dict]) -> bool:
+    """Indica si el proceso que escribió job.json sigue en marcha"""
+    if not owner or not owner.get('pid'):
+        return False
+    if owner['pid'] == os.getpid():
+        return owner.get('token') == _job_owner()['token']
+    return _pid_alive(owner['pid'])
+
+
+class JobManager:
+    """
+    Procesa extracciones en segundo plano con un pool acotado de hilos.
+    
+    Cada trabajo tiene su propio directorio (JOBS_DIR/<job_id>/) con el PDF,
+    las figuras y los JSON de resultado, así que varios usuarios pueden subir
+    documentos a la vez sin pisarse los archivos. El estado se guarda también en
+    JOBS_DIR/<job_id>/job.json, con el proceso que lo ejecuta: los trabajos se pueden
+    consultar desde otros procesos (p. ej. gunicorn -w) y tras reiniciar el servidor.
+    Los terminados se borran pasadas retention_hours.
+    """
+    
+    JOB_ID = re.compile(r'^[0-9a-f]{12}$')
+    
+    def __init__(self, workers: int, max_pending: int, jobs_dir: str, retention_hours: float = 0):
+        self.jobs_dir = Path(jobs_dir)
+        self.max_pending = max_pending
+        self.retention = retention_hours * 3600
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self._jobs = {}
+        self._lock = threading.Lock()
+    
+    def workspace(self, job_id: str) -> Optional[Path]:
+        """Directorio del trabajo si existe en disco (None para ids inválidos o desconocidos)"""
+        if not self.JOB_ID.match(job_id):
+            return None
+        workspace = self.jobs_dir / job_id
+        return workspace if workspace.is_dir() else None
+    
+    def submit(self, pdf_path: str, api_key: str) -> str:
+        """Encola un PDF (se mueve al workspace del trabajo) y devuelve el id del trabajo"""
+        self.cleanup()
+        with self._lock:
+            pending = sum(1 for job in self._jobs.values() if job['status'] in ('queued', 'running'))
+            if pending >= self.max_pending:
+                raise RuntimeError('Cola de trabajos llena, intenta más tarde')
+            
+            job_id = uuid.uuid4().hex[:12]
+            workspace = self.jobs_dir / job_id
+            workspace.mkdir(parents=True)
+            shutil.move(pdf_path, workspace / 'input.pdf')
+            
+            self._jobs[job_id] = {
+                'id': job_id,
+                'status': 'queued',
+                'created_at': datetime.now().isoformat(timespec='seconds'),
+                'started_at': None,
+                'finished_at': None,
+                'progress': {'pages_done': 0, 'total_pages': None, 'stage': 'queued'},
+                'exercises': 0,
+                'figures': 0,
+                'stats': None,
+                'error': None
+            }
+            self._persist(job_id)
+        
+        self._executor.submit(self._run, job_id, api_key)
+        return job_id
+    
+    def get(self, job_id: str) -> Optional[Dict]:
+        """Copia del estado del trabajo (None si no existe)"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job:
+                return json.loads(json.dumps(job))
+        
+        workspace = self.workspace(job_id)
+        return self._load(job_id, workspace) if workspace else None
+    
+    @staticmethod
+    def _read(workspace: Path) -> Optional[Dict]:
+        try:
+            with open(workspace / 'job.json', 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+    
+    def _load(self, job_id: str, workspace: Path) -> Dict:
+        """
+        Estado de un trabajo de otro proceso o de una ejecución anterior del servidor,
+        leído de su workspace. job.json no se modifica: un trabajo en curso solo se
+        informa como fallido si el proceso que lo ejecutaba ya no existe.
+        """
+        job = self._read(workspace)
+        if job is None:
+            job = {'id': job_id, 'status': 'done' if (workspace / 'exercises.json').exists() else 'error',
+                   'progress': {'stage': 'done'}, 'error': None}
+        
+        owner = job.pop('owner', None)
+        if job['status'] in ('queued', 'running') and not _owner_alive(owner):
+            # El servidor se detuvo con el trabajo a medias
+            job.update(status='error', error='El servidor se reinició antes de terminar el trabajo',
+                       progress={**job.get('progress', {}), 'stage': 'error'})
+        if job['status'] == 'error' and not job.get('error'):
+            job['error'] = 'El trabajo no terminó'
+        return job
+    
+    def _persist(self, job_id: str):
+        """Escribe job.json con el proceso dueño del trabajo (se llama con _lock tomado)"""
+        path = self.jobs_dir / job_id / 'job.json'
+        tmp = path.with_suffix('.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(dict(self._jobs[job_id], owner=_job_owner()), f, ensure_ascii=False)
+        os.replace(tmp, path)
+    
+    def cleanup(self) -> int:
+        """
+        Borra los trabajos terminados hace más de retention_hours: su workspace, su
+        entrada en memoria y sus ejercicios en exercise_store. Devuelve cuántos borró.
+        """
+        if not self.retention or not self.jobs_dir.is_dir():
+            return 0
+        
+        cutoff = time.time() - self.retention
+        removed = 0
+        for workspace in self.jobs_dir.iterdir():
+            job_id = workspace.name
+            if not self.JOB_ID.match(job_id) or not workspace.is_dir():
+                continue
+            with self._lock:
+                job = self._jobs.get(job_id) or self._read(workspace) or {}
+                # En curso aquí o en otro proceso vivo
+                if job.get('status') in ('queued', 'running') and (job_id in self._jobs
+                                                                   or _owner_alive(job.get('owner'))):
+                    continue
+                marker = workspace / 'job.json'
+                try:
+                    modified = (marker if marker.exists() else workspace).stat().st_mtime
+                except OSError:
+                    continue
+                if modified > cutoff:
+                    continue
+                self._jobs.pop(job_id, None)
+            
+            shutil.rmtree(workspace, ignore_errors=True)
+            exercise_store.drop(job_id)
+            read_cache.drop(('exercises', job_id))
+            removed += 1
+        
+        if removed:
+            print(f"🧹 {removed} trabajo(s) antiguos eliminados")
+        return removed
+    
+    def counts(self) -> Dict[str, int]:
+        """Número de trabajos por estado"""
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job['status']] = counts.get(job['status'], 0) + 1
+            return counts
+    
+    def _update(self, job_id: str, **fields):
+        with self._lock:
+            job = self._jobs[job_id]
+            progress = fields.pop('progress', None)
+            if progress:
+                job['progress'].update(progress)
+            job.update(fields)
+            # También el progreso: otros procesos leen el estado de job.json
+            self._persist(job_id)
+    
+    def _run(self, job_id: str, api_key: str):
+        workspace = self.jobs_dir / job_id
+        pdf_path = workspace / 'input.pdf'
+        self._update(job_id, status='running', started_at=datetime.now().isoformat(timespec='seconds'),
+                     progress={'stage': 'figures'})
+        
+        # pages_done cuenta las páginas procesadas de las planificadas (en un reproceso
+        # incremental, solo las que cambiaron), no el número de la última página
+        pages_done = 0
+        
+        def on_stage(stage: str, total_pages: int):
+            progress = {'stage': stage, 'total_pages': total_pages}
+            if stage == 'cached':
+                progress['pages_done'] = total_pages
+            self._update(job_id, progress=progress)
+        
+        def on_page(page_number: int, total_pages: int, figures: List[Dict]):
+            nonlocal pages_done
+            pages_done += 1
+            self._update(job_id, progress={'pages_done': pages_done})
+        
+        try:
+            extractor = VisualExtractor(api_key=api_key, output_dir=str(workspace))
+            with FigureManifest(workspace / 'figures.json') as figure_manifest:
+                _, exercises = extractor.extract(str(pdf_path), on_page=on_page, manifest=figure_manifest,
+                                                 on_stage=on_stage)
+                extractor.account('persist', _save_results(None, exercises, str(workspace), doc=job_id,
+                                                           manifest=extractor.page_manifest(exercises),
+                                                           figure_manifest=figure_manifest))
+            
+            self._update(job_id, status='done', exercises=len(exercises), figures=figure_manifest.count,
+                         stats=extractor.stats,
+                         finished_at=datetime.now().isoformat(timespec='seconds'), progress={'stage': 'done'})
+        except Exception as e:
+            print(f"❌ Error en trabajo {job_id}: {e}")
+            import traceback
+            traceback.print_exc()
+            self._update(job_id, status='error', error=str(e),
+                         finished_at=datetime.now().isoformat(timespec='seconds'), progress={'stage': 'error'})
+        finally:
+            if pdf_path.exists():
+                pdf_path.unlink()
+
+
+job_manager = JobManager(Config.JOB_WORKERS, Config.JOB_QUEUE_MAX, Config.JOBS_DIR, Config.JOB_RETENTION_HOURS)
+
+
+# ============================================================================
+# SERVIDOR FLASK MEJORADO
+# ============================================================================
+
+app = Flask(__name__)
+app.config['MAX_CONTENT_LENGTH'] = Config.MAX_UPLOAD_MB * 1024 * 1024
+CORS(app)
+
+
+@app.before_request
+def _start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def _record_request_metrics(response):
+    """Latencia, código de estado y bytes por ruta (la regla de Flask, no la URL concreta)"""
+    route = request.url_rule.rule if request.url_rule else 'sin_ruta'
+    if 'request_start' in g:
+        metrics.observe('http_request_duration_seconds', time.perf_counter() - g.request_start,
+                        method=request.method, route=route)
+    metrics.inc('http_requests_total', method=request.method, route=route, status=response.status_code)
+    if request.content_length:
+        metrics.inc('http_request_bytes_total', request.content_length, route=route)
+    if response.content_length and not response.is_streamed:
+        metrics.inc('http_response_bytes_total', response.content_length, route=route)
+    return response
+
+
+metrics.gauge('extractor_jobs', 'Trabajos de /api/jobs por estado',
+              lambda: {(('status', status),): count for status, count in job_manager.counts().items()})
+metrics.gauge('extractor_claude_scheduler', 'Llamadas a Claude en cola y en curso',
+              lambda: {(('state', state),): claude_scheduler.stats()[state] for state in ('queued', 'in_flight')})
+metrics.gauge('extractor_cache_lookups', 'Consultas a la caché de resultados',
+              lambda: {(('result', name),): result_cache.stats()[name] for name in ('hits', 'misses')})
 
-IMPORTANTE: 
-- El campo "page" es interno para organización, se usará pero NO se exportará al JSON final
-- NO incluyas campos adicionales como "numero" o "id"
-- Responde SOLO con array JSON: []"""
-                        }
-                    ]
-                }]
-            )
-            
-            response_text = ""
-            for block in message.content:
-                if block.type == "text":
-                    response_text += block.text
-            
-            json_match = re.search(r'\[.*\]', response_text, re.DOTALL)
-            if json_match:
-                json_str = json_match.group()
-                json_str = json_str.replace('```json', '').replace('```', '').strip()
-                exercises = json.loads(json_str)
-                
-                valid = [ex for ex in exercises if ex.get('question')]
-                
-                # Agregar ID único y campos para múltiples figuras
-                for idx, ex in enumerate(valid, 1):
-                    ex['id'] = f"EX_{idx}"
-                    ex['text_figures'] = []  # Array de IDs de figuras para text
-                    ex['resolution_figures'] = []  # Array de IDs de figuras para resolution
-                
-                print(f"✅ {len(valid)} ejercicios extraídos\n")
-                return valid
+
+def _receive_pdf_upload() -> str:
+    """
+    Guarda el PDF de la petición en un archivo temporal único y devuelve su ruta.
+    
+    Acepta multipart/form-data (campo 'pdf'), el cuerpo crudo (application/pdf) o,
+    por compatibilidad, JSON con 'pdfBase64'. Los dos primeros se copian a disco por
+    bloques, sin tener el archivo completo en memoria. Lanza ValueError si no hay PDF
+    y RequestEntityTooLarge si supera MAX_UPLOAD_MB.
+    """
+    limit = app.config['MAX_CONTENT_LENGTH']
+    if request.content_length is not None and request.content_length > limit:
+        raise RequestEntityTooLarge()
+    
+    fd, temp_pdf = tempfile.mkstemp(suffix='.pdf')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            if request.mimetype == 'multipart/form-data':
+                # Werkzeug ya vuelca a disco las partes grandes (archivo temporal "spooled")
+                upload = request.files.get('pdf')
+                if not upload:
+                    raise ValueError('No PDF data')
+                shutil.copyfileobj(upload.stream, f, 1024 * 1024)
             
-            return []
+            elif request.mimetype in ('application/pdf', 'application/octet-stream'):
+                received = 0
+                for block in iter(lambda: request.stream.read(1024 * 1024), b''):
+                    received += len(block)
+                    if received > limit:
+                        raise RequestEntityTooLarge()
+                    f.write(block)
             
-        except Exception as e:
-            print(f"❌ Error: {e}\n")
-            return []
-    
-    def process_pdf(self, pdf_path: str):
-        """Proceso completo: extrae figuras y ejercicios"""
-        pdf_name = Path(pdf_path).stem
-        
-        print(f"\n{'='*70}")
-        print(f"🚀 PROCESANDO: {pdf_name}")
-        print(f"{'='*70}\n")
-        
-        # 1. Extraer figuras
-        figures = self.extract_figures_with_nomenclature(pdf_path)
+            else:
+                pdf_base64 = (request.get_json(silent=True) or {}).get('pdfBase64')
+                if not pdf_base64:
+                    raise ValueError('No PDF data')
+                f.write(base64.b64decode(pdf_base64))
         
-        # 2. Extraer ejercicios
-        exercises = self.extract_exercises(pdf_path)
+        if os.path.getsize(temp_pdf) == 0:
+            raise ValueError('No PDF data')
+        return temp_pdf
+    
+    except Exception:
+        os.remove(temp_pdf)
+        raise
+
+
+def _embed_requested() -> bool:
+    """True si la petición pide las figuras en base64 (?embed=1) o así está configurado"""
+    return Config.EMBED_FIGURES or request.args.get('embed') in ('1', 'true')
+
+
+def _public_figures(figures: List[Dict], url_prefix: str = '/figures',
+                    embed: Optional[bool] = None) -> List[Dict]:
+    """
+    Prepara el manifiesto de figuras para una respuesta: añade url y thumbnail_url
+    (con ?v= para que el navegador pueda cachearlas sin riesgo) y solo incluye el
+    base64 si se pide con ?embed=1 o EMBED_FIGURES=1.
+    """
+    embed = _embed_requested() if embed is None else embed
+    public = []
+    
+    for fig in figures:
+        fig = dict(fig)
+        path = Path(fig['path'])
+        version = path.stat().st_mtime_ns if path.exists() else 0
         
-        if not exercises:
-            print("⚠️ No se extrajeron ejercicios")
-            return
+        fig['url'] = f"{url_prefix}/{fig['filename']}?v={version}"
+        if fig.get('thumbnail'):
+            fig['thumbnail_url'] = f"{url_prefix}/{fig['thumbnail']}?v={version}"
         
-        # 3. Guardar datos
-        figures_json = self.output_dir / "figures.json"
-        exercises_json = self.output_dir / "exercises.json"
+        if not embed or fig.get('duplicate_of'):
+            # Las referencias usan la imagen de duplicate_of (misma URL)
+            fig.pop('base64', None)
+        elif 'base64' not in fig and path.exists():
+            # Los mismos bytes del archivo, sin volver a codificar la imagen
+            img_b64 = base64.b64encode(path.read_bytes()).decode('utf-8')
+            fig['base64'] = f"data:{_FIGURE_MIME.get(path.suffix, 'image/png')};base64,{img_b64}"
         
-        with open(figures_json, 'w', encoding='utf-8') as f:
-            json.dump(figures, f, ensure_ascii=False, indent=2)
+        public.append(fig)
+    
+    return public
+
+
+def _send_figure(figures_dir: Path, filename: str):
+    """Sirve una imagen con ETag (304 si no cambió) y Cache-Control"""
+    return send_from_directory(
+        figures_dir.resolve(), filename, max_age=Config.FIGURE_MAX_AGE, etag=True, conditional=True
+    )
+
+
+def _upload_error(e: Exception):
+    """Respuesta para los errores de _receive_pdf_upload"""
+    if isinstance(e, RequestEntityTooLarge):
+        return jsonify({'error': f'El PDF supera el máximo de {Config.MAX_UPLOAD_MB} MB'}), 413
+    return jsonify({'error': str(e)}), 400
+
+def _doc_json_path(doc: str) -> Optional[Path]:
+    """exercises.json de un documento: extracted_data/ para 'default' o el workspace del trabajo"""
+    if doc == 'default':
+        return Path('extracted_data/exercises.json')
+    workspace = job_manager.workspace(doc)
+    return workspace / 'exercises.json' if workspace else None
+
+
+def _sync_doc(doc: str) -> bool:
+    """Importa el JSON del documento si es más reciente; indica si el documento existe en el almacén"""
+    json_path = _doc_json_path(doc)
+    if json_path:
+        exercise_store.sync_from_json(doc, json_path)
+    return exercise_store.version(doc) > 0
+
+
+def _load_doc(doc: str) -> Optional[List[Dict]]:
+    """Ejercicios de un documento desde el almacén (importando su JSON si es más reciente)"""
+    return exercise_store.list(doc) if _sync_doc(doc) else None
+
+
+EXPORT_FORMATS = {'json': '.json', 'jsonl': '.jsonl', 'zip': '.zip'}
+
+
+class _FinalExport:
+    """
+    Arma ejercicios_final.json (formato de la sección "Formato del JSON final") a partir
+    de los ejercicios del almacén y de las asociaciones de figuras que envía el cliente.
+    
+    Cada ejercicio se escribe por partes, sin armar en memoria el documento completo.
+    figures='embed' incrusta [IMAGEN: data:...;base64,...] como siempre (cada archivo se
+    lee y codifica una sola vez aunque la figura se repita); figures='ref' escribe
+    [IMAGEN: figures/<archivo>], relativo al JSON o a la raíz del zip.
+    """
+    
+    def __init__(self, figures: List[Dict], figures_dir: Path, mode: str):
+        self.figures = {fig['id']: fig for fig in figures}
+        self.figures_dir = figures_dir
+        self.mode = mode
+        self.files = {}  # archivo → ruta, de las figuras usadas
+        self._data_urls = {}
+    
+    def _image(self, figure_id: str) -> Optional[str]:
+        fig = self.figures.get(figure_id)
+        if not fig:
+            return None
         
-        with open(exercises_json, 'w', encoding='utf-8') as f:
-            json.dump(exercises, f, ensure_ascii=False, indent=2)
+        filename = fig['filename']
+        path = self.figures_dir / filename
+        self.files[filename] = path
+        if self.mode == 'ref':
+            return json.dumps(f"figures/{filename}", ensure_ascii=False)[1:-1]
         
-        print(f"{'='*70}")
-        print(f"🎉 DATOS PREPARADOS")
-        print(f"{'='*70}")
-        print(f"📊 Ejercicios: {len(exercises)}")
-        print(f"🖼️  Figuras: {len(figures)}")
-        print(f"💾 Figuras JSON: {figures_json}")
-        print(f"💾 Ejercicios JSON: {exercises_json}")
-        print(f"📁 Imágenes: {self.figures_dir}/")
-        print(f"{'='*70}\n")
+        if filename not in self._data_urls:
+            data = base64.b64encode(path.read_bytes()).decode('ascii')
+            self._data_urls[filename] = f"data:{_FIGURE_MIME.get(path.suffix, 'image/png')};base64,{data}"
+        return self._data_urls[filename]
+    
+    def _text(self, ex: Dict) -> Iterator[str]:
+        """text con sus figuras al final (el valor JSON, por partes)"""
+        yield json.dumps(ex.get('text') or '', ensure_ascii=False)[:-1]
+        for figure_id in ex.get('text_figures') or []:
+            image = self._image(figure_id)
+            if image:
+                yield from ('\\n\\n[IMAGEN: ', image, ']')
+        yield '"'
+    
+    def _resolution(self, ex: Dict) -> Iterator[str]:
+        """resolution con sus figuras al inicio (cada una se antepone a la anterior)"""
+        yield '"'
+        for figure_id in reversed(ex.get('resolution_figures') or []):
+            image = self._image(figure_id)
+            if image:
+                yield from ('[IMAGEN: ', image, ']\\n\\n')
+        yield json.dumps(ex.get('resolution') or '', ensure_ascii=False)[1:]
+    
+    def _exercise(self, ex: Dict, pretty: bool) -> Iterator[str]:
+        fields = [
+            ('text', self._text(ex)),
+            ('question', [json.dumps(ex.get('question'), ensure_ascii=False)]),
+            ('alternatives', [json.dumps(ex.get('alternatives'), ensure_ascii=False)]),
+            ('answer', [json.dumps(ex.get('answer'), ensure_ascii=False)]),
+            ('resolution', self._resolution(ex))
+        ]
+        yield '  {\n    ' if pretty else '{'
+        for idx, (key, value) in enumerate(fields):
+            if idx:
+                yield ',\n    ' if pretty else ', '
+            yield f'"{key}": '
+            yield from value
+        yield '\n  }' if pretty else '}'
+    
+    def write(self, f, exercises: List[Dict], jsonl: bool = False):
+        """Escribe los ejercicios en f: un array JSON con indent=2 o una línea JSON por ejercicio"""
+        if not jsonl:
+            f.write('[\n' if exercises else '[')
+        for idx, ex in enumerate(exercises):
+            if idx and not jsonl:
+                f.write(',\n')
+            for part in self._exercise(ex, pretty=not jsonl):
+                f.write(part)
+            if jsonl:
+                f.write('\n')
+        if not jsonl:
+            f.write('\n]' if exercises else ']')
+    
+    def save(self, path: Path, exercises: List[Dict], export_format: str):
+        """
+        Genera el archivo final de forma atómica: json, jsonl o zip (ejercicios_final.json
+        y, en figures/, los archivos de las figuras usadas)
+        """
+        temp = path.with_name(f".{path.name}.{uuid.uuid4().hex}")
+        try:
+            if export_format == 'zip':
+                with zipfile.ZipFile(temp, 'w', zipfile.ZIP_DEFLATED) as bundle:
+                    with bundle.open('ejercicios_final.json', 'w', force_zip64=True) as raw:
+                        with io.TextIOWrapper(raw, encoding='utf-8') as f:
+                            self.write(f, exercises)
+                    # Las imágenes ya están comprimidas: se guardan sin volver a comprimir
+                    for filename, figure_path in sorted(self.files.items()):
+                        bundle.write(figure_path, f"figures/{filename}", compress_type=zipfile.ZIP_STORED)
+            else:
+                with open(temp, 'w', encoding='utf-8') as f:
+                    self.write(f, exercises, jsonl=export_format == 'jsonl')
+            os.replace(temp, path)
+        finally:
+            temp.unlink(missing_ok=True)
+
+
+# Lecturas parseadas que se conservan en memoria (una por documento y tipo)
+_READ_CACHE_ENTRIES = 64
+
+
+class _ReadCache:
+    """
+    Caché en proceso de lecturas ya parseadas, invalidada por versión (mtime o versión del almacén)
+    
+    Guarda como máximo max_entries claves; al superarlo descarta la menos usada (LRU).
+    """
+    
+    def __init__(self, max_entries: int = _READ_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key, version, loader: Callable):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] == version:
+                self._entries.move_to_end(key)
+                return entry[1]
         
-        return figures, exercises
+        value = loader()
+        with self._lock:
+            self._entries[key] = (version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+    
+    def drop(self, key):
+        """Descarta una clave (p. ej. el documento de un trabajo borrado)"""
+        with self._lock:
+            self._entries.pop(key, None)
 
 
-# ============================================================================
-# SERVIDOR FLASK MEJORADO
-# ============================================================================
+read_cache = _ReadCache()
+
+
+def _list_response(etag_base: str, loader: Callable[[], List[Dict]]):
+    """
+    Respuesta GET para listas con ETag fuerte, 304 y paginación.
+    
+    Query: page (filtra por página del PDF), offset y limit. El cuerpo sigue siendo
+    una lista JSON; el total filtrado va en la cabecera X-Total-Count.
+    """
+    try:
+        page = int(request.args['page']) if 'page' in request.args else None
+        offset = max(0, int(request.args.get('offset', 0)))
+        limit = int(request.args['limit']) if 'limit' in request.args else None
+    except ValueError:
+        return jsonify({'error': 'page, offset y limit deben ser enteros'}), 400
+    
+    # La ETag depende solo de la versión y de la consulta: un 304 no carga nada
+    query = request.query_string.decode('utf-8')
+    etag = f"{etag_base}-{hashlib.sha1(query.encode('utf-8')).hexdigest()[:10]}"
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    
+    items = loader()
+    if page is not None:
+        items = [item for item in items if item.get('page') == page]
+    total = len(items)
+    items = items[offset:offset + limit] if limit is not None else items[offset:]
+    
+    response = jsonify(items)
+    response.set_etag(etag)
+    response.headers['X-Total-Count'] = str(total)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
-app = Flask(__name__)
-CORS(app)
 
 @app.route('/api/exercises', methods=['GET'])
 def get_exercises():
-    """Devuelve ejercicios"""
-    try:
-        with open('extracted_data/exercises.json', 'r', encoding='utf-8') as f:
-            exercises = json.load(f)
-        return jsonify(exercises)
-    except FileNotFoundError:
+    """Devuelve ejercicios (?doc=<id de trabajo> para un trabajo de /api/jobs)"""
+    doc = request.args.get('doc', 'default')
+    json_path = _doc_json_path(doc)
+    if json_path:
+        exercise_store.sync_from_json(doc, json_path)
+    
+    version = exercise_store.version(doc)
+    if not version:
         return jsonify([]), 404
+    
+    return _list_response(
+        f"ex-{doc}-{version}",
+        lambda: read_cache.get(('exercises', doc), version, lambda: exercise_store.list(doc) or [])
+    )
+
+@app.route('/api/exercises/export', methods=['GET'])
+def export_exercises():
+    """Descarga los ejercicios (con las ediciones) en el formato de exercises.json"""
+    doc = request.args.get('doc', 'default')
+    if not _sync_doc(doc):
+        return jsonify({'error': f'Documento {doc} no encontrado'}), 404
+    
+    buffer = io.StringIO()
+    exercise_store.export_json(doc, buffer)
+    return Response(
+        buffer.getvalue(), mimetype='application/json',
+        headers={'Content-Disposition': 'attachment; filename=exercises.json'}
+    )
 
 @app.route('/api/figures', methods=['GET'])
 def get_figures():
     """Devuelve figuras"""
+    figures_json = Path('extracted_data/figures.json')
     try:
-        with open('extracted_data/figures.json', 'r', encoding='utf-8') as f:
-            figures = json.load(f)
-        return jsonify(figures)
+        stat = figures_json.stat()
     except FileNotFoundError:
         return jsonify([]), 404
+    
+    embed = _embed_requested()
+    version = (stat.st_mtime_ns, stat.st_size)
+    
+    def load() -> List[Dict]:
+        with open(figures_json, 'r', encoding='utf-8') as f:
+            return _public_figures(json.load(f), embed=embed)
+    
+    return _list_response(
+        f"fig-{stat.st_mtime_ns}-{stat.st_size}",
+        lambda: read_cache.get(('figures', embed), version, load)
+    )
 
 @app.route('/api/update-exercise', methods=['POST'])
 def update_exercise():
@@ -372,37 +3245,23 @@ def update_exercise():
     try:
         data = request.json
         exercise_id = data.get('id')
-        updated_data = data.get('data')
-        
-        # Leer ejercicios actuales
-        exercises_json = 'extracted_data/exercises.json'
+        updated_data = data.get('data') or {}
+        doc = data.get('doc', 'default')
         
-        # Si no existe el archivo, crear uno vacío
-        if not os.path.exists(exercises_json):
-            os.makedirs('extracted_data', exist_ok=True)
-            with open(exercises_json, 'w', encoding='utf-8') as f:
-                json.dump([], f)
+        # El id no se puede cambiar: es la clave del ejercicio
+        updated_data.pop('id', None)
         
-        with open(exercises_json, 'r', encoding='utf-8') as f:
-            exercises = json.load(f)
+        # Sin leer el documento completo: la edición cuesta lo mismo con 20 o 20.000 ejercicios
+        if not _sync_doc(doc):
+            return jsonify({'error': f'Ejercicio {exercise_id} no encontrado'}), 404
         
-        # Encontrar y actualizar el ejercicio
-        found = False
-        for i, ex in enumerate(exercises):
-            if ex.get('id') == exercise_id:
-                exercises[i].update(updated_data)
-                found = True
-                break
+        exercise = exercise_store.update(doc, exercise_id, updated_data)
         
         # Si no se encontró, retornar error específico
-        if not found:
+        if exercise is None:
             return jsonify({'error': f'Ejercicio {exercise_id} no encontrado'}), 404
         
-        # Guardar
-        with open(exercises_json, 'w', encoding='utf-8') as f:
-            json.dump(exercises, f, ensure_ascii=False, indent=2)
-        
-        return jsonify({'status': 'success', 'exercise': exercises[i] if found else None})
+        return jsonify({'status': 'success', 'exercise': exercise})
     except Exception as e:
         print(f"Error en update-exercise: {str(e)}")
         import traceback
@@ -415,30 +3274,19 @@ def delete_exercise():
     try:
         data = request.json
         exercise_id = data.get('id')
+        doc = data.get('doc', 'default')
         
-        # Leer ejercicios actuales
-        exercises_json = 'extracted_data/exercises.json'
-        
-        # Si no existe el archivo, retornar error
-        if not os.path.exists(exercises_json):
+        # Si no existe el documento, retornar error
+        if not _sync_doc(doc):
             return jsonify({'error': 'No hay ejercicios para eliminar'}), 404
         
-        with open(exercises_json, 'r', encoding='utf-8') as f:
-            exercises = json.load(f)
-        
-        # Filtrar ejercicio eliminado
-        original_count = len(exercises)
-        exercises = [ex for ex in exercises if ex.get('id') != exercise_id]
+        remaining = exercise_store.delete(doc, exercise_id)
         
         # Verificar si se eliminó algo
-        if len(exercises) == original_count:
+        if remaining is None:
             return jsonify({'error': f'Ejercicio {exercise_id} no encontrado'}), 404
         
-        # Guardar
-        with open(exercises_json, 'w', encoding='utf-8') as f:
-            json.dump(exercises, f, ensure_ascii=False, indent=2)
-        
-        return jsonify({'status': 'success', 'remaining': len(exercises)})
+        return jsonify({'status': 'success', 'remaining': remaining})
     except Exception as e:
         print(f"Error en delete-exercise: {str(e)}")
         import traceback
@@ -447,21 +3295,108 @@ def delete_exercise():
 
 @app.route('/api/save-associations', methods=['POST'])
 def save_associations():
-    """Guarda asociaciones y genera JSON final"""
-    data = request.json
-    exercises_with_images = data.get('exercises', [])
+    """
+    Guarda asociaciones y genera el JSON final en el servidor
+    
+    Cuerpo: {"exercises": [{"id", "text_figures", "resolution_figures"}, ...], "doc",
+    "format": "json" | "jsonl" | "zip", "figures": "embed" | "ref"}. Los textos salen
+    del almacén (con las ediciones) y las imágenes de los archivos de figuras; sin
+    "exercises" se exportan todos con las asociaciones ya guardadas. El archivo se
+    descarga desde la url de la respuesta.
+    """
+    data = request.get_json(silent=True) or {}
+    doc = data.get('doc', 'default')
+    export_format = data.get('format', 'json')
+    mode = data.get('figures', 'ref' if export_format == 'zip' else 'embed')
+    if export_format not in EXPORT_FORMATS or mode not in ('embed', 'ref'):
+        return jsonify({'error': f"format debe ser {', '.join(EXPORT_FORMATS)} y figures embed o ref"}), 400
+    
+    entries = data.get('exercises')
+    if entries and not all(isinstance(entry, dict) and entry.get('id') for entry in entries):
+        # Compatibilidad: ejercicios ya armados por el cliente, se guardan tal cual
+        output_path = 'extracted_data/ejercicios_final.json'
+        with open(output_path, 'w', encoding='utf-8') as f:
+            json.dump(entries, f, ensure_ascii=False, indent=2)
+        return jsonify({'status': 'success', 'file': output_path})
     
-    # Guardar JSON final
-    output_path = 'extracted_data/ejercicios_final.json'
-    with open(output_path, 'w', encoding='utf-8') as f:
-        json.dump(exercises_with_images, f, ensure_ascii=False, indent=2)
+    # Antes de escribir nada: sin carpeta del documento no hay dónde generar la exportación
+    json_path = _doc_json_path(doc)
+    stored = _load_doc(doc) if json_path else None
+    if stored is None:
+        return jsonify({'error': f'Documento {doc} no encontrado'}), 404
     
-    return jsonify({'status': 'success', 'file': output_path})
+    if entries is None:
+        exercises = stored
+        missing = []
+    else:
+        exercises = exercise_store.update_many(doc, [
+            (entry['id'], {'text_figures': list(entry.get('text_figures') or []),
+                           'resolution_figures': list(entry.get('resolution_figures') or [])})
+            for entry in entries
+        ])
+        found = {ex['id'] for ex in exercises}
+        missing = [entry['id'] for entry in entries if entry['id'] not in found]
+    
+    output_dir = json_path.parent
+    figures = []
+    if (output_dir / 'figures.json').exists():
+        with open(output_dir / 'figures.json', 'r', encoding='utf-8') as f:
+            figures = json.load(f)
+    
+    start = time.perf_counter()
+    export = _FinalExport(figures, output_dir / 'figures', mode)
+    output_path = output_dir / f"ejercicios_final{EXPORT_FORMATS[export_format]}"
+    try:
+        export.save(output_path, exercises, export_format)
+    except OSError as e:
+        return jsonify({'error': f'No se pudo generar la exportación: {e}'}), 500
+    elapsed = time.perf_counter() - start
+    metrics.observe('extractor_stage_seconds', elapsed, stage='export')
+    print(f"📥 Exportación: {len(exercises)} ejercicios, {len(export.files)} figuras en {elapsed:.2f}s → {output_path}")
+    
+    query = '' if doc == 'default' else f'?doc={doc}'
+    return jsonify({
+        'status': 'success',
+        'file': str(output_path),
+        'url': f"/api/exports/{output_path.name}{query}",
+        'exercises': len(exercises),
+        'figures': len(export.files),
+        'bytes': output_path.stat().st_size,
+        'missing': missing
+    })
+
+@app.route('/api/exports/<filename>', methods=['GET'])
+def download_export(filename):
+    """Descarga el archivo generado por /api/save-associations"""
+    if filename not in {f"ejercicios_final{ext}" for ext in EXPORT_FORMATS.values()}:
+        return jsonify({'error': 'Exportación no encontrada'}), 404
+    json_path = _doc_json_path(request.args.get('doc', 'default'))
+    if not json_path or not (json_path.parent / filename).exists():
+        return jsonify({'error': 'Exportación no encontrada'}), 404
+    
+    download_name = f"ejercicios_{int(time.time() * 1000)}{Path(filename).suffix}"
+    return send_from_directory(json_path.parent.resolve(), filename, as_attachment=True,
+                               download_name=download_name, max_age=0)
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Métricas en formato de texto de Prometheus"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/api/claude-stats', methods=['GET'])
+def get_claude_stats():
+    """Cola, llamadas en curso, presupuesto de tokens y reintentos del planificador de Claude"""
+    return jsonify(claude_scheduler.stats())
+
+@app.route('/api/cache-stats', methods=['GET'])
+def get_cache_stats():
+    """Aciertos y fallos de la caché de resultados"""
+    return jsonify(result_cache.stats())
 
 @app.route('/figures/<path:filename>')
 def serve_figure(filename):
     """Sirve imágenes"""
-    return send_from_directory('extracted_data/figures', filename)
+    return _send_figure(Path('extracted_data/figures'), filename)
 
 @app.route('/api/extract-exercises', methods=['POST', 'OPTIONS'])
 def extract_exercises_endpoint():
@@ -470,49 +3405,39 @@ def extract_exercises_endpoint():
     if request.method == 'OPTIONS':
         return jsonify({'status': 'ok'}), 200
     
+    temp_pdf = None
+    
     try:
-        data = request.json
-        pdf_base64 = data.get('pdfBase64')
-        
-        if not pdf_base64:
-            return jsonify({'error': 'No PDF data'}), 400
+        # Obtener API Key
+        api_key = Config.ANTHROPIC_API_KEY
+        if not api_key or api_key == "COLOCA_TU_API_KEY_AQUI":
+            return jsonify({'error': 'API Key no configurada en el backend'}), 500
         
         print("\n" + "="*70)
         print("📥 Recibiendo PDF desde frontend...")
         print("="*70)
         
-        # Decodificar PDF
-        pdf_bytes = base64.b64decode(pdf_base64)
-        
-        # Guardar temporalmente
-        temp_pdf = Path('temp_upload.pdf')
-        with open(temp_pdf, 'wb') as f:
-            f.write(pdf_bytes)
+        # Guardar temporalmente (archivo único por petición)
+        try:
+            temp_pdf = Path(_receive_pdf_upload())
+        except (ValueError, RequestEntityTooLarge) as e:
+            return _upload_error(e)
         
         print(f"✅ PDF guardado temporalmente: {temp_pdf}")
         
-        # Obtener API Key
-        api_key = Config.ANTHROPIC_API_KEY
-        if not api_key or api_key == "COLOCA_TU_API_KEY_AQUI":
-            return jsonify({'error': 'API Key no configurada en el backend'}), 500
-        
         # Procesar con el extractor
         extractor = VisualExtractor(api_key=api_key)
         
-        # Extraer figuras y ejercicios
-        figures = extractor.extract_figures_with_nomenclature(str(temp_pdf))
-        exercises = extractor.extract_exercises(str(temp_pdf))
-        
-        # 🔥 GUARDAR DATOS EN DISCO para persistencia
-        os.makedirs('extracted_data', exist_ok=True)
-        
-        with open('extracted_data/figures.json', 'w', encoding='utf-8') as f:
-            json.dump(figures, f, ensure_ascii=False, indent=2)
-        
-        with open('extracted_data/exercises.json', 'w', encoding='utf-8') as f:
-            json.dump(exercises, f, ensure_ascii=False, indent=2)
-        
-        print("💾 Datos guardados en extracted_data/")
+        # Extraer figuras y ejercicios (de la caché, o solo las páginas que cambiaron)
+        with FigureManifest(extractor.output_dir / 'figures.json') as figure_manifest:
+            _, exercises = extractor.extract(str(temp_pdf), doc='default', manifest=figure_manifest)
+            
+            # 🔥 GUARDAR DATOS EN DISCO para persistencia
+            extractor.account('persist', _save_results(None, exercises,
+                                                       manifest=extractor.page_manifest(exercises),
+                                                       figure_manifest=figure_manifest))
+            # La respuesta lleva todas las figuras: se leen del figures.json publicado
+            figures = figure_manifest.read()
         
         # Limpiar archivo temporal
         if temp_pdf.exists():
@@ -527,7 +3452,8 @@ def extract_exercises_endpoint():
         
         return jsonify({
             'exercises': exercises,
-            'figures': figures
+            'figures': _public_figures(figures),
+            'stats': extractor.stats
         }), 200
         
     except Exception as e:
@@ -536,24 +3462,433 @@ def extract_exercises_endpoint():
         traceback.print_exc()
         
         # Limpiar archivo temporal si existe
-        temp_pdf = Path('temp_upload.pdf')
-        if temp_pdf.exists():
+        if temp_pdf and temp_pdf.exists():
             temp_pdf.unlink()
         
         return jsonify({'error': str(e)}), 500
 
 
-def start_server():
-    """Inicia servidor Flask"""
+@app.route('/api/jobs', methods=['POST'])
+def submit_job():
+    """Encola un PDF para procesarlo en segundo plano; responde de inmediato con el id del trabajo"""
+    api_key = Config.ANTHROPIC_API_KEY
+    if not api_key or api_key == "COLOCA_TU_API_KEY_AQUI":
+        return jsonify({'error': 'API Key no configurada en el backend'}), 500
+    
+    try:
+        temp_pdf = _receive_pdf_upload()
+    except (ValueError, RequestEntityTooLarge) as e:
+        return _upload_error(e)
+    
+    try:
+        job_id = job_manager.submit(temp_pdf, api_key)
+    except RuntimeError as e:
+        os.remove(temp_pdf)
+        return jsonify({'error': str(e)}), 503
+    
+    print(f"📥 Trabajo {job_id} encolado")
+    return jsonify({
+        'job_id': job_id,
+        'status_url': f'/api/jobs/{job_id}',
+        'result_url': f'/api/jobs/{job_id}/result'
+    }), 202
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Estado y progreso por página de un trabajo"""
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({'error': f'Trabajo {job_id} no encontrado'}), 404
+    return jsonify(job)
+
+@app.route('/api/jobs/<job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    """Ejercicios y figuras de un trabajo terminado"""
+    job = job_manager.get(job_id)
+    if not job:
+        return jsonify({'error': f'Trabajo {job_id} no encontrado'}), 404
+    if job['status'] == 'error':
+        return jsonify({'error': job['error']}), 500
+    if job['status'] != 'done':
+        return jsonify({'error': 'El trabajo aún no termina', 'status': job['status']}), 409
+    
+    workspace = job_manager.workspace(job_id)
+    if not workspace:
+        return jsonify({'error': f'Trabajo {job_id} no encontrado'}), 404
+    exercises = _load_doc(job_id) or []
+    with open(workspace / 'figures.json', 'r', encoding='utf-8') as f:
+        figures = json.load(f)
+    
+    return jsonify({'exercises': exercises, 'figures': _public_figures(figures, f'/api/jobs/{job_id}/figures')})
+
+@app.route('/api/jobs/<job_id>/figures/<path:filename>')
+def serve_job_figure(job_id, filename):
+    """Sirve imágenes del workspace de un trabajo"""
+    workspace = job_manager.workspace(job_id)
+    if not workspace:
+        return jsonify({'error': f'Trabajo {job_id} no encontrado'}), 404
+    return _send_figure(workspace / 'figures', filename)
+
+
+def _save_results(figures: Optional[List[Dict]], exercises: List[Dict], output_dir: str = 'extracted_data',
+                  doc: str = 'default', manifest: Optional[Dict] = None,
+                  figure_manifest: Optional[FigureManifest] = None) -> float:
+    """
+    Guarda figuras y ejercicios para que los lean los demás endpoints; devuelve los segundos empleados
+    
+    manifest (huellas de página de VisualExtractor.manifest) permite reprocesar
+    solo las páginas cambiadas la próxima vez que se suba una versión del PDF.
+    figure_manifest: figures.json ya escrito durante la extracción; solo se publica
+    (figures puede ser None: las figuras no pasan por memoria).
+    """
+    start = time.perf_counter()
+    os.makedirs(output_dir, exist_ok=True)
+    
+    # Un manifiesto viejo no debe sobrevivir a un resultado distinto
+    manifest_json = os.path.join(output_dir, 'pages.json')
+    if os.path.exists(manifest_json):
+        os.remove(manifest_json)
+    
+    if figure_manifest:
+        figure_manifest.commit()
+    else:
+        with open(os.path.join(output_dir, 'figures.json'), 'w', encoding='utf-8') as f:
+            json.dump(figures, f, ensure_ascii=False, indent=2)
+    
+    exercises_json = os.path.join(output_dir, 'exercises.json')
+    with open(exercises_json, 'w', encoding='utf-8') as f:
+        json.dump(exercises, f, ensure_ascii=False, indent=2)
+    
+    # Las ediciones posteriores se hacen sobre el almacén, no sobre el JSON
+    exercise_store.replace(doc, exercises, source_mtime=os.stat(exercises_json).st_mtime_ns)
+    
+    if manifest:
+        with open(manifest_json, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+    
+    print(f"💾 Datos guardados en {output_dir}/")
+    return time.perf_counter() - start
+
+
+def _sse(event: str, data) -> str:
+    """Formatea un evento Server-Sent Events"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@app.route('/api/extract-exercises/stream', methods=['POST'])
+def extract_exercises_stream_endpoint():
+    """
+    Igual que /api/extract-exercises, pero responde con Server-Sent Events:
+    - figures:  figuras de cada página en cuanto termina su detección
+    - exercise: cada ejercicio en cuanto Claude lo termina de escribir
+    - done:     totales al finalizar (los datos ya están guardados en disco) y failed_pages,
+                las páginas cuyos ejercicios pueden estar incompletos
+    - error:    mensaje de error
+    """
+    api_key = Config.ANTHROPIC_API_KEY
+    if not api_key or api_key == "COLOCA_TU_API_KEY_AQUI":
+        return jsonify({'error': 'API Key no configurada en el backend'}), 500
+    
+    try:
+        temp_pdf = _receive_pdf_upload()
+    except (ValueError, RequestEntityTooLarge) as e:
+        return _upload_error(e)
+    
+    embed = _embed_requested()
+    
+    def generate():
+        figure_manifest = None
+        # Se activa al terminar, también si el cliente se desconecta: los hilos de
+        # figuras y ejercicios dejan de procesar páginas y de llamar a Claude
+        cancel = threading.Event()
+        try:
+            extractor = VisualExtractor(api_key=api_key)
+            
+            def replay(figures: List[Dict], exercises: List[Dict], **done):
+                """Envía de una vez un resultado completo (caché o reproceso parcial)"""
+                extractor.account('persist', _save_results(figures, exercises,
+                                                           manifest=extractor.page_manifest(exercises)))
+                yield _sse('figures', {'page': None, 'figures': _public_figures(figures, embed=embed)})
+                for ex in exercises:
+                    yield _sse('exercise', ex)
+                yield _sse('done', dict(exercises=len(exercises), figures=len(figures), stats=extractor.stats,
+                                        failed_pages=sorted(extractor.failed_pages), **done))
+            
+            # Versión corregida de un PDF ya procesado: solo las páginas que cambiaron
+            plan = extractor.plan_incremental(temp_pdf, 'default')
+            if plan:
+                extractor.account_document(temp_pdf, 'incremental')
+                figures, exercises = extractor.extract_incremental(temp_pdf, plan)
+                yield from replay(figures, exercises, cached=False, changed_pages=plan['changed'])
+                return
+            
+            cache_key = None
+            if Config.CACHE_ENABLED:
+                cache_key = ResultCache.make_key(temp_pdf, extractor.cache_params())
+                cached = result_cache.get(cache_key, extractor.figures_dir)
+                if cached:
+                    extractor.account_document(temp_pdf, 'cache')
+                    yield from replay(*cached, cached=True)
+                    return
+            
+            extractor.account_document(temp_pdf, 'full')
+            
+            # Figuras y ejercicios avanzan en paralelo; ambos publican en la misma cola
+            events = queue.Queue()
+            exercises = []
+            # figures.json se escribe página a página y se publica junto con los ejercicios
+            figure_manifest = FigureManifest(extractor.output_dir / 'figures.json')
+            
+            def run_figures():
+                try:
+                    for page, total, figs in extractor.iter_figures(temp_pdf, manifest=figure_manifest, cancel=cancel):
+                        events.put(('figures', {'page': page, 'total_pages': total, 'figures': figs}))
+                except Exception as e:
+                    events.put(('error', {'error': f'Figuras: {e}'}))
+                finally:
+                    events.put(('figures_done', None))
+            
+            def run_exercises():
+                try:
+                    for ex in extractor.iter_exercises(temp_pdf, cancel):
+                        events.put(('exercise', ex))
+                except Exception as e:
+                    events.put(('error', {'error': f'Ejercicios: {e}'}))
+                finally:
+                    events.put(('exercises_done', None))
+            
+            threads = [threading.Thread(target=run_figures, daemon=True),
+                       threading.Thread(target=run_exercises, daemon=True)]
+            for thread in threads:
+                thread.start()
+            
+            running, failed = len(threads), False
+            while running:
+                event, payload = events.get()
+                if event in ('figures_done', 'exercises_done'):
+                    running -= 1
+                    continue
+                failed = failed or event == 'error'
+                if event == 'figures':
+                    # Ya están en figure_manifest: aquí solo se reenvían
+                    payload = dict(payload, figures=_public_figures(payload['figures'], embed=embed))
+                elif event == 'exercise':
+                    exercises.append(payload)
+                yield _sse(event, payload)
+            
+            # Un resultado incompleto (p. ej. Claude sin reintentos) no se guarda en la caché
+            # ni deja huellas de página: la próxima subida lo vuelve a procesar completo
+            failed = failed or bool(extractor.failed_pages)
+            extractor.account('persist', _save_results(None, exercises,
+                                                       manifest=extractor.page_manifest(exercises, failed),
+                                                       figure_manifest=figure_manifest))
+            if cache_key and exercises and not failed:
+                result_cache.put(cache_key, figure_manifest.read(), exercises)
+            
+            yield _sse('done', {'exercises': len(exercises), 'figures': figure_manifest.count, 'cached': False,
+                                'failed_pages': sorted(extractor.failed_pages), 'stats': extractor.stats})
+        
+        except Exception as e:
+            print(f"\n❌ Error en streaming: {str(e)}")
+            import traceback
+            traceback.print_exc()
+            yield _sse('error', {'error': str(e)})
+        
+        finally:
+            cancel.set()
+            if figure_manifest:
+                figure_manifest.discard()
+            if os.path.exists(temp_pdf):
+                os.remove(temp_pdf)
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+def start_server(production: bool = False):
+    """Inicia servidor Flask (production: sin depurador ni recarga, ver serve_production)"""
     print("\n" + "="*70)
     print("🌐 INICIANDO SERVIDOR WEB MEJORADO")
     print("="*70)
-    print("📍 URL: http://localhost:5000")
+    print(f"📍 URL: http://{'localhost' if Config.SERVER_HOST == '127.0.0.1' else Config.SERVER_HOST}:{Config.SERVER_PORT}")
     print("🔗 Abre el frontend React en otra terminal")
     print("⌨️  Ctrl+C para detener")
     print("="*70 + "\n")
     
-    app.run(debug=True, port=5000)
+    if production:
+        serve_production()
+    else:
+        app.run(debug=True, port=Config.SERVER_PORT)
+
+
+def serve_production():
+    """
+    Servidor para uso real: SERVER_THREADS hilos atienden las peticiones y las
+    conexiones inactivas se cierran tras SERVER_TIMEOUT segundos.
+    
+    Usa waitress si está instalado (pip install waitress); si no, el servidor de
+    Werkzeug con un pool fijo de hilos. Para varios procesos, ver gunicorn en el README.
+    """
+    try:
+        from waitress import serve
+    except ImportError:
+        serve = None
+    
+    if serve:
+        print(f"🚀 waitress: {Config.SERVER_THREADS} hilos, timeout {Config.SERVER_TIMEOUT}s\n")
+        serve(app, host=Config.SERVER_HOST, port=Config.SERVER_PORT, threads=Config.SERVER_THREADS,
+              channel_timeout=Config.SERVER_TIMEOUT, ident='Cachimbo-RM')
+        return
+    
+    from werkzeug.serving import make_server, WSGIRequestHandler
+    
+    class RequestHandler(WSGIRequestHandler):
+        # Tiempo máximo esperando datos del cliente (cuerpo de la petición o keep-alive)
+        timeout = Config.SERVER_TIMEOUT
+    
+    server = make_server(Config.SERVER_HOST, Config.SERVER_PORT, app, threaded=True,
+                         request_handler=RequestHandler)
+    # ThreadingMixIn crea un hilo por conexión: aquí se acotan con un pool fijo
+    pool = ThreadPoolExecutor(max_workers=Config.SERVER_THREADS, thread_name_prefix='http')
+    server.process_request = lambda request, client_address: pool.submit(
+        server.process_request_thread, request, client_address
+    )
+    
+    print(f"🚀 Werkzeug: {Config.SERVER_THREADS} hilos, timeout {Config.SERVER_TIMEOUT}s "
+          f"(instala waitress para un servidor más robusto)\n")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+# ============================================================================
+# PROCESAMIENTO POR LOTES
+# ============================================================================
+
+class BatchRunner:
+    """
+    Procesa una colección de PDFs sin interacción, cada uno en su propia carpeta
+    (output_dir/<nombre del PDF>/).
+    
+    El estado de cada archivo (running, done, failed) se guarda en
+    output_dir/batch_manifest.json después de cada cambio. Al volver a ejecutar
+    se omiten los archivos terminados cuyo PDF no cambió; los que quedaron a medias
+    por una caída y los que fallaron se procesan de nuevo.
+    """
+    
+    def __init__(self, api_key: str, output_dir: str, workers: int):
+        self.api_key = api_key
+        self.output_dir = Path(output_dir)
+        self.workers = workers
+        self.manifest_path = self.output_dir / 'batch_manifest.json'
+        self._lock = threading.Lock()
+        
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.files = {}
+        if self.manifest_path.exists():
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                self.files = json.load(f).get('files', {})
+    
+    @staticmethod
+    def find_pdfs(source: str) -> List[Path]:
+        """PDFs de una carpeta (sin subcarpetas) o de un patrón glob ('examenes/**/*.pdf')"""
+        if os.path.isdir(source):
+            return sorted(p for p in Path(source).iterdir() if p.suffix.lower() == '.pdf')
+        return sorted(Path(p) for p in glob.glob(source, recursive=True) if p.lower().endswith('.pdf'))
+    
+    @staticmethod
+    def _keys(pdfs: List[Path]) -> Dict[str, Path]:
+        """Nombre de carpeta de cada PDF; los nombres repetidos se distinguen con un hash de la ruta"""
+        stems = [pdf.stem for pdf in pdfs]
+        keys = {}
+        for pdf in pdfs:
+            key = pdf.stem
+            if stems.count(key) > 1:
+                key += '_' + hashlib.sha1(str(pdf.resolve()).encode('utf-8')).hexdigest()[:6]
+            keys[key] = pdf
+        return keys
+    
+    def _save_manifest(self):
+        tmp = self.manifest_path.with_suffix('.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'files': self.files}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, self.manifest_path)
+    
+    def _set(self, key: str, **fields):
+        with self._lock:
+            self.files.setdefault(key, {}).update(fields)
+            self._save_manifest()
+    
+    def _is_done(self, key: str, pdf: Path) -> bool:
+        entry = self.files.get(key)
+        stat = pdf.stat()
+        return bool(entry) and entry.get('status') == 'done' \
+            and entry.get('size') == stat.st_size and entry.get('mtime_ns') == stat.st_mtime_ns
+    
+    def _process(self, key: str, pdf: Path) -> Dict:
+        stat = pdf.stat()
+        self._set(key, source=str(pdf), status='running', size=stat.st_size, mtime_ns=stat.st_mtime_ns,
+                  started_at=datetime.now().isoformat(timespec='seconds'), error=None)
+        start = time.perf_counter()
+        
+        try:
+            extractor = VisualExtractor(api_key=self.api_key, output_dir=str(self.output_dir / key))
+            result = extractor.process_pdf(str(pdf), doc=None)
+            if not result:
+                raise RuntimeError('No se extrajeron ejercicios')
+            
+            figure_count, exercises = result
+            stats = {'pages': len(extractor.manifest['pages']), 'figures': figure_count, 'exercises': len(exercises)}
+            self._set(key, status='done', seconds=round(time.perf_counter() - start, 2),
+                      finished_at=datetime.now().isoformat(timespec='seconds'), **stats)
+            return stats
+        except Exception as e:
+            print(f"❌ {pdf.name}: {e}")
+            self._set(key, status='failed', error=str(e), finished_at=datetime.now().isoformat(timespec='seconds'))
+            return {}
+    
+    def run(self, source: str) -> Dict:
+        """Procesa los PDFs de source y devuelve los totales de esta ejecución"""
+        keys = self._keys(self.find_pdfs(source))
+        pending = {key: pdf for key, pdf in keys.items() if not self._is_done(key, pdf)}
+        
+        print(f"📚 {len(keys)} PDFs: {len(keys) - len(pending)} ya procesados, {len(pending)} pendientes")
+        print(f"⚡ {self.workers} documentos a la vez → {self.output_dir}/\n")
+        
+        totals = {'documents': 0, 'failed': 0, 'pages': 0, 'figures': 0, 'exercises': 0}
+        start = time.perf_counter()
+        
+        with ThreadPoolExecutor(max_workers=max(1, self.workers), thread_name_prefix='batch') as executor:
+            futures = {executor.submit(self._process, key, pdf): key for key, pdf in pending.items()}
+            for done, future in enumerate(as_completed(futures), 1):
+                stats = future.result()
+                if stats:
+                    totals['documents'] += 1
+                    for name in ('pages', 'figures', 'exercises'):
+                        totals[name] += stats[name]
+                else:
+                    totals['failed'] += 1
+                print(f"📦 [{done}/{len(pending)}] {futures[future]}: {'✅' if stats else '❌'}")
+        
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        totals['seconds'] = round(elapsed, 1)
+        
+        print(f"\n{'='*70}")
+        print(f"🎉 LOTE TERMINADO: {totals['documents']} documentos, {totals['failed']} con error")
+        print(f"📄 {totals['pages']} páginas ({totals['pages'] / elapsed:.1f} páginas/s)")
+        print(f"🖼️  {totals['figures']} figuras ({totals['figures'] / elapsed:.1f} figuras/s)")
+        print(f"📊 {totals['exercises']} ejercicios ({totals['exercises'] / elapsed * 60:.1f} ejercicios/min)")
+        print(f"⏱️  {elapsed:.1f}s · estado en {self.manifest_path}")
+        print(f"{'='*70}\n")
+        
+        return totals
 
 
 # ============================================================================
@@ -594,10 +3929,19 @@ def main():
 
 if __name__ == "__main__":
     if len(sys.argv) > 1 and sys.argv[1] == '--server':
+        # python backend_extractor.py --server [--production]
         if Config.validate_api_key():
-            start_server()
+            start_server(production='--production' in sys.argv[2:])
         else:
             print("❌ Configura API Key antes de iniciar el servidor")
             sys.exit(1)
+    elif len(sys.argv) > 2 and sys.argv[1] == '--batch':
+        # python backend_extractor.py --batch <carpeta o patrón> [carpeta de salida]
+        if not Config.validate_api_key():
+            print("❌ Configura API Key antes de procesar un lote")
+            sys.exit(1)
+        output_dir = sys.argv[3] if len(sys.argv) > 3 else Config.BATCH_OUTPUT_DIR
+        totals = BatchRunner(Config.ANTHROPIC_API_KEY, output_dir, Config.BATCH_WORKERS).run(sys.argv[2])
+        sys.exit(1 if totals['failed'] else 0)
     else:
         main()
\ No newline at end of file
@@ -0,0 +1,587 @@
+"""
+╔════════════════════════════════════════════════════════════════════╗
+║  ⏱️  BENCHMARK DEL EXTRACTOR                                       ║
+║  ✅ PDFs sintéticos con recuadros rojos (vectoriales y escaneados) ║
+║  ✅ Cliente de Anthropic simulado (sin red ni API Key)             ║
+║  ✅ Resultados en JSON para comparar versiones                     ║
+╚════════════════════════════════════════════════════════════════════╝
+
+USO:
+python benchmark_extractor.py
+python benchmark_extractor.py --pages 40 --boxes 3 --repeat 5 --output resultados.json
+python benchmark_extractor.py --variants vector --modes full,vector --claude-delay 0
+python benchmark_extractor.py --stages process_pdf --extraction pdf,hybrid
+python benchmark_extractor.py --stages scheduler --throttle-every 3 --retry-after 0.2
+
+Etapas medidas (cada una se repite --repeat veces; se guardan mínimo, mediana y media):
+- render:          rasterizar cada página a RENDER_ZOOM
+- detect:          detect_red_boxes sobre las páginas ya rasterizadas
+- encode:          codificar las figuras detectadas (PNG + miniatura)
+- figures:<modo>:  extract_figures_with_nomenclature completo, por DETECTION_MODE
+- process_pdf:<m>: proceso completo con el cliente simulado, por EXTRACTION_MODE
+                   (con los tokens de entrada estimados de lo que se envía a Claude)
+- endpoint:<ruta>: endpoints de Flask con el cliente de pruebas
+- scheduler:<api>: process_pdf (create) e iter_exercises (stream) con el SDK real contra
+                   un servidor local que responde 429/529 cada --throttle-every peticiones
+                   (comprueba que no se pierden ejercicios; guarda reintentos y esperas)
+"""
+
+import os
+import sys
+import io
+import json
+import time
+import base64
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import threading
+import subprocess
+from contextlib import redirect_stdout
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Callable, Dict, List
+
+# El backend usa rutas relativas (extracted_data/...): todo se ejecuta dentro de un
+# directorio temporal y sin caché de resultados, para medir siempre el trabajo real.
+# Los workers de render (spawn/forkserver) vuelven a importar este módulo: reutilizan
+# el directorio del proceso principal en vez de crear otro
+BACKEND_DIR = Path(__file__).resolve().parent
+WORK_DIR = Path(os.environ.get('BENCHMARK_WORK_DIR') or tempfile.mkdtemp(prefix='benchmark_extractor_'))
+os.environ['BENCHMARK_WORK_DIR'] = str(WORK_DIR)
+os.environ['CACHE_ENABLED'] = '0'
+os.environ.setdefault('ANTHROPIC_API_KEY', 'benchmark')
+sys.path.insert(0, str(BACKEND_DIR))
+os.chdir(WORK_DIR)
+
+import fitz
+from PIL import Image
+
+import backend_extractor as backend
+
+REAL_ANTHROPIC = backend.anthropic
+
+
+# ============================================================================
+# PDFs SINTÉTICOS
+# ============================================================================
+
+def make_pdf(path: Path, pages: int, boxes: int, variant: str):
+    """
+    Genera un PDF con `boxes` recuadros rojos por página (cada tercera página sin figuras).
+
+    variant: 'vector' (recuadros dibujados), 'annot' (anotaciones rectangulares rojas)
+             o 'scanned' (cada página convertida en imagen, como un escaneo)
+    """
+    doc = fitz.open()
+    for page_num in range(pages):
+        page = doc.new_page()
+        page.insert_text((72, 72), f"Ejercicio {page_num + 1}: calcula el área del triángulo", fontsize=12)
+        page.insert_textbox(fitz.Rect(72, 540, 520, 760),
+                            "Un triángulo rectángulo tiene catetos de 6 cm y 8 cm. Si se duplica la "
+                            "medida de cada lado, ¿cuál es el área del nuevo triángulo?\n"
+                            "A) 24 cm2   B) 48 cm2   C) 96 cm2   D) 192 cm2   E) 384 cm2", fontsize=11)
+        if page_num % 3 == 2:
+            continue
+
+        columns = 2
+        for box in range(boxes):
+            row, col = divmod(box, columns)
+            rect = fitz.Rect(60 + col * 260, 120 + row * 200, 280 + col * 260, 290 + row * 200)
+            page.draw_circle(rect.tl + (110, 85), 50, color=(0, 0, 1), width=2)
+            page.insert_text(rect.tl + (20, 30), f"Figura {box + 1}", fontsize=10)
+            if variant == 'annot':
+                annot = page.add_rect_annot(rect)
+                annot.set_colors(stroke=(1, 0, 0))
+                annot.set_border(width=2)
+                annot.update()
+            else:
+                page.draw_rect(rect, color=(1, 0, 0), width=2)
+
+    if variant == 'scanned':
+        scanned = fitz.open()
+        for page in doc:
+            pix = page.get_pixmap(matrix=fitz.Matrix(2, 2))
+            new_page = scanned.new_page(width=page.rect.width, height=page.rect.height)
+            # JPEG, como un escáner real (un Pixmap sin comprimir infla el PDF)
+            new_page.insert_image(new_page.rect, stream=pix.tobytes('jpg'))
+        doc.close()
+        doc = scanned
+
+    doc.save(path)
+    doc.close()
+
+
+# ============================================================================
+# CLIENTE DE ANTHROPIC SIMULADO
+# ============================================================================
+
+class _FakeStream:
+    def __init__(self, text: str, delay: float, input_tokens: int):
+        self.text = text
+        self.delay = delay
+        self.input_tokens = input_tokens
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    @property
+    def text_stream(self):
+        step = max(1, len(self.text) // 10)
+        for start in range(0, len(self.text), step):
+            time.sleep(self.delay / 10)
+            yield self.text[start:start + step]
+
+    def get_final_message(self):
+        return SimpleNamespace(stop_reason='end_turn', usage=_fake_usage(self.text, self.input_tokens))
+
+
+# Estimación de tokens de entrada: una página de PDF cuesta su texto más su imagen
+# (~2500 tokens); una imagen, ancho × alto / 750 (hasta ~1600); el texto, ~4 caracteres por token
+PDF_PAGE_TOKENS = 2500
+
+
+def _estimate_input_tokens(content: List[Dict]) -> int:
+    tokens = 0
+    for block in content:
+        if block['type'] == 'document':
+            pdf = fitz.open(stream=base64.b64decode(block['source']['data']), filetype='pdf')
+            tokens += len(pdf) * PDF_PAGE_TOKENS
+            pdf.close()
+        elif block['type'] == 'image':
+            pix = fitz.Pixmap(base64.b64decode(block['source']['data']))
+            tokens += min(pix.width * pix.height // 750, 1600)
+        else:
+            tokens += len(block['text']) // 4
+    return tokens
+
+
+class _FakeMessages:
+    """Responde un ejercicio por página del fragmento recibido, tras `delay` segundos"""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+
+    def _answer(self, kwargs: Dict) -> str:
+        content = kwargs['messages'][0]['content']
+        # Modo hybrid: un encabezado por página
+        pages = sum(block['type'] == 'text' and block['text'].startswith('=== Página') for block in content)
+        for block in content:
+            if block['type'] == 'document':
+                pdf = fitz.open(stream=base64.b64decode(block['source']['data']), filetype='pdf')
+                pages = len(pdf)
+                pdf.close()
+        pages = max(pages, 1)
+
+        exercises = [{
+            "text": f"Texto del ejercicio de la página {page}",
+            "question": f"¿Pregunta {page}?",
+            "alternatives": "A) 1  B) 2  C) 3  D) 4",
+            "answer": "A",
+            "resolution": "Resolución de ejemplo",
+            "page": page
+        } for page in range(1, pages + 1)]
+        return "```json\n" + json.dumps(exercises, ensure_ascii=False, indent=2) + "\n```"
+
+    def create(self, **kwargs):
+        time.sleep(self.delay)
+        text = self._answer(kwargs)
+        usage = _fake_usage(text, _estimate_input_tokens(kwargs['messages'][0]['content']))
+        return SimpleNamespace(content=[SimpleNamespace(type='text', text=text)], stop_reason='end_turn', usage=usage)
+
+    def stream(self, **kwargs):
+        return _FakeStream(self._answer(kwargs), self.delay, _estimate_input_tokens(kwargs['messages'][0]['content']))
+
+
+def _fake_usage(text: str, input_tokens: int):
+    return SimpleNamespace(input_tokens=input_tokens, output_tokens=len(text) // 4)
+
+
+class FakeAnthropic:
+    """Sustituto de anthropic.Anthropic con respuestas fijas y retardo configurable"""
+
+    def __init__(self, delay: float):
+        self.messages = _FakeMessages(delay)
+
+
+class ThrottlingServer(ThreadingHTTPServer):
+    """
+    API de Messages local (POST /v1/messages) con las respuestas de _FakeMessages.
+    Cada `every` peticiones responde un error de límite, alternando 429 y 529,
+    con retry-after = `retry_after` segundos; el SDK real se apunta aquí con base_url.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, delay: float, every: int, retry_after: float):
+        super().__init__(('127.0.0.1', 0), _ThrottlingHandler)
+        self.fake = _FakeMessages(0)
+        self.delay = delay
+        self.every = every
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.throttled = 0
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+
+class _ThrottlingHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status: int, body: bytes, content_type: str, headers: Dict = None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        server = self.server
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with server.lock:
+            server.requests += 1
+            throttle = server.every and server.requests % server.every == 0
+            if throttle:
+                server.throttled += 1
+                status = 429 if server.throttled % 2 else 529
+        if throttle:
+            kind = 'rate_limit_error' if status == 429 else 'overloaded_error'
+            body = json.dumps({'type': 'error', 'error': {'type': kind, 'message': 'simulado'}}).encode()
+            self._send(status, body, 'application/json', {'retry-after': str(server.retry_after)})
+            return
+
+        time.sleep(server.delay)
+        text = server.fake._answer(request)
+        usage = {'input_tokens': _estimate_input_tokens(request['messages'][0]['content']),
+                 'output_tokens': len(text) // 4}
+        message = {'id': 'msg_benchmark', 'type': 'message', 'role': 'assistant', 'model': request['model'],
+                   'content': [{'type': 'text', 'text': text}], 'stop_reason': 'end_turn',
+                   'stop_sequence': None, 'usage': usage}
+        if not request.get('stream'):
+            self._send(200, json.dumps(message).encode(), 'application/json')
+            return
+
+        step = max(1, len(text) // 10)
+        events = [('message_start', {'type': 'message_start', 'message': {
+            **message, 'content': [], 'stop_reason': None, 'usage': {**usage, 'output_tokens': 0}}}),
+            ('content_block_start', {'type': 'content_block_start', 'index': 0,
+                                     'content_block': {'type': 'text', 'text': ''}})]
+        events += [('content_block_delta', {'type': 'content_block_delta', 'index': 0,
+                                            'delta': {'type': 'text_delta', 'text': text[start:start + step]}})
+                   for start in range(0, len(text), step)]
+        events += [('content_block_stop', {'type': 'content_block_stop', 'index': 0}),
+                   ('message_delta', {'type': 'message_delta', 'delta': {'stop_reason': 'end_turn', 'stop_sequence': None},
+                                      'usage': {'output_tokens': usage['output_tokens']}}),
+                   ('message_stop', {'type': 'message_stop'})]
+        body = ''.join(f'event: {name}\ndata: {json.dumps(data)}\n\n' for name, data in events).encode()
+        self._send(200, body, 'text/event-stream')
+
+
+# ============================================================================
+# MEDICIÓN
+# ============================================================================
+
+def timed(fn: Callable, repeat: int, verbose: bool = False) -> List[float]:
+    """Ejecuta fn `repeat` veces y devuelve los tiempos en segundos"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        if verbose:
+            fn()
+        else:
+            with redirect_stdout(io.StringIO()):
+                fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def record(results: List[Dict], stage: str, variant: str, pages: int, times: List[float], **extra):
+    median = statistics.median(times)
+    results.append({
+        'stage': stage,
+        'variant': variant,
+        'pages': pages,
+        'runs': len(times),
+        'min_s': round(min(times), 4),
+        'median_s': round(median, 4),
+        'mean_s': round(statistics.mean(times), 4),
+        'pages_per_s': round(pages / median, 2) if median else None,
+        **extra
+    })
+    print(f"  {stage:<28} {median * 1000:>9.1f} ms   {pages / median if median else 0:>8.1f} páginas/s")
+
+
+def bench_stages(pdf_path: Path, variant: str, pages: int, args, results: List[Dict]):
+    """Etapas sueltas del modo 'full': render, detección y codificación"""
+    doc = fitz.open(pdf_path)
+    matrix = fitz.Matrix(backend.Config.RENDER_ZOOM, backend.Config.RENDER_ZOOM)
+    raster = backend._RasterBuffer()
+
+    def render():
+        images = []
+        for page in doc:
+            # rgb_view no copia: el Pixmap debe seguir vivo hasta convertirlo
+            pix = page.get_pixmap(matrix=matrix, alpha=False)
+            images.append(raster.to_bgr(raster.rgb_view(pix)).copy())
+        return images
+
+    record(results, 'render', variant, pages, timed(render, args.repeat))
+    images = render()
+
+    boxes = []
+    record(results, 'detect', variant, pages, timed(
+        lambda: boxes.__setitem__(slice(None), [backend.VisualExtractor.detect_red_boxes(img) for img in images]),
+        args.repeat
+    ))
+
+    crops = [img[y:y + h, x:x + w, ::-1].copy() for img, page_boxes in zip(images, boxes)
+             for x, y, w, h in page_boxes]
+
+    def encode():
+        # Mismo codificador que el extractor (FIGURE_FORMAT), figura y miniatura
+        sizes = []
+        for crop in crops:
+            pil_image = Image.fromarray(crop)
+            sizes.append(len(backend._encode_image(pil_image)))
+            pil_image.thumbnail((backend.Config.THUMBNAIL_HEIGHT * 5, backend.Config.THUMBNAIL_HEIGHT))
+            sizes.append(len(backend._encode_image(pil_image)))
+        return sizes
+
+    encoded_bytes = sum(encode())
+    record(results, 'encode', variant, pages, timed(encode, args.repeat), figures=len(crops),
+           figure_format=backend.Config.FIGURE_FORMAT, encoded_bytes=encoded_bytes)
+    doc.close()
+
+
+def bench_figures(pdf_path: Path, variant: str, pages: int, args, results: List[Dict]):
+    """extract_figures_with_nomenclature completo, en cada modo de detección"""
+    for mode in args.modes:
+        output_dir = WORK_DIR / f'out_{variant}_{mode}'
+        with redirect_stdout(io.StringIO()):
+            extractor = backend.VisualExtractor(api_key='benchmark', output_dir=str(output_dir))
+
+        figures = []
+        record(results, f'figures:{mode}', variant, pages, timed(
+            lambda: figures.__setitem__(slice(None), extractor.extract_figures_with_nomenclature(
+                str(pdf_path), workers=args.workers, mode=mode)),
+            args.repeat, args.verbose
+        ), figures=len(figures), workers=args.workers)
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+
+def bench_process_pdf(pdf_path: Path, variant: str, pages: int, args, results: List[Dict]):
+    """Proceso completo (figuras + Claude simulado + JSON), por EXTRACTION_MODE"""
+    original = backend.Config.EXTRACTION_MODE
+    for extraction in args.extraction:
+        backend.Config.EXTRACTION_MODE = extraction
+        output_dir = WORK_DIR / f'out_{variant}_process_{extraction}'
+        with redirect_stdout(io.StringIO()):
+            extractor = backend.VisualExtractor(api_key='benchmark', output_dir=str(output_dir))
+
+        times = timed(lambda: extractor.process_pdf(str(pdf_path), doc=None), args.repeat, args.verbose)
+        stats = extractor.stats
+        record(results, f'process_pdf:{extraction}', variant, pages, times,
+               claude_delay_s=args.claude_delay,
+               claude_input_tokens=stats.get('claude_input_tokens', 0) // len(times),
+               claude_text_pages=stats.get('claude_text_pages', 0) // len(times),
+               claude_image_pages=stats.get('claude_image_pages', 0) // len(times))
+        shutil.rmtree(output_dir, ignore_errors=True)
+    backend.Config.EXTRACTION_MODE = original
+
+
+def bench_scheduler(pdf_path: Path, variant: str, pages: int, args, results: List[Dict]):
+    """process_pdf e iter_exercises contra ThrottlingServer, con un planificador nuevo por etapa"""
+    server = ThrottlingServer(args.claude_delay, args.throttle_every, args.retry_after)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    fake_anthropic, original_scheduler = backend.anthropic, backend.claude_scheduler
+    os.environ['ANTHROPIC_BASE_URL'] = server.url
+    backend.anthropic = REAL_ANTHROPIC
+    backend._anthropic_clients.clear()
+    original_chunk = backend.Config.CHUNK_PAGES
+    backend.Config.CHUNK_PAGES = max(1, pages // 8)  # varios fragmentos para que haya cola
+    config = backend.Config
+
+    try:
+        for api in ('create', 'stream'):
+            backend.claude_scheduler = backend.ClaudeScheduler(
+                config.CLAUDE_MAX_IN_FLIGHT, config.CLAUDE_TOKENS_PER_MINUTE, config.CLAUDE_MAX_RETRIES,
+                config.CLAUDE_BACKOFF_BASE, config.CLAUDE_BACKOFF_MAX)
+            output_dir = WORK_DIR / f'out_{variant}_scheduler_{api}'
+            with redirect_stdout(io.StringIO()):
+                extractor = backend.VisualExtractor(api_key='benchmark', output_dir=str(output_dir))
+            counts = []
+
+            def run():
+                if api == 'create':
+                    counts.append(len(extractor.extract_exercises(str(pdf_path))))
+                else:
+                    counts.append(sum(1 for _ in extractor.iter_exercises(str(pdf_path))))
+
+            times = timed(run, args.repeat, args.verbose)
+            assert all(count == pages for count in counts), f'ejercicios perdidos: {counts} de {pages}'
+            stats = backend.claude_scheduler.stats()
+            record(results, f'scheduler:{api}', variant, pages, times,
+                   throttle_every=args.throttle_every, retry_after_s=args.retry_after,
+                   requests=stats['requests'], retries=stats['retries'], throttled=stats['throttled'],
+                   wait_s=stats['wait_seconds'])
+            shutil.rmtree(output_dir, ignore_errors=True)
+    finally:
+        server.shutdown()
+        server.server_close()
+        os.environ.pop('ANTHROPIC_BASE_URL', None)
+        backend._anthropic_clients.clear()
+        backend.anthropic, backend.claude_scheduler = fake_anthropic, original_scheduler
+        backend.Config.CHUNK_PAGES = original_chunk
+
+
+def bench_endpoints(pdf_path: Path, variant: str, pages: int, args, results: List[Dict]):
+    """Endpoints de Flask con el cliente de pruebas (sin servidor HTTP)"""
+    client = backend.app.test_client()
+    pdf_bytes = pdf_path.read_bytes()
+
+    def extract():
+        response = client.post('/api/extract-exercises', data=pdf_bytes, content_type='application/pdf')
+        assert response.status_code == 200, response.get_data(as_text=True)
+
+    record(results, 'endpoint:extract-exercises', variant, pages, timed(extract, args.repeat, args.verbose))
+
+    def get(path: str):
+        def call():
+            response = client.get(path)
+            assert response.status_code == 200, f'{path}: {response.status_code}'
+            response.get_data()
+        return call
+
+    first_figure = client.get('/api/figures').get_json()
+    requests = [('endpoint:exercises', '/api/exercises'), ('endpoint:figures', '/api/figures')]
+    if first_figure:
+        requests.append(('endpoint:figure-file', first_figure[0]['url']))
+
+    for stage, path in requests:
+        # Peticiones de lectura: se mide un lote de 50 para que el tiempo sea apreciable
+        times = timed(lambda: [get(path)() for _ in range(50)], args.repeat)
+        record(results, stage, variant, pages, [t / 50 for t in times])
+
+
+# ============================================================================
+# MAIN
+# ============================================================================
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark del extractor con PDFs sintéticos')
+    parser.add_argument('--pages', type=int, default=20, help='páginas por PDF')
+    parser.add_argument('--boxes', type=int, default=2, help='recuadros rojos por página')
+    parser.add_argument('--variants', default='vector,annot,scanned', help='vector, annot, scanned')
+    parser.add_argument('--modes', default='full,two_pass,vector', help='modos de detección a medir')
+    parser.add_argument('--stages', default='stages,figures,process_pdf,endpoints',
+                        help='grupos de etapas: stages, figures, process_pdf, endpoints, scheduler')
+    parser.add_argument('--repeat', type=int, default=3, help='repeticiones por etapa')
+    parser.add_argument('--workers', type=int, default=1, help='RENDER_WORKERS para figures:<modo>')
+    parser.add_argument('--extraction', default='pdf,hybrid', help='EXTRACTION_MODE para process_pdf:<modo>')
+    parser.add_argument('--throttle-every', type=int, default=4, help='scheduler: una de cada N peticiones es 429/529')
+    parser.add_argument('--retry-after', type=float, default=0.2, help='scheduler: segundos de retry-after simulados')
+    parser.add_argument('--claude-delay', type=float, default=0.5, help='segundos por respuesta simulada')
+    parser.add_argument('--output', default='benchmark_results.json', help='archivo JSON de resultados')
+    parser.add_argument('--verbose', action='store_true', help='mostrar la salida del extractor')
+    args = parser.parse_args()
+
+    args.modes = [mode for mode in args.modes.split(',') if mode]
+    args.extraction = [mode for mode in args.extraction.split(',') if mode]
+    variants = [variant for variant in args.variants.split(',') if variant]
+    stages = set(args.stages.split(','))
+    output_path = Path(args.output)
+    if not output_path.is_absolute():
+        output_path = Path(os.environ.get('PWD', BACKEND_DIR)) / output_path
+
+    # Cualquier VisualExtractor creado desde aquí usa el cliente simulado
+    backend.anthropic = SimpleNamespace(Anthropic=lambda *a, **kw: FakeAnthropic(args.claude_delay),
+                                        APIConnectionError=REAL_ANTHROPIC.APIConnectionError)
+
+    print(f"⏱️  Benchmark: {args.pages} páginas, {args.boxes} recuadros/página, {args.repeat} repeticiones")
+    print(f"📁 Directorio temporal: {WORK_DIR}\n")
+
+    results = []
+    try:
+        for variant in variants:
+            pdf_path = WORK_DIR / f'synthetic_{variant}.pdf'
+            make_pdf(pdf_path, args.pages, args.boxes, variant)
+            print(f"📄 {variant} ({pdf_path.stat().st_size / 1024:.0f} KB)")
+
+            if 'stages' in stages:
+                bench_stages(pdf_path, variant, args.pages, args, results)
+            if 'figures' in stages:
+                bench_figures(pdf_path, variant, args.pages, args, results)
+            if 'process_pdf' in stages:
+                bench_process_pdf(pdf_path, variant, args.pages, args, results)
+            if 'endpoints' in stages:
+                bench_endpoints(pdf_path, variant, args.pages, args, results)
+            if 'scheduler' in stages:
+                bench_scheduler(pdf_path, variant, args.pages, args, results)
+            print()
+    finally:
+        os.chdir(BACKEND_DIR)
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'commit': _git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'pymupdf': fitz.VersionBind,
+            'opencv': backend.cv2.__version__,
+            'pages': args.pages,
+            'boxes_per_page': args.boxes,
+            'repeat': args.repeat,
+            'workers': args.workers,
+            'claude_delay_s': args.claude_delay,
+            'config': {
+                'render_zoom': backend.Config.RENDER_ZOOM,
+                'scan_zoom': backend.Config.SCAN_ZOOM,
+                'chunk_pages': backend.Config.CHUNK_PAGES,
+                'claude_concurrency': backend.Config.CLAUDE_CONCURRENCY,
+                'claude_max_in_flight': backend.Config.CLAUDE_MAX_IN_FLIGHT,
+                'claude_tokens_per_minute': backend.Config.CLAUDE_TOKENS_PER_MINUTE,
+                'claude_max_retries': backend.Config.CLAUDE_MAX_RETRIES,
+                'hybrid_min_chars': backend.Config.HYBRID_MIN_CHARS,
+                'hybrid_math_ratio': backend.Config.HYBRID_MATH_RATIO,
+                'hybrid_image_zoom': backend.Config.HYBRID_IMAGE_ZOOM,
+                'thumbnail_height': backend.Config.THUMBNAIL_HEIGHT,
+                'figure_format': backend.Config.FIGURE_FORMAT,
+                'png_compress_level': backend.Config.PNG_COMPRESS_LEVEL,
+                'webp_quality': backend.Config.WEBP_QUALITY,
+                'encode_workers': backend.Config.ENCODE_WORKERS
+            }
+        },
+        'results': results
+    }
+
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"💾 Resultados: {output_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -39,6 +39,10 @@ function App() {
   const handleFileSelect = (e) => {
     const file = e.target.files[0];
     if (file && file.type === 'application/pdf') {
+      if (file.size > config.MAX_FILE_SIZE) {
+        alert(`El PDF supera el máximo de ${config.MAX_FILE_SIZE / 1024 / 1024} MB`);
+        return;
+      }
       setPdfFile(file);
       addLog(`PDF seleccionado: ${file.name}`, 'success');
     } else {
@@ -63,22 +67,19 @@ function App() {
     addLog('🚀 Iniciando procesamiento...', 'info');
 
     try {
-      addLog('📄 Leyendo PDF...', 'info');
-      const arrayBuffer = await pdfFile.arrayBuffer();
-      const base64 = btoa(
-        new Uint8Array(arrayBuffer).reduce((data, byte) => data + String.fromCharCode(byte), '')
-      );
+      // El archivo se envía tal cual (multipart), sin convertirlo a base64
+      const formData = new FormData();
+      formData.append('pdf', pdfFile);
 
       addLog('📸 Detectando recuadros rojos...', 'info');
       addLog('🤖 Extrayendo ejercicios con Claude AI...', 'info');
-      addLog('⏳ Esto puede tomar 30-90 segundos...', 'info');
+      setFigures([]);
+      setExercises([]);
 
-      const response = await fetch('http://localhost:5000/api/extract-exercises', {
+      // Los resultados llegan como Server-Sent Events a medida que se generan
+      const response = await fetch('http://localhost:5000/api/extract-exercises/stream', {
         method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({ pdfBase64: base64 })
+        body: formData
       });
 
       if (!response.ok) {
@@ -86,33 +87,75 @@ function App() {
         throw new Error(errorData.error || `Error ${response.status}: ${response.statusText}`);
       }
 
-      const data = await response.json();
-      
-      if (!data || !data.exercises || !data.figures) {
+      let firstExercise = true;
+      let summary = null;
+
+      const handleEvent = (event, data) => {
+        if (event === 'figures') {
+          if (data.figures.length > 0) {
+            setFigures(prev => [...prev, ...data.figures]);
+          }
+          if (data.page) {
+            addLog(`📄 Página ${data.page}/${data.total_pages}: ${data.figures.length} figuras`, 'info');
+          }
+        } else if (event === 'exercise') {
+          // Agregar campos para múltiples figuras
+          const exercise = {
+            ...data,
+            text_figures: data.text_figures || [],
+            resolution_figures: data.resolution_figures || []
+          };
+          setExercises(prev => [...prev, exercise]);
+
+          // Mostrar los ejercicios en cuanto llega el primero
+          if (firstExercise) {
+            firstExercise = false;
+            setCurrentPage(exercise.page);
+            setStep('associate');
+          }
+        } else if (event === 'error') {
+          addLog(`❌ ${data.error}`, 'error');
+        } else if (event === 'done') {
+          summary = data;
+        }
+      };
+
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        let separator;
+        while ((separator = buffer.indexOf('\n\n')) !== -1) {
+          const frame = buffer.slice(0, separator);
+          buffer = buffer.slice(separator + 2);
+
+          let event = 'message';
+          let data = '';
+          frame.split('\n').forEach(line => {
+            if (line.startsWith('event: ')) event = line.slice(7);
+            else if (line.startsWith('data: ')) data += line.slice(6);
+          });
+          if (data) handleEvent(event, JSON.parse(data));
+        }
+      }
+
+      if (!summary) {
         throw new Error('Respuesta inválida del servidor');
       }
 
-      const { exercises: extractedExercises, figures: extractedFigures } = data;
-      
-      addLog(`✅ ${extractedFigures.length} figuras detectadas`, 'success');
-      setFigures(extractedFigures);
-
-      // Agregar campos para múltiples figuras
-      const exercisesWithFigures = extractedExercises.map(ex => ({
-        ...ex,
-        text_figures: ex.text_figures || [],
-        resolution_figures: ex.resolution_figures || []
-      }));
-
-      addLog(`✅ ${exercisesWithFigures.length} ejercicios extraídos`, 'success');
-      setExercises(exercisesWithFigures);
-      
-      // Establecer la primera página disponible
-      const pages = [...new Set(exercisesWithFigures.map(ex => ex.page))].sort((a, b) => a - b);
-      if (pages.length > 0) {
-        setCurrentPage(pages[0]);
+      addLog(`✅ ${summary.figures} figuras detectadas`, 'success');
+      addLog(`✅ ${summary.exercises} ejercicios extraídos${summary.cached ? ' (desde caché)' : ''}`, 'success');
+      if (summary.failed_pages && summary.failed_pages.length > 0) {
+        const pages = summary.failed_pages.join(', ');
+        addLog(`⚠️ Páginas con ejercicios posiblemente incompletos: ${pages}`, 'error');
+        alert(`Algunos ejercicios pueden faltar en las páginas ${pages}.\n\nVuelve a subir el PDF para reprocesarlas.`);
       }
-      
+
       setStep('associate');
       addLog('🎨 Listo para trabajar', 'success');
 
@@ -127,7 +170,10 @@ function App() {
 
   // ============ FUNCIONES DE EDICIÓN ============
   
+  // Mientras llega el stream, el backend aún tiene el documento anterior: editar,
+  // eliminar o exportar actuaría sobre él y se perdería al terminar la extracción
   const startEditing = (exercise) => {
+    if (isProcessing) return;
     setEditingExercise(exercise.id);
     setEditForm({
       text: exercise.text,
@@ -175,6 +221,7 @@ function App() {
   };
 
   const deleteExercise = async (exerciseId) => {
+    if (isProcessing) return;
     if (!confirm('¿Estás seguro de eliminar este ejercicio? Esta acción no se puede deshacer.')) {
       return;
     }
@@ -245,54 +292,50 @@ function App() {
     addLog(`🗑️ ${figureId} removida de ${location}`, 'info');
   };
 
+  // ============ FIGURAS POR URL ============
+
+  const figureSrc = (fig) => fig.base64 || `${config.API_BASE_URL}${fig.url}`;
+  const thumbnailSrc = (fig) => fig.base64 || `${config.API_BASE_URL}${fig.thumbnail_url || fig.url}`;
+
   // ============ EXPORTACIÓN LIMPIA ============
 
-  const exportJSON = () => {
-    const finalExercises = exercises.map(ex => {
-      const textFigures = (ex.text_figures || [])
-        .map(id => figures.find(f => f.id === id))
-        .filter(Boolean);
-      
-      const resFigures = (ex.resolution_figures || [])
-        .map(id => figures.find(f => f.id === id))
-        .filter(Boolean);
-
-      // Construir text con imágenes incrustadas
-      let textWithImages = ex.text;
-      textFigures.forEach(fig => {
-        textWithImages += `\n\n[IMAGEN: ${fig.base64}]`;
+  // El backend arma el JSON final: solo se envían los ids y las figuras asociadas
+  const exportJSON = async () => {
+    if (isProcessing) return;
+    try {
+      const response = await fetch(`${config.API_BASE_URL}/api/save-associations`, {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({
+          exercises: exercises.map(ex => ({
+            id: ex.id,
+            text_figures: ex.text_figures || [],
+            resolution_figures: ex.resolution_figures || []
+          })),
+          format: 'json',
+          figures: 'embed'
+        })
       });
 
-      // Construir resolution con imágenes incrustadas
-      let resolutionWithImages = ex.resolution;
-      resFigures.forEach(fig => {
-        resolutionWithImages = `[IMAGEN: ${fig.base64}]\n\n` + resolutionWithImages;
-      });
+      if (!response.ok) {
+        throw new Error('Error al generar la exportación');
+      }
 
-      // Retornar SOLO el formato exacto requerido
-      // Sin campos adicionales como id, page, etc.
-      return {
-        text: textWithImages,
-        question: ex.question,
-        alternatives: ex.alternatives,
-        answer: ex.answer,
-        resolution: resolutionWithImages
-      };
-    });
+      const result = await response.json();
+      const link = document.createElement('a');
+      link.href = `${config.API_BASE_URL}${result.url}`;
+      document.body.appendChild(link);
+      link.click();
+      document.body.removeChild(link);
 
-    const dataStr = JSON.stringify(finalExercises, null, 2);
-    const dataBlob = new Blob([dataStr], { type: 'application/json' });
-    const url = URL.createObjectURL(dataBlob);
-    const link = document.createElement('a');
-    link.href = url;
-    link.download = `ejercicios_${Date.now()}.json`;
-    document.body.appendChild(link);
-    link.click();
-    document.body.removeChild(link);
-    URL.revokeObjectURL(url);
-
-    addLog('✅ JSON exportado correctamente', 'success');
-    alert('✅ JSON exportado con formato limpio!');
+      addLog(`✅ JSON exportado correctamente (${result.exercises} ejercicios, ${result.figures} figuras)`, 'success');
+      alert('✅ JSON exportado con formato limpio!');
+    } catch (error) {
+      addLog(`❌ Error al exportar: ${error.message}`, 'error');
+      alert('Error al exportar el JSON');
+    }
   };
 
   const reset = () => {
@@ -424,7 +467,7 @@ function App() {
                     {pdfFile ? pdfFile.name : 'Click para seleccionar PDF'}
                   </p>
                   <p style={{ fontSize: '14px', color: '#6b7280' }}>
-                    {pdfFile ? `${(pdfFile.size / 1024 / 1024).toFixed(2)} MB` : 'Máximo 15 MB'}
+                    {pdfFile ? `${(pdfFile.size / 1024 / 1024).toFixed(2)} MB` : `Máximo ${config.MAX_FILE_SIZE / 1024 / 1024} MB`}
                   </p>
                 </div>
                 <input
@@ -519,24 +562,32 @@ function App() {
                     <p style={{ fontSize: '24px', fontWeight: 'bold', color: '#713f12' }}>{pageCount}</p>
                   </div>
                 </div>
-                <div style={{ display: 'flex', gap: '8px', marginLeft: '16px' }}>
+                <div style={{ display: 'flex', gap: '8px', marginLeft: '16px', alignItems: 'center' }}>
+                  {isProcessing && (
+                    <span style={{ display: 'flex', alignItems: 'center', gap: '6px', fontSize: '14px', color: '#1e40af' }}>
+                      <Loader style={{ animation: 'spin 1s linear infinite' }} size={16} />
+                      Extrayendo...
+                    </span>
+                  )}
                   <button
                     onClick={exportJSON}
+                    disabled={isProcessing}
+                    title={isProcessing ? 'Disponible al terminar la extracción' : undefined}
                     style={{
                       padding: '12px 24px',
-                      background: '#16a34a',
+                      background: isProcessing ? '#9ca3af' : '#16a34a',
                       color: 'white',
                       borderRadius: '8px',
                       border: 'none',
                       fontWeight: '600',
-                      cursor: 'pointer',
+                      cursor: isProcessing ? 'not-allowed' : 'pointer',
                       display: 'flex',
                       alignItems: 'center',
                       gap: '8px',
                       transition: 'background 0.2s'
                     }}
-                    onMouseEnter={(e) => e.currentTarget.style.background = '#15803d'}
-                    onMouseLeave={(e) => e.currentTarget.style.background = '#16a34a'}
+                    onMouseEnter={(e) => { if (!isProcessing) e.currentTarget.style.background = '#15803d'; }}
+                    onMouseLeave={(e) => { if (!isProcessing) e.currentTarget.style.background = '#16a34a'; }}
                   >
                     <Download size={20} />
                     Exportar
@@ -648,35 +699,39 @@ function App() {
                                 <>
                                   <button
                                     onClick={(e) => { e.stopPropagation(); startEditing(ex); }}
+                                    disabled={isProcessing}
                                     style={{
                                       padding: '8px',
                                       background: '#dbeafe',
                                       color: '#2563eb',
                                       borderRadius: '6px',
                                       border: 'none',
-                                      cursor: 'pointer',
+                                      cursor: isProcessing ? 'not-allowed' : 'pointer',
+                                      opacity: isProcessing ? 0.5 : 1,
                                       display: 'flex',
                                       alignItems: 'center',
                                       justifyContent: 'center'
                                     }}
-                                    title="Editar"
+                                    title={isProcessing ? 'Disponible al terminar la extracción' : 'Editar'}
                                   >
                                     <Edit2 size={16} />
                                   </button>
                                   <button
                                     onClick={(e) => { e.stopPropagation(); deleteExercise(ex.id); }}
+                                    disabled={isProcessing}
                                     style={{
                                       padding: '8px',
                                       background: '#fee2e2',
                                       color: '#dc2626',
                                       borderRadius: '6px',
                                       border: 'none',
-                                      cursor: 'pointer',
+                                      cursor: isProcessing ? 'not-allowed' : 'pointer',
+                                      opacity: isProcessing ? 0.5 : 1,
                                       display: 'flex',
                                       alignItems: 'center',
                                       justifyContent: 'center'
                                     }}
-                                    title="Eliminar"
+                                    title={isProcessing ? 'Disponible al terminar la extracción' : 'Eliminar'}
                                   >
                                     <Trash2 size={16} />
                                   </button>
@@ -741,7 +796,7 @@ function App() {
                               <div style={{ marginTop: '8px', display: 'flex', flexDirection: 'column', gap: '8px' }}>
                                 {textFigs.map(fig => (
                                   <div key={fig.id} style={{ padding: '8px', background: 'white', borderRadius: '4px', display: 'flex', alignItems: 'center', gap: '8px' }}>
-                                    <img src={fig.base64} alt="" style={{ height: '60px', borderRadius: '4px' }} />
+                                    <img src={thumbnailSrc(fig)} alt="" loading="lazy" style={{ height: '60px', borderRadius: '4px' }} />
                                     <p style={{ fontSize: '12px', color: '#16a34a', fontWeight: '600', flex: 1, display: 'flex', alignItems: 'center', gap: '4px' }}>
                                       <CheckCircle size={12} />
                                       {fig.filename}
@@ -827,7 +882,7 @@ function App() {
                               <div style={{ marginTop: '8px', display: 'flex', flexDirection: 'column', gap: '8px' }}>
                                 {resFigs.map(fig => (
                                   <div key={fig.id} style={{ padding: '8px', background: 'white', borderRadius: '4px', display: 'flex', alignItems: 'center', gap: '8px' }}>
-                                    <img src={fig.base64} alt="" style={{ height: '60px', borderRadius: '4px' }} />
+                                    <img src={thumbnailSrc(fig)} alt="" loading="lazy" style={{ height: '60px', borderRadius: '4px' }} />
                                     <p style={{ fontSize: '12px', color: '#16a34a', fontWeight: '600', flex: 1, display: 'flex', alignItems: 'center', gap: '4px' }}>
                                       <CheckCircle size={12} />
                                       {fig.filename}
@@ -889,7 +944,7 @@ function App() {
                             {isAssigned && <CheckCircle size={20} style={{ color: '#16a34a' }} />}
                           </div>
                           
-                          <img src={fig.base64} alt={fig.filename} style={{ width: '100%', borderRadius: '6px', border: '1px solid #e5e7eb', marginBottom: '12px' }} />
+                          <img src={figureSrc(fig)} alt={fig.filename} loading="lazy" style={{ width: '100%', borderRadius: '6px', border: '1px solid #e5e7eb', marginBottom: '12px' }} />
                           
                           {selectedExercise && !editingExercise && (
                             <div style={{ display: 'flex', gap: '8px' }}>
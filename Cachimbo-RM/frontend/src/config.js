@@ -11,7 +11,7 @@ export const config = {
   
   // Otras configuraciones
   API_BASE_URL: 'http://localhost:5000',
-  MAX_FILE_SIZE: 15 * 1024 * 1024, // 15 MB
+  MAX_FILE_SIZE: 100 * 1024 * 1024, // 100 MB (igual que MAX_UPLOAD_MB del backend)
   SUPPORTED_FILE_TYPES: ['application/pdf'],
   CLAUDE_MODEL: 'claude-sonnet-4-20250514',
   MAX_TOKENS: 8000